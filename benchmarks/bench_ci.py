@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+    Compare profile confidence intervals from kfit.uncertainty with
+    lmfit's conf_interval, for time and for agreement
+
+    Both search for each bound with the same root finder, which stops
+    within a relative tolerance of 5e-5, but kfit refits each probe
+    from the nearest probe already fit and lmfit from the best fit, so
+    the two can stop at slightly different points. Bounds are compared
+    relative to their value and to their distance from the best value.
+
+    Usage:
+        python benchmarks/bench_ci.py --seeds 3
+'''
+
+import os
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from kfit.engine import FitEngine  # noqa: E402
+from kfit.uncertainty import conf_intervals  # noqa: E402
+from bench_fit import make_spectrum  # noqa: E402
+
+# (peak type, number of peaks, number of points)
+cases = [
+    ('gau', 2, 1000),
+    ('lor', 2, 1000),
+    ('voi', 2, 1000),
+    ('gau', 4, 2000),
+]
+
+
+def differences(ours, ref):
+    '''
+        Returns the largest difference between matching bounds,
+        relative to the bound (as lmfit's root finding tolerance is)
+        and to its distance from the best value, and how many bounds
+        only one of the two found (the other ran into a parameter
+        bound)
+    '''
+    by_value, by_width, unmatched = 0, 0, 0
+    for name, rows in ref.items():
+        best = dict(rows)[0]
+        for (_, val), (_, ref_val) in zip(ours[name], rows):
+            if not (np.isfinite(val) and np.isfinite(ref_val)):
+                unmatched += np.isfinite(val) != np.isfinite(ref_val)
+                continue
+            diff = abs(val - ref_val)
+            if ref_val != 0:
+                by_value = max(by_value, diff/abs(ref_val))
+            if ref_val != best:
+                by_width = max(by_width, diff/abs(ref_val - best))
+    return by_value, by_width, unmatched
+
+
+def timed(func):
+    '''
+        Returns (seconds, result), or (None, error) if func raises
+        ValueError, e.g. for a bound the root finder can't bracket
+    '''
+    t0 = time.perf_counter()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            out = func()
+    except ValueError as e:
+        return None, e
+    return time.perf_counter() - t0, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:<12} {:>4} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'case', 'seed', 'kfit (s)', 'lmfit (s)', 'rel value', 'rel width',
+        'unmatched'
+    ))
+    worst = np.zeros(2)
+    for kind, npeaks, npoints in cases:
+        for seed in range(args.seeds):
+            rng = np.random.default_rng(seed)
+            x, y, truth = make_spectrum(npeaks, npoints, args.noise, rng,
+                                        kind=kind)
+            engine = FitEngine(x, y, **{'n' + kind: npeaks})
+            result = engine.fit()
+            label = '{} {}x{}'.format(kind, npeaks, npoints)
+            ours_s, ours = timed(
+                lambda: conf_intervals(engine, workers=args.workers)
+            )
+            ref_s, ref = timed(result.conf_interval)
+            if ours_s is None or ref_s is None:
+                print('{:<12} {:>4} failed in {}: {}'.format(
+                    label, seed, 'kfit' if ours_s is None else 'lmfit',
+                    ours if ours_s is None else ref
+                ))
+                continue
+            *diffs, unmatched = differences(ours, ref)
+            worst = np.maximum(worst, diffs)
+            print('{:<12} {:>4} {:>8.2f} {:>9.2f} {:>9.2g} {:>9.2g} {:>9}'
+                  .format(label, seed, ours_s, ref_s, *diffs, unmatched))
+    print('largest difference: {:.2g} of the bound, {:.2g} of its distance '
+          'from the best value'.format(*worst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''
+    Time FitEngine on a synthetic spectrum of N pseudo-voigts
+
+    Usage:
+        python benchmarks/bench_fit.py --npeaks 40 --npoints 5000
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from kfit.engine import FitEngine  # noqa: E402
+from kfit.models import MultiPeakModel  # noqa: E402
+from lmfit.model import Parameters  # noqa: E402
+
+
+def make_spectrum(npeaks, npoints, noise, rng, kind='voi'):
+    '''
+        Returns x, y and the true parameter values
+    '''
+    x = np.linspace(100, 1800, npoints)
+    spacing = (x[-1] - x[0])/(npeaks + 1)
+    truth = {'lin1_slope': 1e-4, 'lin1_intercept': 0.5}
+    for i in range(npeaks):
+        prefix = '{}{}_'.format(kind, i+1)
+        truth[prefix + 'amplitude'] = rng.uniform(5, 50)
+        truth[prefix + 'center'] = x[0] + spacing*(i+1) + \
+            rng.uniform(-0.2, 0.2)*spacing
+        truth[prefix + 'sigma'] = rng.uniform(0.1, 0.25)*spacing
+        if kind == 'voi':
+            truth[prefix + 'fraction'] = rng.uniform(0.2, 0.8)
+    model = MultiPeakModel(**{'n' + kind: npeaks})
+    params = Parameters()
+    for name, val in truth.items():
+        params.add(name, value=val)
+    y = model.eval(params, x=x) + rng.normal(0, noise, npoints)
+    return x, y, truth
+
+
+def perturbed(truth, rng):
+    '''
+        Starting values a little way off the truth
+    '''
+    start = {}
+    for name, val in truth.items():
+        if name.endswith('center'):
+            sigma = truth[name.replace('center', 'sigma')]
+            start[name] = val + rng.uniform(-0.3, 0.3)*sigma
+        elif name.endswith('fraction'):
+            start[name] = 0.5
+        else:
+            start[name] = val*rng.uniform(0.8, 1.2)
+    return start
+
+
+def run(x, y, npeaks, start, **engine_kws):
+    engine = FitEngine(x, y, nvoi=npeaks, **engine_kws)
+    engine.usr_vals['value'].update(start)
+    t0 = time.perf_counter()
+    result = engine.fit()
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--npeaks', type=int, default=40)
+    parser.add_argument('--npoints', type=int, default=5000)
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--window', type=float, default=8,
+        help='window (in sigmas) for the sparse jacobian case'
+    )
+    parser.add_argument(
+        '--skip-dense', action='store_true',
+        help='skip the finite-difference case, which is slow on big fits'
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    x, y, truth = make_spectrum(args.npeaks, args.npoints, args.noise, rng)
+    start = perturbed(truth, rng)
+    print('{} pseudo-voigts, {} points'.format(args.npeaks, args.npoints))
+    print('{:<24} {:>9} {:>7} {:>12}'.format(
+        'case', 'time (s)', 'nfev', 'redchi'
+    ))
+    cases = [
+        ('finite differences', {'analytic_jac': False}),
+        ('analytic jacobian', {'analytic_jac': True}),
+        ('sparse, window={:g}'.format(args.window), {'window': args.window}),
+    ]
+    if args.skip_dense:
+        cases = cases[1:]
+    for label, engine_kws in cases:
+        seconds, result = run(x, y, args.npeaks, start, **engine_kws)
+        print('{:<24} {:>9.2f} {:>7} {:>12.4g}'.format(
+            label, seconds, result.nfev, result.redchi
+        ))
+
+
+if __name__ == '__main__':
+    main()
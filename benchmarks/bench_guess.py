@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''
+    Compare fits seeded from detected peaks with the old seeding, where
+    every peak started at mean(x) with height mean(y) and width std(x)
+
+    A low nfev from the old seeding usually means the fit stalled,
+    so the number of fits that got down to the noise level is also
+    reported.
+
+    Usage:
+        python benchmarks/bench_guess.py --seeds 3
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from kfit.engine import FitEngine  # noqa: E402
+from bench_fit import make_spectrum  # noqa: E402
+
+# (peak type, number of peaks, number of points)
+cases = [
+    ('gau', 3, 1000),
+    ('lor', 3, 1000),
+    ('voi', 5, 2000),
+    ('gau', 10, 5000),
+    ('voi', 20, 5000),
+]
+
+
+def old_guesses(engine):
+    '''
+        The seeding guess_params used before peak detection
+    '''
+    vals = {}
+    for prefix in engine.model.prefixes:
+        if prefix.find('lin') != -1:
+            vals[prefix + 'slope'] = np.mean(engine.y)
+            vals[prefix + 'intercept'] = np.mean(engine.y)
+        else:
+            vals[prefix + 'center'] = np.mean(engine.x)
+            vals[prefix + 'amplitude'] = np.mean(engine.y)
+            vals[prefix + 'sigma'] = np.std(engine.x, ddof=1)
+            if prefix.find('voi') != -1:
+                vals[prefix + 'fraction'] = 0.5
+    return vals
+
+
+def run(x, y, kind, npeaks, old):
+    engine = FitEngine(x, y, **{'n' + kind: npeaks})
+    if old:
+        engine.usr_vals['value'].update(old_guesses(engine))
+    t0 = time.perf_counter()
+    result = engine.fit()
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=0.05)
+    args = parser.parse_args()
+
+    print('{:<14} {:>5} {:>9} {:>9} {:>11} {:>11}'.format(
+        'case', 'seed', 'nfev old', 'nfev new', 'redchi old', 'redchi new'
+    ))
+    totals = np.zeros(2)
+    floor = np.zeros(2, dtype=int)
+    nfits = 0
+    for kind, npeaks, npoints in cases:
+        for seed in range(args.seeds):
+            rng = np.random.default_rng(seed)
+            x, y, truth = make_spectrum(npeaks, npoints, args.noise, rng,
+                                        kind=kind)
+            old_s, old = run(x, y, kind, npeaks, old=True)
+            new_s, new = run(x, y, kind, npeaks, old=False)
+            totals += [old.nfev, new.nfev]
+            floor += [r.redchi < 1.1*args.noise**2 for r in (old, new)]
+            nfits += 1
+            print('{:<14} {:>5} {:>9} {:>9} {:>11.4g} {:>11.4g}'.format(
+                '{} {}x{}'.format(kind, npeaks, npoints), seed,
+                old.nfev, new.nfev, old.redchi, new.redchi
+            ))
+    print('total nfev: {:.0f} old, {:.0f} new ({:.1f}x fewer)'.format(
+        totals[0], totals[1], totals[0]/totals[1]
+    ))
+    print('reached the noise level: {} of {} old, {} of {} new'.format(
+        floor[0], nfits, floor[1], nfits
+    ))
+
+
+if __name__ == '__main__':
+    main()
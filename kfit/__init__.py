@@ -0,0 +1,3 @@
+'''
+    kfit - simple, graphical spectral fitting
+'''
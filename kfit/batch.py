@@ -0,0 +1,417 @@
+'''
+    Fit many spectra without the GUI
+
+    Usage:
+        kfit-batch 'runs/*.csv' --ngau 2 --nlor 1 --value gau1_center=520
+        kfit-batch 'runs/*.csv' --nvoi 3 --series
+        kfit-batch 'runs/*.csv' --ngau 10 --global --shared center sigma
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+try:
+    from . import models, tools
+    from .engine import FitEngine, empty_vals
+except ImportError:
+    import models
+    import tools
+    from engine import FitEngine, empty_vals
+
+
+def parse_header(text):
+    # same rules as the settings dialog
+    return 'infer' if text == 'infer' else int(text)
+
+
+def parse_overrides(args):
+    '''
+        Turn --value/--min/--max NAME=FLOAT options into usr_vals
+    '''
+    usr_vals = empty_vals()
+    for val_type in usr_vals:
+        for item in getattr(args, val_type) or []:
+            name, sep, val = item.partition('=')
+            if not sep:
+                raise ValueError(
+                    'Expected NAME=VALUE for --{}, got {!r}'.format(
+                        val_type, item
+                    )
+                )
+            usr_vals[val_type][name.strip()] = float(val)
+    return usr_vals
+
+
+def file_stem(path, depth=0):
+    '''
+        File name without its extension, after depth parent
+        directories, e.g. file_stem('a/b/run.csv', 1) == 'b_run'
+    '''
+    parts = os.path.abspath(path).split(os.sep)[1:]
+    parts[-1] = os.path.splitext(parts[-1])[0]
+    return '_'.join(parts[-depth-1:])
+
+
+def output_stems(files):
+    '''
+        Returns {path: name its outputs are written under}: the file
+        name, with as many parent directories as it takes to tell apart
+        files that share one (a/run.csv, b/run.csv -> a_run, b_run)
+    '''
+    stems = {path: file_stem(path) for path in files}
+    depth = 0
+    while True:
+        counts = Counter(stems.values())
+        clashing = [path for path in files if counts[stems[path]] > 1]
+        if not clashing:
+            return stems
+        depth += 1
+        if depth >= max(len(os.path.abspath(path).split(os.sep))
+                        for path in clashing):
+            break
+        for path in clashing:
+            stems[path] = file_stem(path, depth)
+    # e.g. run.csv and run.txt in one directory: number them by their
+    # place in the batch
+    for i, path in enumerate(files):
+        if counts[stems[path]] > 1:
+            stems[path] = '{}_{}'.format(file_stem(path), i + 1)
+    return stems
+
+
+def output_paths(path, outdir, fmt='csv', stem=None):
+    if stem is None:
+        stem = file_stem(path)
+    curves_path = os.path.join(outdir, stem + tools.export_ext[fmt])
+    params_path = os.path.join(outdir, stem + '.params.csv')
+    return curves_path, params_path
+
+
+def make_engine(spec, x=None, y=None):
+    engine = FitEngine(
+        x, y, ngau=spec['ngau'], nlor=spec['nlor'], nvoi=spec['nvoi'],
+        nlin=spec['nlin'], fit_method=spec['fit_method'],
+        window=spec['window']
+    )
+    engine.usr_vals = spec['usr_vals']
+    return engine
+
+
+def fit_file(path, spec, import_kws, outdir, export_kws=None, stem=None):
+    '''
+        Import, fit and export a single file, with the curves written by
+        tools.write_curves(**export_kws), named by stem (default: the
+        file name)
+
+        Never raises, so one bad file can't take down the batch.
+        Returns a record for the summary table.
+    '''
+    record = {'file': path, 'status': 'ok', 'seconds': None,
+              'redchi': None, 'nfev': None, 'error': ''}
+    start = time.perf_counter()
+    try:
+        df = tools.to_df(path, usecols=[spec['xcol'], spec['ycol']],
+                         **import_kws)
+        engine = make_engine(spec, df.iloc[:, 0].values, df.iloc[:, 1].values)
+        result = engine.fit()
+        params_df, curves_df = engine.process_results(xname=df.columns[0])
+        export_kws = export_kws or {}
+        curves_path, params_path = output_paths(
+            path, outdir, export_kws.get('fmt') or 'csv', stem=stem
+        )
+        tools.write_curves(curves_df, curves_path, **export_kws)
+        params_df.to_csv(params_path)
+        record['redchi'] = result.redchi
+        record['nfev'] = result.nfev
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def fit_series(files, spec, import_kws, outdir, extrapolate=True):
+    '''
+        Fit files one after another, each warm-started from the last,
+        and write series.csv (parameter vs index) and series_fits.csv
+
+        Files that fail to import are skipped, and ones that fail to fit
+        are listed in series_fits.csv with their error. Returns the
+        number of files that failed.
+    '''
+    engine = make_engine(spec)
+    fitted = []
+    failed = []
+
+    def spectra():
+        for path in files:
+            try:
+                df = tools.to_df(path, usecols=[spec['xcol'], spec['ycol']],
+                                 **import_kws)
+                x = df.iloc[:, 0].values
+                y = df.iloc[:, 1].values
+            except Exception as e:
+                failed.append(path)
+                print('failed {} {}: {}'.format(path, type(e).__name__, e))
+                continue
+            fitted.append(path)
+            yield x, y
+
+    def report(index, result, reseeded):
+        print('{:<6} {:>5} {} redchi={:.4g}{}'.format(
+            'ok', index, fitted[index], result.redchi,
+            ' (re-seeded)' if reseeded else ''
+        ))
+
+    def report_error(index, error):
+        print('{:<6} {:>5} {} {}'.format('failed', index, fitted[index],
+                                         error))
+
+    start = time.perf_counter()
+    params_df, fits_df = engine.fit_series(
+        spectra(), extrapolate=extrapolate, on_fit=report,
+        on_error=report_error
+    )
+    params_df.insert(1, 'file', [fitted[i] for i in params_df['index']])
+    fits_df.insert(0, 'file', fitted)
+    params_df.to_csv(os.path.join(outdir, 'series.csv'), index=False)
+    fits_df.to_csv(os.path.join(outdir, 'series_fits.csv'))
+    nfit = int((fits_df['status'] == 'ok').sum())
+    print('Fit {} of {} files in {:.2f}s, {} re-seeded.'.format(
+        nfit, len(files), time.perf_counter() - start,
+        int(fits_df['reseeded'].sum())
+    ))
+    return len(files) - nfit
+
+
+def fit_global(files, spec, import_kws, outdir, shared=models.shared_args):
+    '''
+        Fit all the files at once with the shared parameters tied
+        across them, and write global.csv (parameter vs index)
+
+        Files that fail to import are left out of the fit. Returns the
+        number of files that failed.
+    '''
+    engine = make_engine(spec)
+    spectra, fitted, failed = [], [], []
+    for path in files:
+        try:
+            df = tools.to_df(path, usecols=[spec['xcol'], spec['ycol']],
+                             **import_kws)
+        except Exception as e:
+            failed.append(path)
+            print('failed {} {}: {}'.format(path, type(e).__name__, e))
+            continue
+        spectra.append((df.iloc[:, 0].values, df.iloc[:, 1].values))
+        fitted.append(path)
+
+    start = time.perf_counter()
+    result, params_df = engine.fit_global(spectra, shared=shared)
+    params_df.insert(1, 'file', [fitted[i] for i in params_df['index']])
+    params_df.to_csv(os.path.join(outdir, 'global.csv'), index=False)
+    print('Fit {} of {} files together in {:.2f}s: {} parameters, '
+          'redchi={:.4g}, nfev={}{}'.format(
+              len(fitted), len(files), time.perf_counter() - start,
+              result.nvarys, result.redchi, result.nfev,
+              '' if result.success else ' (not converged)'
+          ))
+    return len(failed)
+
+
+def expand_files(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        files.extend(matches if matches else [pattern])
+    # drop duplicates but keep order
+    return list(dict.fromkeys(files))
+
+
+def add_model_args(parser):
+    '''
+        Options for the model and parameter values, shared with kfit-map
+    '''
+    model = parser.add_argument_group('model')
+    model.add_argument('--ngau', type=int, default=0)
+    model.add_argument('--nlor', type=int, default=0)
+    model.add_argument('--nvoi', type=int, default=0)
+    model.add_argument('--nlin', type=int, default=1)
+    model.add_argument('--fit-method', default='least_squares')
+    model.add_argument(
+        '--window', type=float, default=None, metavar='K',
+        help='only evaluate peaks within K*sigma of their centers and '
+             'use a sparse jacobian (least_squares only)'
+    )
+    for val_type in ['value', 'min', 'max']:
+        model.add_argument(
+            '--' + val_type, action='append', metavar='NAME=VALUE',
+            help='set the {} of a parameter, e.g. gau1_sigma=0.5'.format(
+                val_type
+            )
+        )
+
+
+def model_spec(parser, args):
+    '''
+        Returns the spec make_engine() takes from parsed model options
+    '''
+    try:
+        usr_vals = parse_overrides(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return {
+        'ngau': max(args.ngau, 0), 'nlor': max(args.nlor, 0),
+        'nvoi': max(args.nvoi, 0), 'nlin': max(args.nlin, 1),
+        'fit_method': args.fit_method, 'window': args.window,
+        'usr_vals': usr_vals,
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='kfit-batch',
+        description='Fit a set of spectra with the same kfit model.'
+    )
+    parser.add_argument(
+        'files', nargs='+',
+        help='files or glob patterns (quote them to avoid shell expansion)'
+    )
+    add_model_args(parser)
+    series = parser.add_argument_group('series')
+    series.add_argument(
+        '--series', action='store_true',
+        help='fit the files in order, each starting from the last '
+             'result, and write series.csv instead of one file per fit'
+    )
+    series.add_argument(
+        '--no-drift', action='store_true',
+        help='start from the last result as is, without extrapolating '
+             'the drift between the last two'
+    )
+    joint = parser.add_argument_group('global fit')
+    joint.add_argument(
+        '--global', dest='global_fit', action='store_true',
+        help='fit all the files at once with the shared parameters of '
+             'every peak tied across them, and write global.csv'
+    )
+    joint.add_argument(
+        '--shared', nargs='+', default=models.shared_args,
+        choices=models.shared_args, metavar='ARG',
+        help='peak parameters tied across files (default: %(default)s)'
+    )
+    data = parser.add_argument_group('import (see tools.to_df)')
+    data.add_argument('--xcol', type=int, default=0)
+    data.add_argument('--ycol', type=int, default=1)
+    data.add_argument('--sep', default=',')
+    data.add_argument('--header', type=parse_header, default='infer')
+    data.add_argument('--skiprows', type=int, default=None)
+    data.add_argument('--dtype', default=None)
+    data.add_argument('--encoding', default=None)
+    data.add_argument(
+        '--format', dest='fmt', default=None,
+        choices=sorted(set(tools.formats.values())),
+        help='file format (default: from the extension or contents)'
+    )
+    data.add_argument('--dataset', default=None,
+                      help='HDF5 dataset to read (default: the first one)')
+    export = parser.add_argument_group('export (see tools.write_curves)')
+    export.add_argument(
+        '--export-format', default='csv',
+        choices=sorted(tools.export_ext),
+        help='format of the curves files (default: %(default)s); '
+             'parameters always go to <name>.params.csv'
+    )
+    export.add_argument(
+        '--compress', nargs='?', const=True, default=None, metavar='CODEC',
+        help='compress the curves, with CODEC or the format\'s default'
+    )
+    export.add_argument(
+        '--float32', action='store_true',
+        help='store the curves (but not x) as float32'
+    )
+    parser.add_argument(
+        '-o', '--outdir', default='kfit_results',
+        help='where to write <name>.csv (or .parquet, ...) and '
+             '<name>.params.csv'
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)'
+    )
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    spec = model_spec(parser, args)
+    spec.update({'xcol': args.xcol, 'ycol': args.ycol})
+    files = expand_files(args.files)
+    import_kws = {
+        'sep': args.sep, 'header': args.header, 'skiprows': args.skiprows,
+        'dtype': args.dtype, 'encoding': args.encoding,
+        'fmt': args.fmt, 'dataset': args.dataset,
+    }
+    export_kws = {
+        'fmt': args.export_format, 'compression': args.compress,
+        'float32': args.float32,
+    }
+    os.makedirs(args.outdir, exist_ok=True)
+    if args.series and args.global_fit:
+        parser.error('--series and --global can\'t be used together')
+    if args.global_fit:
+        try:
+            nfailed = fit_global(files, spec, import_kws, args.outdir,
+                                 shared=args.shared)
+        except ValueError as e:
+            parser.error(str(e))
+        return 1 if nfailed else 0
+    if args.series:
+        nfailed = fit_series(files, spec, import_kws, args.outdir,
+                             extrapolate=not args.no_drift)
+        return 1 if nfailed else 0
+
+    records = []
+    start = time.perf_counter()
+    # files with the same name in different directories would overwrite
+    # each other's outputs
+    stems = output_stems(files)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(fit_file, path, spec, import_kws, args.outdir,
+                        export_kws, stems[path]): path
+            for path in files
+        }
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                # e.g. the worker process died
+                record = {'file': futures[future], 'status': 'failed',
+                          'seconds': None, 'redchi': None, 'nfev': None,
+                          'error': '{}: {}'.format(type(e).__name__, e)}
+            records.append(record)
+            seconds = record['seconds']
+            print('{:<6} {:>8} {} {}'.format(
+                record['status'],
+                '-' if seconds is None else '{:.2f}s'.format(seconds),
+                record['file'], record['error']
+            ).rstrip())
+
+    summary = pd.DataFrame(records)
+    summary.to_csv(os.path.join(args.outdir, 'summary.csv'), index=False)
+    nfailed = int((summary['status'] != 'ok').sum()) if records else 0
+    print('Fit {} of {} files in {:.2f}s, {} failed.'.format(
+        len(records) - nfailed, len(records),
+        time.perf_counter() - start, nfailed
+    ))
+    return 1 if nfailed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+'''
+    On-disk cache of parsed data files
+
+    Parsing a large CSV takes seconds, and the same file tends to be
+    imported again and again while a model is tuned. ImportCache keeps
+    each parsed frame as one .npy file per column, keyed by the file's
+    path, size and modification time and by the import settings, so a
+    repeat import is a handful of memory-mapped opens. Entries are
+    evicted least recently used first once the cache grows past its
+    size cap.
+
+    The cache lives in $KFIT_CACHE_DIR (default ~/.cache/kfit/imports)
+    and holds at most $KFIT_CACHE_MB megabytes (default 1024, 0 turns
+    it off).
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+try:
+    from . import tools
+except ImportError:
+    import tools
+
+# bump when the layout of an entry changes, so old entries are ignored
+cache_version = 1
+default_size_mb = 1024
+meta_name = 'meta.json'
+# formats worth caching; the binary ones are already memory-mapped
+cached_formats = ['csv']
+# dtype kinds a column can be stored and mapped back as
+cached_kinds = 'biufcmM'
+
+
+def default_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.environ.get('KFIT_CACHE_DIR') or \
+        os.path.join(base, 'kfit', 'imports')
+
+
+def default_size():
+    return int(float(os.environ.get('KFIT_CACHE_MB', default_size_mb))*2**20)
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+    )
+
+
+def parse(file_path, fmt, import_kws, on_chunk=None, cancel=None):
+    '''
+        tools.to_df(), in pieces if on_chunk is given and the file is
+        text read with usecols (see ImportCache.load)
+    '''
+    usecols = import_kws.get('usecols')
+    if on_chunk is None or fmt != 'csv' or usecols is None:
+        df = tools.to_df(file_path, **import_kws)
+        if on_chunk is not None:
+            size = os.path.getsize(file_path)
+            on_chunk(df, size, size)
+        return df
+    csv_kws = {key: import_kws[key] for key in
+               ['sep', 'header', 'skiprows', 'dtype', 'encoding']
+               if key in import_kws}
+    chunks = []
+    for chunk, nbytes, size in tools.read_csv_chunks(
+            file_path, usecols, **csv_kws):
+        if cancel is not None and cancel.is_set():
+            return None
+        chunks.append(chunk)
+        on_chunk(chunk, nbytes, size)
+    if cancel is not None and cancel.is_set():
+        return None
+    if not chunks:
+        # nothing below the header
+        return tools.to_df(file_path, **import_kws)
+    if len(chunks) == 1:
+        return chunks[0]  # no need to copy it
+    return pd.concat(chunks, ignore_index=True)
+
+
+class ImportCache():
+    '''
+        Caches tools.to_df() results under cache_dir, using at most
+        max_bytes of disk
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = default_dir() if cache_dir is None else cache_dir
+        self.max_bytes = default_size() if max_bytes is None else max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, file_path, import_kws):
+        '''
+            Name of the entry for file_path as it is now, read with
+            import_kws
+        '''
+        stat = os.stat(file_path)
+        ident = json.dumps(
+            [cache_version, os.path.abspath(file_path), stat.st_size,
+             stat.st_mtime_ns, sorted(import_kws.items())],
+            default=str
+        )
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def load(self, file_path, on_chunk=None, cancel=None, **import_kws):
+        '''
+            Same as tools.to_df(file_path, **import_kws), from the cache
+            if the file was parsed before with the same settings
+
+            With on_chunk, a text file with usecols is parsed a piece at
+            a time and each piece is passed to on_chunk(frame, bytes
+            read, file size) as it arrives; anything else arrives as a
+            single piece. Setting the cancel event stops the parse
+            between pieces, and None is returned.
+        '''
+        fmt = import_kws.get('fmt') or tools.detect_format(file_path)
+        if not self.enabled or fmt not in cached_formats:
+            return parse(file_path, fmt, import_kws, on_chunk, cancel)
+        key = self.key(file_path, import_kws)
+        df = self.get(key)
+        if df is not None:
+            if on_chunk is not None:
+                size = os.path.getsize(file_path)
+                on_chunk(df, size, size)
+            return df
+        df = parse(file_path, fmt, import_kws, on_chunk, cancel)
+        if df is not None:
+            try:
+                self.put(key, df)
+            except OSError:
+                pass  # a full or read-only disk just means no caching
+        return df
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(path, meta_name)) as f:
+                meta = json.load(f)
+            columns = [
+                np.load(os.path.join(path, '{}.npy'.format(i)), mmap_mode='r')
+                for i in range(len(meta['columns']))
+            ]
+            levels = [
+                np.load(os.path.join(path, 'index{}.npy'.format(i)),
+                        mmap_mode='r')
+                for i in range(len(meta['index']))
+            ]
+        except (OSError, ValueError, KeyError):
+            return None
+        # mark as recently used; a read-only cache, or an entry evicted
+        # by another kfit meanwhile, still gives a hit
+        try:
+            os.utime(os.path.join(path, meta_name))
+        except OSError:
+            pass
+        df = pd.DataFrame(dict(enumerate(columns)), copy=False)
+        df.columns = meta['columns']
+        if len(levels) == 1:
+            df.index = pd.Index(levels[0], name=meta['index'][0], copy=False)
+        elif levels:
+            df.index = pd.MultiIndex.from_arrays(levels, names=meta['index'])
+        return df
+
+    def put(self, key, df):
+        '''
+            Store df under key, unless it has columns that can't be
+            stored as plain arrays or is bigger than the whole cache
+        '''
+        arrays = [df.iloc[:, i].to_numpy() for i in range(df.shape[1])]
+        index = df.index
+        if isinstance(index, pd.RangeIndex) and index.start == 0 and \
+                index.step == 1:
+            levels = []
+        else:
+            levels = [index.get_level_values(i).to_numpy()
+                      for i in range(index.nlevels)]
+        if any(arr.dtype.kind not in cached_kinds for arr in arrays + levels):
+            return
+        if sum(arr.nbytes for arr in arrays + levels) > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            for i, arr in enumerate(arrays):
+                np.save(os.path.join(tmp_path, '{}.npy'.format(i)), arr)
+            for i, arr in enumerate(levels):
+                np.save(os.path.join(tmp_path, 'index{}.npy'.format(i)), arr)
+            meta = {
+                'columns': list(df.columns),
+                'index': list(index.names) if levels else [],
+            }
+            with open(os.path.join(tmp_path, meta_name), 'w') as f:
+                json.dump(meta, f, default=str)
+            # written last, so a half-written entry is never read
+            os.rename(tmp_path, path)
+        except OSError:
+            # e.g. another kfit cached the same file first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        '''
+            Returns [(last used, size, path)] of every entry, oldest
+            first
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                used = os.path.getmtime(os.path.join(path, meta_name))
+                found.append((used, dir_size(path), path))
+            except OSError:
+                continue  # being written, or not an entry
+        return sorted(found)
+
+    def evict(self):
+        '''
+            Remove the least recently used entries until the cache fits
+            in max_bytes
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,301 @@
+'''
+    Fit every pixel of a hyperspectral map without loading the cube
+
+    Usage:
+        kfit-map cube.npy --x wavenumbers.npy --nvoi 2 -o maps
+        kfit-map scan.raw --shape 500 500 1024 --dtype float32 --nlor 1
+
+    The cube is read through np.memmap and split into chunks of pixels
+    that are fit in parallel. Results go to maps.npy in the output
+    directory, a memory-mapped (n_maps, rows, cols) float32 array whose
+    map names are listed in map.json. Chunks are marked off in done.npy
+    as they finish, so running the same command again picks up where an
+    interrupted run stopped.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+try:
+    from . import models, tools
+    from .batch import add_model_args, model_spec, make_engine
+except ImportError:
+    import models
+    import tools
+    from batch import add_model_args, model_spec, make_engine
+
+cube_shape_msg = 'Expected a 3D (rows, cols, channels) cube, got shape {}'
+resume_msg = (
+    '{} holds results for a different run; use --restart to overwrite them'
+)
+
+
+def open_cube(path, shape=None, dtype='float32', offset=0, dataset=None):
+    '''
+        Returns the cube at path as a read-only array without reading it
+
+        .npy files and uncompressed HDF5 datasets are memory-mapped,
+        anything else is treated as raw binary of the given shape and
+        dtype. Chunked or compressed HDF5 datasets can't be mapped, so
+        they are read a pixel at a time through a tools.H5Dataset, and
+        the caller closes the cube with tools.close_array().
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        cube = np.load(path, mmap_mode='r')
+    elif tools.formats.get(ext) == 'hdf5':
+        cube = tools.open_h5_dataset(path, dataset=dataset, ndim=3)
+    else:
+        if shape is None:
+            raise ValueError(
+                'Raw cubes need --shape ROWS COLS CHANNELS (and --dtype)'
+            )
+        cube = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                         shape=tuple(shape))
+    if len(cube.shape) != 3:
+        tools.close_array(cube)
+        raise ValueError(cube_shape_msg.format(cube.shape))
+    return cube
+
+
+def map_names(model):
+    '''
+        Names of the maps written for model: every parameter, the
+        height and fwhm of every peak, then the reduced chi-square
+    '''
+    names = list(model.param_names)
+    for prefix in model.prefixes:
+        if prefix.find('lin') == -1:
+            names += [prefix + 'height', prefix + 'fwhm']
+    return names + ['redchi']
+
+
+def chunk_bounds(npixels, chunk):
+    return [(start, min(start + chunk, npixels))
+            for start in range(0, npixels, chunk)]
+
+
+def open_outputs(outdir, info, restart=False):
+    '''
+        Create maps.npy and done.npy in outdir, or reopen them if they
+        belong to the same run. Returns (maps, done) memmaps.
+    '''
+    info_path = os.path.join(outdir, 'map.json')
+    maps_path = os.path.join(outdir, 'maps.npy')
+    done_path = os.path.join(outdir, 'done.npy')
+    if not restart and os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f) != info:
+                raise ValueError(resume_msg.format(outdir))
+        return (np.load(maps_path, mmap_mode='r+'),
+                np.load(done_path, mmap_mode='r+'))
+    rows, cols = info['shape']
+    maps = np.lib.format.open_memmap(
+        maps_path, mode='w+', dtype=np.float32,
+        shape=(len(info['maps']), rows, cols)
+    )
+    maps[:] = np.nan
+    maps.flush()
+    done = np.lib.format.open_memmap(
+        done_path, mode='w+', dtype=bool,
+        shape=(len(chunk_bounds(rows*cols, info['chunk'])),)
+    )
+    done.flush()
+    # written last, so a crash while creating the outputs starts over
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    return maps, done
+
+
+def fit_chunk(cube_kws, x, spec, channels_first, start, stop, outdir):
+    '''
+        Fit pixels start:stop (in raster order) and write them into
+        maps.npy. Runs in a worker process, so everything is reopened
+        from paths rather than passed in. Pixels whose fit fails are
+        left as nan.
+
+        Returns (pixels fit, pixels failed, pixels re-seeded, seconds).
+    '''
+    t0 = time.perf_counter()
+    cube = open_cube(**cube_kws)
+    ncols = cube.shape[2] if channels_first else cube.shape[1]
+    maps = np.load(os.path.join(outdir, 'maps.npy'), mmap_mode='r+')
+    engine = make_engine(spec)
+    names = map_names(engine.model)
+    # a pixel needs at least one point per parameter to be fit
+    min_points = len(engine.model.param_names) + 1
+    pixels = []
+
+    def spectra():
+        for flat in range(start, stop):
+            row, col = divmod(flat, ncols)
+            y = np.asarray(
+                cube[:, row, col] if channels_first else cube[row, col],
+                dtype=float
+            )
+            if np.isfinite(y).sum() < min_points:
+                continue  # left as nan
+            pixels.append((row, col))
+            yield x, y
+
+    def write(index, result, reseeded):
+        row, col = pixels[index]
+        values = dict(result.best_values)
+        values.update(models.peak_shapes(values))
+        values['redchi'] = result.redchi
+        maps[:, row, col] = [values[name] for name in names]
+
+    # neighbouring pixels look alike, so warm-start from the last one
+    try:
+        _, fits = engine.fit_series(spectra(), extrapolate=False,
+                                    on_fit=write)
+    finally:
+        tools.close_array(cube)
+    maps.flush()
+    nfailed = int((fits['status'] != 'ok').sum())
+    return (len(fits) - nfailed, nfailed, int(fits['reseeded'].sum()),
+            time.perf_counter() - t0)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='kfit-map',
+        description='Fit the same kfit model at every pixel of a '
+                    'hyperspectral cube.'
+    )
+    parser.add_argument(
+        'cube', help='.npy, HDF5 (needs h5py) or raw binary cube'
+    )
+    add_model_args(parser)
+    data = parser.add_argument_group('cube')
+    data.add_argument(
+        '--x', default=None, metavar='FILE',
+        help='spectral axis as .npy or text, one value per channel'
+    )
+    data.add_argument(
+        '--xrange', type=float, nargs=2, default=None,
+        metavar=('FIRST', 'LAST'),
+        help='spectral axis as evenly spaced values (default: channel '
+             'number)'
+    )
+    data.add_argument(
+        '--channels-first', action='store_true',
+        help='cube is (channels, rows, cols) rather than (rows, cols, '
+             'channels)'
+    )
+    data.add_argument(
+        '--shape', type=int, nargs=3, default=None,
+        metavar=('D0', 'D1', 'D2'), help='shape of a raw cube'
+    )
+    data.add_argument('--dtype', default='float32', help='dtype of a raw cube')
+    data.add_argument(
+        '--offset', type=int, default=0,
+        help='bytes to skip at the start of a raw cube'
+    )
+    data.add_argument('--dataset', default=None,
+                      help='HDF5 dataset (default: the first 3D one)')
+    parser.add_argument(
+        '-o', '--outdir', default='kfit_map',
+        help='where to write maps.npy, map.json and done.npy'
+    )
+    parser.add_argument(
+        '-c', '--chunk', type=int, default=1000,
+        help='pixels fit per task (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='discard results from an earlier run in outdir'
+    )
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    spec = model_spec(parser, args)
+    if args.chunk < 1:
+        parser.error('--chunk must be at least 1')
+    cube_kws = {
+        'path': os.path.abspath(args.cube), 'shape': args.shape,
+        'dtype': args.dtype, 'offset': args.offset,
+        'dataset': args.dataset,
+    }
+    try:
+        cube = open_cube(**cube_kws)
+    except (OSError, ValueError, ImportError) as e:
+        parser.error(str(e))
+    # only the shape is needed here, the workers reopen the cube
+    tools.close_array(cube)
+    if args.channels_first:
+        nchan, rows, cols = cube.shape
+    else:
+        rows, cols, nchan = cube.shape
+    if args.x is not None:
+        x = np.load(args.x) if args.x.endswith('.npy') \
+            else np.loadtxt(args.x)
+        x = np.ravel(x).astype(float)
+        if len(x) != nchan:
+            parser.error('--x has {} values for {} channels'.format(
+                len(x), nchan
+            ))
+    elif args.xrange is not None:
+        x = np.linspace(args.xrange[0], args.xrange[1], nchan)
+    else:
+        x = np.arange(nchan, dtype=float)
+
+    info = {
+        'cube': cube_kws['path'], 'shape': [rows, cols],
+        'channels_first': args.channels_first, 'chunk': args.chunk,
+        'spec': spec, 'x': [float(x[0]), float(x[-1]), len(x)],
+        'maps': map_names(make_engine(spec).model),
+    }
+    os.makedirs(args.outdir, exist_ok=True)
+    try:
+        maps, done = open_outputs(args.outdir, info, restart=args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+    del maps  # workers write through their own mappings
+
+    chunks = chunk_bounds(rows*cols, args.chunk)
+    todo = [i for i in range(len(chunks)) if not done[i]]
+    print('{} of {} chunks of {} pixels left to fit'.format(
+        len(todo), len(chunks), args.chunk
+    ))
+    nfailed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(fit_chunk, cube_kws, x, spec, args.channels_first,
+                        chunks[i][0], chunks[i][1], args.outdir): i
+            for i in todo
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                nfit, nbad, nreseeded, seconds = future.result()
+            except Exception as e:
+                nfailed += 1
+                print('failed chunk {} {}: {}'.format(
+                    i, type(e).__name__, e
+                ))
+                continue
+            done[i] = True
+            done.flush()
+            print('chunk {:>5} {:>7.2f}s {} pixels fit, {} failed, {} '
+                  're-seeded'.format(i, seconds, nfit, nbad, nreseeded))
+    print('Fit {} of {} chunks in {:.2f}s, {} failed.'.format(
+        len(todo) - nfailed, len(todo), time.perf_counter() - start, nfailed
+    ))
+    return 1 if nfailed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,608 @@
+'''
+    GUI-free fitting engine
+
+    Holds the data being fit, the number of each peak type in the
+    model, any user-entered parameter values and the latest result.
+    The GTK front end drives one of these, and batch tools can use it
+    directly without importing Gtk.
+'''
+
+from functools import cached_property
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks, peak_widths, savgol_filter
+from lmfit.model import Parameters
+try:
+    from . import models
+except ImportError:
+    import models
+
+# methods that can use the model's analytic jacobian
+jac_methods = ['least_squares', 'leastsq']
+# a windowed fit only solves sparsely when the windows fill at most this
+# share of the jacobian; wider ones (e.g. broad lorentzians) are faster
+# dense
+max_sparse_fill = 0.25
+# peaks must stand this many noise sigmas above their surroundings
+# to be used as starting guesses
+min_prominence = 3
+# in a series fit, re-seed from the data when the reduced chi-square
+# grows by more than this factor over the previous spectrum
+max_redchi_jump = 3
+
+
+def empty_vals():
+    '''
+        Returns the nested dict used for guesses and user values
+    '''
+    return {
+        'value': {},
+        'min': {},
+        'max': {}
+    }
+
+
+def smooth(y):
+    '''
+        Savitzky-Golay smoothing over ~1% of the points, which keeps
+        peak heights and widths much better than a moving average
+    '''
+    width = min(max(len(y)//100, 5), 51)
+    width += 1 - width % 2  # must be odd
+    if len(y) <= width:
+        return np.asarray(y, dtype=float)
+    return savgol_filter(y, width, 2)
+
+
+def find_peak_guesses(x, y, npeaks):
+    '''
+        Returns (centers, heights, fwhms, baseline) for up to npeaks
+        of the most prominent peaks in the smoothed data, sorted by
+        center. baseline is (slope, intercept) of a line through the
+        points away from the peaks.
+    '''
+    order = np.argsort(x)
+    x = np.asarray(x, dtype=float)[order]
+    y = np.asarray(y, dtype=float)[order]
+    smoothed = smooth(y)
+    noise = 1.4826*np.median(np.abs(y - smoothed))
+    found, props = find_peaks(
+        smoothed, prominence=max(min_prominence*noise, np.finfo(float).tiny)
+    )
+    best = np.argsort(props['prominences'])[::-1][:npeaks]
+    found = found[best]
+    heights = props['prominences'][best]
+    _, _, left, right = peak_widths(
+        smoothed, found, rel_height=0.5,
+        prominence_data=(heights, props['left_bases'][best],
+                         props['right_bases'][best])
+    )
+    index = np.arange(len(x))
+    left, right = np.interp(left, index, x), np.interp(right, index, x)
+
+    # fit the baseline away from the peaks
+    away = np.ones(len(x), dtype=bool)
+    for lo, hi in zip(left, right):
+        fwhm = hi - lo
+        away &= (x < lo - fwhm) | (x > hi + fwhm)
+    if away.sum() < 2:
+        away[:] = True
+    baseline = tuple(np.polyfit(x[away], y[away], 1)) \
+        if len(x) > 1 else (0.0, float(np.mean(y)))
+
+    keep = np.argsort(x[found])
+    return (x[found][keep], heights[keep], (right - left)[keep],
+            baseline)
+
+
+def result_data(result):
+    '''
+        Returns the (x, data) a result was fit to, which need not be
+        the engine's current data (e.g. after a zoomed fit was canceled
+        or failed)
+    '''
+    return (np.asarray(result.userkws['x'], dtype=float),
+            np.asarray(result.data, dtype=float))
+
+
+class ResultProducts():
+    '''
+        Everything drawn, reported or exported from one result, on the
+        x grid it was fit on, each computed the first time it's asked
+        for
+    '''
+
+    def __init__(self, result):
+        self.result = result
+        self.x, self.data = result_data(result)
+
+    @cached_property
+    def components(self):
+        '''
+            {prefix: curve}
+        '''
+        return self.result.eval_components(x=self.x)
+
+    @cached_property
+    def total(self):
+        # lmfit already evaluated the model at the best values
+        return self.result.best_fit
+
+    @cached_property
+    def residual(self):
+        return self.data - self.total
+
+    @cached_property
+    def peak_shapes(self):
+        '''
+            {prefix + 'height' or 'fwhm': value} for every peak
+        '''
+        return models.peak_shapes(self.result.best_values)
+
+    @cached_property
+    def report(self):
+        '''
+            lmfit's fit report plus the height and fwhm of each peak
+        '''
+        lines = [self.result.fit_report()]
+        if self.peak_shapes:
+            lines.append('[[Peak Shapes]]')
+            width = max(len(name) for name in self.peak_shapes)
+            for name, val in self.peak_shapes.items():
+                lines.append('    {} {:.8g}'.format(
+                    (name + ':').ljust(width + 2), val
+                ))
+        return '\n'.join(lines)
+
+
+class FitEngine():
+
+    def __init__(self, x=None, y=None, ngau=0, nlor=0, nvoi=0, nlin=1,
+                 fit_method='least_squares', analytic_jac=True,
+                 window=None):
+        self.x = np.array([]) if x is None else np.asarray(x)
+        self.y = np.array([]) if y is None else np.asarray(y)
+        self.ngau = ngau
+        self.nlor = nlor
+        self.nvoi = nvoi
+        self.nlin = nlin
+        self.fit_method = fit_method
+        self.analytic_jac = analytic_jac
+        # if set, peaks only extend window*sigma from their centers
+        self.window = window
+        self.model = None
+        self.result = None
+        self.cached_products = None
+        self.params = Parameters()
+        self.guesses = empty_vals()
+        self.usr_vals = empty_vals()
+        self.init_model()
+
+    def set_data(self, x, y):
+        '''
+            Replace the data being fit, dropping any previous result
+        '''
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.result = None
+        self.filter_nan()
+
+    def init_model(self):
+        # note: increment() ensures nlin >= 1
+        self.model = models.MultiPeakModel(
+            ngau=self.ngau, nlor=self.nlor, nvoi=self.nvoi, nlin=self.nlin,
+            window=self.window
+        )
+        return self.model
+
+    def increment(self, val, add):
+        step = 1 if add else -1
+        if val == 'gau':
+            self.ngau += step
+        if val == 'lor':
+            self.nlor += step
+        if val == 'voi':
+            self.nvoi += step
+        if val == 'lin':
+            self.nlin += step
+
+        # make sure value doesn't go below zero
+        self.ngau = max(self.ngau, 0)
+        self.nlor = max(self.nlor, 0)
+        self.nvoi = max(self.nvoi, 0)
+        self.nlin = max(self.nlin, 1)
+        self.init_model()
+
+    def reset(self):
+        '''
+            Back to a single line with no guesses, user values or result
+        '''
+        self.ngau = 0
+        self.nlor = 0
+        self.nvoi = 0
+        self.nlin = 1
+        self.init_model()
+        self.params = Parameters()
+        self.result = None
+        self.guesses = empty_vals()
+        self.usr_vals = empty_vals()
+
+    def guess_params(self):
+        '''
+            Seed each peak from a detected peak in the data, in order
+            of center, and the lines from the baseline around them
+
+            Peaks beyond the number detected are spread evenly across
+            the data.
+        '''
+        peak_prefixes = [
+            prefix for prefix in self.model.prefixes
+            if prefix.find('lin') == -1
+        ]
+        npeaks = len(peak_prefixes)
+        if len(self.x) > 2:
+            centers, heights, fwhms, baseline = find_peak_guesses(
+                self.x, self.y, npeaks
+            )
+        else:
+            centers, heights, fwhms = np.array([]), [], []
+            baseline = (0.0, np.mean(self.y) if len(self.y) else 0.0)
+        slope, intc = baseline
+        nextra = npeaks - len(centers)
+        if nextra and len(self.x):
+            xmin, xmax = np.min(self.x), np.max(self.x)
+            spread = np.linspace(xmin, xmax, nextra + 2)[1:-1]
+            order = np.argsort(self.x)
+            above = np.interp(spread, self.x[order], self.y[order]) - \
+                (slope*spread + intc)
+            centers = np.concatenate([centers, spread])
+            heights = np.concatenate(
+                [heights, np.maximum(above, np.std(self.y)/10)]
+            )
+            fwhms = np.concatenate(
+                [fwhms, np.full(nextra, (xmax - xmin)/(2*nextra + 2))]
+            )
+
+        for prefix, center, height, fwhm in zip(
+                peak_prefixes, centers, heights, fwhms):
+            # need to define explicitly to make proper guesses
+            c = prefix + 'center'
+            a = prefix + 'amplitude'
+            s = prefix + 'sigma'
+            f = prefix + 'fraction'
+
+            fwhm = max(fwhm, np.finfo(float).eps)
+            if prefix.find('gau') != -1:
+                sigma = fwhm/models.fwhm_gau(1)
+                amp = height/models.height_gau(1, sigma)
+            elif prefix.find('lor') != -1:
+                sigma = fwhm/models.fwhm_lor(1)
+                amp = height/models.height_lor(1, sigma)
+            else:
+                sigma = fwhm/models.fwhm_voi(1)
+                amp = height/models.height_voi(1, sigma, 0.5)
+                self.guesses['value'][f] = 0.5
+                self.guesses['min'][f] = 0
+                self.guesses['max'][f] = 1
+
+            self.guesses['value'][c] = center
+            self.guesses['value'][a] = amp
+            self.guesses['value'][s] = sigma
+            self.guesses['min'][c] = None
+            self.guesses['min'][a] = 0
+            self.guesses['min'][s] = 0
+            self.guesses['max'][c] = None
+            self.guesses['max'][a] = None
+            self.guesses['max'][s] = None
+
+        # lines sum, so split the baseline between them
+        nlin = len(self.model.prefixes) - npeaks
+        for prefix in self.model.prefixes:
+            if prefix.find('lin') != -1:
+                self.guesses['value'][prefix + 'slope'] = slope/nlin
+                self.guesses['value'][prefix + 'intercept'] = intc/nlin
+                for p in [prefix + 'slope', prefix + 'intercept']:
+                    self.guesses['min'][p] = None
+                    self.guesses['max'][p] = None
+
+    def set_params(self):
+        self.params = Parameters()
+        self.guess_params()
+        vals = {}
+
+        # fill params with any user-entered values
+        # fill in blanks with guesses
+        for param_name in self.model.param_names:
+            for val_type in ['value', 'min', 'max']:
+                if param_name in self.usr_vals[val_type]:
+                    vals[val_type] = self.usr_vals[val_type][param_name]
+                else:
+                    vals[val_type] = self.guesses[val_type][param_name]
+            self.params.add(
+                name=param_name, value=vals['value'], vary=True,
+                min=vals['min'], max=vals['max']
+            )
+        return self.params
+
+    def set_xrange(self, xmin, xmax):
+        '''
+            Crop the data to xmin <= x <= xmax
+        '''
+        range_bool = (self.x >= xmin) & (self.x <= xmax)
+        self.x = self.x[range_bool]
+        self.y = self.y[range_bool]
+
+    def filter_nan(self):
+        # drop inf as well as nan, either would stop the fit
+        finite = np.isfinite(self.x) & np.isfinite(self.y)
+        if not finite.all():
+            self.x = self.x[finite]
+            self.y = self.y[finite]
+
+    def run(self, iter_cb=None):
+        '''
+            Fit the model with the current params and return the
+            ModelResult without storing it, so the fit can run on a
+            worker while the caller decides whether to keep it
+        '''
+        if len(self.x) == 0:
+            raise ValueError('No data to fit!')
+        if self.window is not None and 'Dfun' in self.fit_kws() and \
+                self.fit_method == 'least_squares' and \
+                self.window_fill() <= max_sparse_fill:
+            return self.run_windowed(iter_cb=iter_cb)
+        return self.model.fit(
+            data=self.y, params=self.params, x=self.x,
+            method=self.fit_method, iter_cb=iter_cb,
+            fit_kws=self.fit_kws()
+        )
+
+    def run_windowed(self, iter_cb=None):
+        '''
+            least_squares with a sparse jacobian, so memory and time
+            per iteration scale with the points near each peak rather
+            than the whole grid
+        '''
+        steps = np.diff(self.x)
+        if not (np.all(steps >= 0) or np.all(steps <= 0)):
+            raise ValueError('Windowed fitting needs sorted x values!')
+        return self.model.fit_sparse(
+            self.y, self.params, self.x, iter_cb=iter_cb
+        )
+
+    def window_fill(self):
+        '''
+            Share of the jacobian the peak windows cover at the current
+            params
+        '''
+        return self.model.func.window_fill(
+            self.x, **{name: par.value for name, par in self.params.items()}
+        )
+
+    def fit_kws(self):
+        '''
+            Solver options: the analytic jacobian where the method can
+            use it, otherwise scipy falls back to finite differences
+        '''
+        fit_kws = {}
+        use_jac = self.analytic_jac and self.fit_method in jac_methods and \
+            all(par.expr is None for par in self.params.values())
+        if use_jac:
+            fit_kws['Dfun'] = self.model.jacobian
+        return fit_kws
+
+    def fit(self, iter_cb=None):
+        '''
+            Build params from guesses and user values, fit, and store
+            the result
+        '''
+        self.set_params()
+        self.result = self.run(iter_cb=iter_cb)
+        return self.result
+
+    def warm_start(self, history, extrapolate=True):
+        '''
+            Params from the last result in history, moved on by the
+            drift between the last two if extrapolate is set
+        '''
+        params = history[-1].params.copy()
+        if extrapolate and len(history) > 1:
+            before = history[-2].best_values
+            for name, par in params.items():
+                if par.vary and par.expr is None:
+                    val = 2*par.value - before[name]
+                    # keep inside the bounds, or least_squares refuses
+                    par.value = float(np.clip(val, par.min, par.max))
+        return params
+
+    def fit_series(self, spectra, extrapolate=True,
+                   max_jump=max_redchi_jump, on_fit=None, on_error=None):
+        '''
+            Fit a sequence of (x, y) spectra with the same model, each
+            starting from the previous best values
+
+            The first spectrum is seeded like fit(). If a warm-started
+            fit's reduced chi-square jumps by more than max_jump over
+            the last one, it is refit from fresh guesses and the better
+            of the two kept. on_fit(index, result, reseeded) is called
+            after each spectrum. A spectrum whose fit raises is skipped,
+            with on_error(index, error) called, and the next one is
+            seeded from its own data.
+
+            Returns (params_df, fits_df): a tidy table with one row per
+            spectrum and parameter, and one row per spectrum with its
+            fit statistics, status ('ok' or 'failed') and error.
+        '''
+        history = []
+        param_rows, fit_rows = [], []
+        for index, (x, y) in enumerate(spectra):
+            try:
+                result, reseeded = self.fit_next(x, y, history, extrapolate,
+                                                 max_jump)
+            except Exception as e:
+                # nothing to warm-start the next spectrum from
+                history = []
+                error = '{}: {}'.format(type(e).__name__, e)
+                fit_rows.append({
+                    'index': index, 'status': 'failed', 'redchi': np.nan,
+                    'nfev': np.nan, 'success': False, 'reseeded': False,
+                    'error': error,
+                })
+                if on_error is not None:
+                    on_error(index, error)
+                continue
+            # only the last two are needed for the drift, and there is
+            # no drift to speak of across a re-seed
+            history = [result] if reseeded else history[-1:] + [result]
+            self.result = result
+            for name, par in result.params.items():
+                param_rows.append({
+                    'index': index, 'parameter': name,
+                    'value': par.value, 'stderr': par.stderr,
+                })
+            fit_rows.append({
+                'index': index, 'status': 'ok', 'redchi': result.redchi,
+                'nfev': result.nfev, 'success': result.success,
+                'reseeded': reseeded, 'error': '',
+            })
+            if on_fit is not None:
+                on_fit(index, result, reseeded)
+        params_df = pd.DataFrame(
+            param_rows, columns=['index', 'parameter', 'value', 'stderr']
+        )
+        fits_df = pd.DataFrame(
+            fit_rows,
+            columns=['index', 'status', 'redchi', 'nfev', 'success',
+                     'reseeded', 'error']
+        ).set_index('index')
+        return params_df, fits_df
+
+    def fit_next(self, x, y, history, extrapolate, max_jump):
+        '''
+            Fit one spectrum of a series, warm-started from history if
+            there is one. Returns (result, reseeded).
+        '''
+        self.set_data(x, y)
+        if not history:
+            self.set_params()
+            return self.run(), False
+        self.params = self.warm_start(history, extrapolate)
+        result = self.run()
+        if result.redchi > max_jump*history[-1].redchi:
+            self.set_params()
+            fresh = self.run()
+            if fresh.redchi < result.redchi:
+                return fresh, True
+        return result, False
+
+    def fit_global(self, spectra, shared=models.shared_args, iter_cb=None):
+        '''
+            Fit a sequence of (x, y) spectra with the same model at once,
+            with the `shared` parameters of every peak (see
+            models.GlobalPeakModel) tied across all of them
+
+            Each spectrum is seeded like fit(), and shared parameters
+            start from the median of their seeds. Lines are never
+            shared. Returns (result, params_df): the lmfit
+            MinimizerResult over the global parameters, and a tidy
+            table with one row per spectrum and model parameter like
+            fit_series() gives.
+        '''
+        spectra = list(spectra)
+        if not spectra:
+            raise ValueError('No data to fit!')
+        model = models.GlobalPeakModel(
+            len(spectra), ngau=self.ngau, nlor=self.nlor, nvoi=self.nvoi,
+            nlin=self.nlin, window=self.window, shared=shared
+        )
+        seeds, xs, ys = [], [], []
+        for x, y in spectra:
+            engine = FitEngine(
+                x, y, ngau=self.ngau, nlor=self.nlor, nvoi=self.nvoi,
+                nlin=self.nlin, window=self.window
+            )
+            engine.filter_nan()
+            if len(engine.x) == 0:
+                raise ValueError('No data to fit!')
+            # peaks are cut to windows by searchsorted, so sort x
+            order = np.argsort(engine.x, kind='stable')
+            engine.x, engine.y = engine.x[order], engine.y[order]
+            engine.usr_vals = self.usr_vals
+            seeds.append(engine.set_params())
+            xs.append(engine.x)
+            ys.append(engine.y)
+
+        params = Parameters()
+        for name in model.shared_names:
+            first = seeds[0][name]
+            value = np.median([seed[name].value for seed in seeds])
+            params.add(name, value=float(np.clip(value, first.min, first.max)),
+                       min=first.min, max=first.max)
+        for i, seed in enumerate(seeds):
+            for name, par in seed.items():
+                if not model.is_shared(name):
+                    params.add(model.global_name(name, i), value=par.value,
+                               min=par.min, max=par.max)
+        result = model.fit(xs, ys, params, iter_cb=iter_cb)
+
+        param_rows = []
+        for i in range(len(spectra)):
+            for name in model.func.param_names:
+                par = result.params[model.global_name(name, i)]
+                param_rows.append({
+                    'index': i, 'parameter': name,
+                    'value': par.value, 'stderr': par.stderr,
+                })
+        params_df = pd.DataFrame(
+            param_rows, columns=['index', 'parameter', 'value', 'stderr']
+        )
+        return result, params_df
+
+    def products(self):
+        '''
+            ResultProducts for the latest result, kept until the result
+            changes, so the plot, the report and export share one
+            evaluation of each curve
+        '''
+        if self.result is None:
+            return None
+        cached = self.cached_products
+        if cached is None or cached.result is not self.result:
+            self.cached_products = ResultProducts(self.result)
+        return self.cached_products
+
+    def process_results(self, xname='x'):
+        '''
+            Returns (params_df, curves_df) for the latest result, on
+            the x values it was fit to
+        '''
+        if self.result is None:
+            raise ValueError('No fit results to process!')
+        products = self.products()
+        values = dict(self.result.best_values)
+        values.update(products.peak_shapes)
+        params_df = pd.DataFrame.from_dict(values, orient='index')
+        params_df.index.name = 'parameter'
+        params_df.columns = ['value']
+        curves_dict = {
+            'data': products.data,
+            'total_fit': products.total,
+        }
+        components = products.components
+        for i, comp in enumerate(components):
+            curves_dict[comp[:comp.find('_')]] = components[comp]
+        curves_df = pd.DataFrame.from_dict(curves_dict)
+        curves_df.index = products.x
+        curves_df.index.name = xname
+        return params_df, curves_df
+
+
+def engine_spec(engine):
+    '''
+        What a worker needs to rebuild engine's model
+    '''
+    return {
+        'ngau': engine.ngau, 'nlor': engine.nlor, 'nvoi': engine.nvoi,
+        'nlin': engine.nlin, 'fit_method': engine.fit_method,
+        'analytic_jac': engine.analytic_jac, 'window': engine.window,
+    }
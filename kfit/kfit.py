@@ -1,29 +1,53 @@
 #!/usr/bin/env python3
 
 import os
-from matplotlib import cm
+import copy
+import time
+import multiprocessing
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
-from matplotlib.backends.backend_gtk3cairo import (
-    FigureCanvasGTK3Cairo as FigureCanvas)
+from matplotlib.backends.backend_gtk3agg import (
+    FigureCanvasGTK3Agg as FigureCanvas)
 from custom_backend_gtk3 import (
      NavigationToolbar2GTK3 as NavigationToolbar)
-from matplotlib.widgets import Cursor
 import pandas as pd
 import numpy as np
-from lmfit.model import Parameters
 import models
 import tools
+from engine import FitEngine
+from search import select_peaks, multi_start, multi_start_report
+from uncertainty import (bootstrap, bootstrap_report, conf_intervals,
+                         sample_posterior, mcmc_report)
+from lmfit.printfuncs import ci_report
+from cache import ImportCache
+from worker import Worker
+from table import DataFrameModel
+from plotting import PlotManager, BlitCursor
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 
 curr_dir = os.path.abspath(os.path.dirname(__file__))
 idx_type_error_msg = 'Error: Cannot convert index to integer!'
 idx_range_error_msg = 'Error: Column index is out of range!'
 file_import_error_msg = 'Error: Failed to import file with the given settings!'
+fit_error_msg = 'Error: Fit failed!'
+export_error_msg = 'Error: Export failed!'
+mcmc_error_msg = 'Error: Sampling failed!'
+import_progress_msg = 'Importing {}: {:.1f} of {:.1f} MB, {:,} rows'
 msg_length = 2000
 pad = 3
+col_width_sample = 100  # rows used to size the data table's columns
+progress_interval = 0.1  # min seconds between progress updates from a fit
+auto_max_peaks = 6  # most peaks the auto button tries
+auto_criterion = 'bic'  # what it ranks models by, 'aic' or 'bic'
+multi_starts = 32  # starting points the multi-start button fits from
+bootstrap_samples = 200  # refits behind the bootstrap intervals
+no_fit_error_msg = 'Error: Fit the data first!'
+mcmc_steps = 1000  # default steps the mcmc button adds to a chain
+# the tool buttons' process pools spawn their workers, since forking
+# while GTK's threads run can deadlock the children
+pool_context = multiprocessing.get_context('spawn')
 
 
 class App(Gtk.Application):
@@ -100,14 +124,20 @@ class App(Gtk.Application):
             models.gauss(x, 0.4, 6, 0.3) + 0.2
         self.data = pd.DataFrame([x, y]).T
         self.data.columns = ['x', 'y']
-        self.x = self.data['x'].values
-        self.y = self.data['y'].values
+        # shown until a file is imported; data_file is None until then
+        self.demo_data = self.data
+        self.data_file = None
+        self.columns = list(self.data.columns)
+        self.engine = FitEngine(self.data['x'].values, self.data['y'].values)
         self.xmin = self.data['x'].min()
         self.xmax = self.data['x'].max()
         plt.style.use(os.path.join(curr_dir, 'kfit.mplstyle'))
         self.figure = Figure(figsize=(10, 4), dpi=60)
         self.canvas = FigureCanvas(self.figure)
         self.canvas.set_size_request(900, 400)
+        self.plotter = PlotManager(self.figure)
+        # the axis lives as long as the app, so the cursor can keep it
+        self.axis = self.plotter.axis
         self.toolbar = NavigationToolbar(self.canvas, self.main_window)
         self.graph_box.pack_start(self.toolbar, True, True, 0)
         self.graph_box.pack_start(self.canvas, True, True, 0)
@@ -139,29 +169,50 @@ class App(Gtk.Application):
         self.toolbar.insert(self.cmode_toolitem, -1)
 
         # for fit...
-        self.fit_method = 'least_squares'
-        self.model = None
-        self.result = None
+        # the engine holds x/y, the model, user values and the result
         self.yfit = None
-        self.ngau = 0
-        self.nlor = 0
-        self.nvoi = 0
-        self.nlin = 1
         self.curves_df = None
         self.params_df = None
-        self.params = Parameters()
-        self.guesses = {
-            'value': {},
-            'min': {},
-            'max': {}
-        }
-        self.usr_vals = {
-            'value': {},
-            'min': {},
-            'max': {}
-        }
         self.usr_entry_widgets = {}
         self.cid = None
+        self.mpl_cursor = None
+        self.fit_worker = Worker(dispatch=GLib.idle_add)
+        # imports get their own worker, so a fit and an import can't
+        # cancel each other
+        self.import_worker = Worker(dispatch=GLib.idle_add)
+        self.import_rows = 0
+        # tool buttons, in a row right of the fit button
+        self.top_bar = self.builder.get_object('top_bar')
+        self.auto_button = self.add_tool_button(
+            'Auto',
+            'Fit models with different numbers of peaks and keep the best',
+            self.auto_peaks, self.fit_button
+        )
+        self.multi_button = self.add_tool_button(
+            'Multi-start',
+            'Fit from many starting points and keep the best minimum',
+            self.multi_start_fit, self.auto_button
+        )
+        self.boot_button = self.add_tool_button(
+            'Bootstrap',
+            'Refit resampled data to get intervals for every parameter',
+            self.bootstrap_errors, self.multi_button
+        )
+        self.ci_button = self.add_tool_button(
+            'Profile',
+            'Profile every parameter for 1, 2 and 3 sigma intervals',
+            self.profile_intervals, self.boot_button
+        )
+        self.mcmc_button = self.add_tool_button(
+            'MCMC',
+            'Sample the posterior with emcee, starting from the best fit',
+            self.sample_chain, self.ci_button
+        )
+        self.auto_fits = 0
+        self.multi_fits = 0
+        self.report_note = None
+        # {name: [(probability, value)]} of the parameters profiled so far
+        self.ci_out = {}
 
         # for data view...
         self.fname_buffer = Gtk.TextBuffer()
@@ -178,6 +229,7 @@ class App(Gtk.Application):
         self.skiprows = None
         self.dtype = None
         self.encoding = None
+        self.import_cache = ImportCache()
 
         # show initial plot
         self.plot()
@@ -188,7 +240,21 @@ class App(Gtk.Application):
         self.statusbar.set_margin_bottom(0)
         self.statusbar.set_margin_start(0)
         self.statusbar.set_margin_end(0)
-        self.statusbar_viewport.add(self.statusbar)
+        # progress bar and cancel button, only shown while a fit or an
+        # import runs
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_valign(Gtk.Align.CENTER)
+        self.progress_bar.set_no_show_all(True)
+        self.cancel_button = Gtk.Button.new_with_label('Cancel')
+        self.cancel_button.set_relief(Gtk.ReliefStyle.NONE)
+        self.cancel_button.connect('clicked', self.cancel_jobs)
+        self.cancel_button.set_no_show_all(True)
+        self.statusbar_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        self.statusbar_box.pack_start(self.statusbar, True, True, 0)
+        self.statusbar_box.pack_start(self.progress_bar, False, False, pad)
+        self.statusbar_box.pack_start(self.cancel_button, False, False, pad)
+        self.statusbar_viewport.add(self.statusbar_box)
 
         # connect signals
         events = {
@@ -217,6 +283,7 @@ class App(Gtk.Application):
         self.add_accelerator(self.settings_button, '<Control>p')
         self.add_accelerator(self.import_button, '<Control>o')
         self.add_accelerator(self.export_button, '<Control>s')
+        self.add_accelerator(self.cancel_button, 'Escape')
         self.add_accelerator(self.add_gau, 'g')
         self.add_accelerator(self.rem_gau, '<Shift>g')
         self.add_accelerator(self.add_lor, 'l')
@@ -234,66 +301,424 @@ class App(Gtk.Application):
         self.main_window.show_all()
 
     def plot(self):
-        self.figure.clear()
-        self.axis = self.figure.add_subplot(111)
         self.set_xlims()
-        if len(self.x) >= 1000:
-            self.axis.plot(
-                self.x, self.y, c='#af87ff',
-                linewidth=12, label='data'
+        x, y = self.engine.x, self.engine.y
+        self.plotter.set_data(
+            x, y, xlabel=self.data.columns[0],
+            ylabel=self.data.columns[1]
+        )
+        products = self.engine.products()
+        if products is not None:
+            # drawn on the x it was fit on, which a canceled zoomed fit
+            # may have cropped the data away from
+            self.yfit = products.total
+            self.plotter.set_fit(
+                products.x, self.yfit, products.components
             )
         else:
-            self.axis.scatter(
-                self.x, self.y, s=200, c='#af87ff',
-                edgecolors='black', linewidth=1,
-                label='data'
-            )
-        if self.result is not None:
-            self.yfit = self.result.best_fit
-            self.axis.plot(self.x, self.yfit, c='r', linewidth=2.5)
-            cmap = cm.get_cmap('gnuplot')
-            components = self.result.eval_components()
-            for i, comp in enumerate(components):
-                self.axis.plot(
-                    self.x, components[comp],
-                    linewidth=2.5, linestyle='--',
-                    c=cmap(i/len(components)),
-                    label=comp[:comp.find('_')]
-                )
-        self.axis.set_xlabel(self.data.columns[self.xcol_idx])
-        self.axis.set_ylabel(self.data.columns[self.ycol_idx])
-        self.axis.legend(loc='best')
-        self.axis.set_xlim([self.xmin, self.xmax])
-        self.canvas.draw()
+            self.plotter.set_fit(x)
+        self.plotter.set_xlim(self.xmin, self.xmax)
+        self.plotter.draw()
 
     def fit(self, source=None, event=None):
         self.cmode_radio_off.set_active(True)
         self.toggle_copy_mode(self.cmode_radio_off)
         self.set_xrange_to_zoom()
-        self.filter_nan()
+        self.engine.filter_nan()
         self.set_params()
-        self.result = self.model.fit(
-            data=self.y, params=self.params, x=self.x,
-            method=self.fit_method
+        # hand the worker its own copy of the engine, so nothing the GUI
+        # does while the fit runs can change what is being fitted
+        engine = copy.copy(self.engine)
+
+        def job(progress, cancel):
+            last_update = [0.0]
+
+            def iter_cb(params, iter, resid, *args, **kws):
+                now = time.monotonic()
+                if now - last_update[0] > progress_interval:
+                    last_update[0] = now
+                    progress(iter)
+                # returning True makes lmfit abort the fit
+                return cancel.is_set()
+
+            return engine.run(iter_cb=iter_cb)
+
+        self.start_fit_job(
+            job, self.on_fit_done, self.on_fit_error, self.on_fit_progress,
+            'Fitting...'
         )
-        self.output_buffer.set_text(self.result.fit_report())
+
+    def on_fit_progress(self, iteration):
+        self.progress_bar.pulse()
+        self.progress_bar.set_text('Iteration {}'.format(iteration))
+
+    def on_fit_done(self, result):
+        self.hide_fit_progress()
+        self.engine.result = result
+        report = self.engine.products().report
+        if self.report_note is not None:
+            # e.g. the ranking that picked this model, once
+            report += '\n' + self.report_note
+            self.report_note = None
+        self.output_buffer.set_text(report)
         self.plot()
         # overwrite widgets to clear input (not ideal method..)
         self.init_param_widgets()
+        self.statusbar.push(
+            self.statusbar.get_context_id('fit_finished'),
+            'Fit finished after {} function evaluations.'.format(result.nfev)
+        )
+
+    def on_fit_error(self, error):
+        self.hide_fit_progress()
+        self.statusbar.push(
+            self.statusbar.get_context_id('fit_error'),
+            '{} ({})'.format(fit_error_msg, error)
+        )
+
+    def auto_peaks(self, source=None, event=None):
+        '''
+        Fit models with different numbers of each kind of peak on a
+        process pool, then load the best one and fit it
+        '''
+        self.cmode_radio_off.set_active(True)
+        self.toggle_copy_mode(self.cmode_radio_off)
+        self.set_xrange_to_zoom()
+        self.engine.filter_nan()
+        x, y = self.engine.x, self.engine.y
+        fit_kws = {
+            'nlin': self.engine.nlin, 'fit_method': self.engine.fit_method,
+            'window': self.engine.window,
+        }
+
+        def job(progress, cancel):
+            return select_peaks(
+                x, y, max_peaks=auto_max_peaks, criterion=auto_criterion,
+                on_fit=progress, cancel=cancel, mp_context=pool_context,
+                **fit_kws
+            )
+
+        self.auto_fits = 0
+        self.start_fit_job(
+            job, self.on_auto_done, self.on_fit_error, self.on_auto_progress,
+            'Choosing peaks...'
+        )
+
+    def on_auto_progress(self, record):
+        self.auto_fits += 1
+        self.progress_bar.pulse()
+        self.progress_bar.set_text('{} models fit'.format(self.auto_fits))
+
+    def on_auto_done(self, selection):
+        self.hide_fit_progress()
+        if selection is None:
+            return
+        counts, fits_df = selection
+        self.engine.ngau = counts['ngau']
+        self.engine.nlor = counts['nlor']
+        self.engine.nvoi = counts['nvoi']
+        self.init_param_widgets()
+        columns = ['model', auto_criterion, 'delta_' + auto_criterion,
+                   'redchi', 'nfev']
+        self.report_note = '[[Model Selection]]\n{}\n'.format(
+            fits_df[columns].to_string(index=False)
+        )
+        self.statusbar.push(
+            self.statusbar.get_context_id('auto_finished'),
+            'Best of {} models by {}: {}'.format(
+                len(fits_df), auto_criterion.upper(), fits_df['model'][0]
+            )
+        )
+        self.fit()
+
+    def multi_start_fit(self, source=None, event=None):
+        '''
+        Fit the current model from many starting points on a process
+        pool, then load the best minimum found
+        '''
+        self.cmode_radio_off.set_active(True)
+        self.toggle_copy_mode(self.cmode_radio_off)
+        self.set_xrange_to_zoom()
+        self.engine.filter_nan()
+        self.set_params()
+        engine = copy.copy(self.engine)
+        params = self.engine.params.copy()
+
+        def job(progress, cancel):
+            found = multi_start(
+                engine, nstarts=multi_starts, params=params,
+                on_fit=progress, cancel=cancel, mp_context=pool_context
+            )
+            if found is None:
+                return None
+            # once more from the best minimum, for the full result
+            engine.params, minima_df = found
+            return engine.run(), minima_df
+
+        self.multi_fits = 0
+        self.start_fit_job(
+            job, self.on_multi_done, self.on_fit_error, self.on_multi_progress,
+            'Fitting from {} starts...'.format(multi_starts), fraction=0
+        )
+
+    def on_multi_progress(self, record):
+        self.multi_fits += 1
+        self.progress_bar.set_fraction(self.multi_fits/multi_starts)
+        self.progress_bar.set_text('{} of {} starts fit'.format(
+            self.multi_fits, multi_starts
+        ))
+
+    def on_multi_done(self, found):
+        self.hide_fit_progress()
+        if found is None:
+            return
+        result, minima_df = found
+        self.report_note = multi_start_report(minima_df, multi_starts)
+        self.on_fit_done(result)
+        self.statusbar.push(
+            self.statusbar.get_context_id('multi_finished'),
+            '{} distinct minima from {} starts, best chi-square '
+            '{:.6g}.'.format(len(minima_df), multi_starts, result.chisqr)
+        )
+
+    def bootstrap_errors(self, source=None, event=None):
+        '''
+        Refit the latest result to resampled data on a process pool and
+        add percentile intervals to the output
+        '''
+        if not self.have_result('bootstrap_error'):
+            return
+        engine = copy.copy(self.engine)
+
+        def job(progress, cancel):
+            return bootstrap(
+                engine, nsamples=bootstrap_samples, on_progress=progress,
+                cancel=cancel, mp_context=pool_context
+            )
+
+        self.start_fit_job(
+            job, self.on_bootstrap_done, self.on_fit_error,
+            self.on_bootstrap_progress, 'Bootstrapping...', fraction=0
+        )
+
+    def on_bootstrap_progress(self, done, total):
+        self.progress_bar.set_fraction(done/total)
+        self.progress_bar.set_text('{} of {} refits'.format(done, total))
+
+    def on_bootstrap_done(self, intervals):
+        self.hide_fit_progress()
+        if intervals is None or self.engine.result is None:
+            return
+        intervals_df, samples_df = intervals
+        self.output_buffer.set_text('{}\n{}'.format(
+            self.engine.products().report,
+            bootstrap_report(intervals_df, len(samples_df), bootstrap_samples)
+        ))
+        self.statusbar.push(
+            self.statusbar.get_context_id('bootstrap_finished'),
+            'Bootstrap finished, {} of {} refits succeeded.'.format(
+                len(samples_df), bootstrap_samples
+            )
+        )
+
+    def profile_intervals(self, source=None, event=None):
+        '''
+        Profile confidence intervals for every parameter of the latest
+        result on a process pool, showing each as it finishes
+        '''
+        if not self.have_result('ci_error'):
+            return
+        engine = copy.copy(self.engine)
+
+        def job(progress, cancel):
+            return conf_intervals(
+                engine, on_interval=progress, cancel=cancel,
+                mp_context=pool_context
+            )
+
+        self.ci_out = {}
+        self.start_fit_job(
+            job, self.on_ci_done, self.on_fit_error, self.on_ci_progress,
+            'Profiling...', fraction=0
+        )
+
+    def on_ci_progress(self, name, rows):
+        self.ci_out[name] = rows
+        nvarys = self.engine.result.nvarys
+        self.progress_bar.set_fraction(len(self.ci_out)/nvarys)
+        self.progress_bar.set_text('{} of {} parameters'.format(
+            len(self.ci_out), nvarys
+        ))
+        self.show_intervals(self.ci_out)
+
+    def on_ci_done(self, ci_out):
+        self.hide_fit_progress()
+        if ci_out is None or self.engine.result is None:
+            return
+        self.show_intervals(ci_out)
+        self.statusbar.push(
+            self.statusbar.get_context_id('ci_finished'),
+            'Confidence intervals found for {} parameters.'.format(
+                len(ci_out)
+            )
+        )
+
+    def show_intervals(self, ci_out):
+        self.output_buffer.set_text('{}\n[[Confidence Intervals]]\n{}'.format(
+            self.engine.products().report, ci_report(ci_out)
+        ))
+
+    def sample_chain(self, source=None, event=None):
+        '''
+        Run emcee from the latest result on a process pool, saving the
+        chain to a .npy file; a chain already there for the same model
+        is continued
+        '''
+        if not self.have_result('mcmc_error'):
+            return
+        chain_dialog = Gtk.FileChooserDialog(
+            title='Save chain to...', parent=self.main_window,
+            action=Gtk.FileChooserAction.SAVE,
+        )
+        chain_dialog.add_buttons(
+            Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+            Gtk.STOCK_OK, Gtk.ResponseType.OK
+        )
+        chain_filter = Gtk.FileFilter()
+        chain_filter.set_name('NumPy .npy files')
+        chain_filter.add_pattern('*.npy')
+        chain_dialog.add_filter(chain_filter)
+        chain_dialog.set_current_name('chain.npy')
+        options_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        steps_spin = Gtk.SpinButton.new_with_range(1, 10**7, 100)
+        steps_spin.set_value(mcmc_steps)
+        options_box.pack_start(
+            Gtk.Label(label='Steps to add:'), False, False, pad
+        )
+        options_box.pack_start(steps_spin, False, False, pad)
+        options_box.pack_start(
+            Gtk.Label(label='(an existing chain for this model is continued)'),
+            False, False, pad
+        )
+        options_box.show_all()
+        chain_dialog.set_extra_widget(options_box)
+        response = chain_dialog.run()
+        chain_path = chain_dialog.get_filename()
+        steps = steps_spin.get_value_as_int()
+        chain_dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        if not chain_path.endswith('.npy'):
+            chain_path += '.npy'
+        engine = copy.copy(self.engine)
+
+        def job(progress, cancel):
+            return sample_posterior(
+                engine, chain_path, steps=steps, on_block=progress,
+                cancel=cancel, mp_context=pool_context
+            )
+
+        self.start_fit_job(
+            job, self.on_mcmc_done, self.on_mcmc_error, self.on_mcmc_progress,
+            'Sampling...'
+        )
+
+    def on_mcmc_progress(self, stats_df, summary):
+        self.progress_bar.pulse()
+        self.progress_bar.set_text('{} steps, acceptance {:.2f}'.format(
+            summary['steps'], summary['acceptance']
+        ))
+        self.show_mcmc(stats_df, summary)
+
+    def on_mcmc_done(self, stats):
+        self.hide_fit_progress()
+        if stats is None or self.engine.result is None:
+            return
+        self.show_mcmc(*stats)
+        self.statusbar.push(
+            self.statusbar.get_context_id('mcmc_finished'),
+            'Sampling finished, the chain has {} steps.'.format(
+                stats[1]['steps']
+            )
+        )
+
+    def on_mcmc_error(self, error):
+        self.hide_fit_progress()
+        self.statusbar.push(
+            self.statusbar.get_context_id('mcmc_error'),
+            '{} ({})'.format(mcmc_error_msg, error)
+        )
+
+    def show_mcmc(self, stats_df, summary):
+        if self.engine.result is None:
+            return
+        self.output_buffer.set_text('{}\n{}'.format(
+            self.engine.products().report, mcmc_report(stats_df, summary)
+        ))
+
+    def cancel_fit(self, source=None, event=None):
+        if self.fit_worker.running:
+            self.fit_worker.cancel()
+            self.hide_fit_progress()
+            self.statusbar.push(
+                self.statusbar.get_context_id('fit_canceled'),
+                'Fit canceled.'
+            )
+
+    def cancel_import(self, source=None, event=None):
+        if self.import_worker.running:
+            self.import_worker.cancel()
+            self.hide_fit_progress()
+            # put back the table of the data still loaded
+            self.display_data()
+            self.statusbar.push(
+                self.statusbar.get_context_id('import_canceled'),
+                'Import canceled.'
+            )
+
+    def cancel_jobs(self, source=None, event=None):
+        self.cancel_fit()
+        self.cancel_import()
+
+    def hide_fit_progress(self):
+        if self.fit_worker.running or self.import_worker.running:
+            return  # the other job still needs them
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
+    def start_fit_job(self, job, on_done, on_error, on_progress, text,
+                      fraction=None):
+        '''
+        Runs job on the fit worker and shows the progress bar and cancel
+        button; a bar with no fraction is pulsed by on_progress
+        '''
+        # starting a new job supersedes a fit that is still running
+        self.fit_worker.start(job, on_done, on_error, on_progress)
+        if fraction is not None:
+            self.progress_bar.set_fraction(fraction)
+        self.progress_bar.set_text(text)
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+    def have_result(self, context):
+        '''
+        Returns whether there is a fit result to work from, saying so in
+        the statusbar if not
+        '''
+        if self.engine.result is not None:
+            return True
+        self.statusbar.push(
+            self.statusbar.get_context_id(context), no_fit_error_msg
+        )
+        return False
 
     def init_model(self):
-        # note: increment() ensures nlin >= 1
-        self.model = models.line_mod(self.nlin)
-        if self.ngau != 0:
-            self.model += models.gauss_mod(self.ngau)
-        if self.nlor != 0:
-            self.model += models.lor_mod(self.nlor)
-        if self.nvoi != 0:
-            self.model += models.voigt_mod(self.nvoi)
+        self.engine.init_model()
         self.statusbar.push(
                 self.statusbar.get_context_id('info'),
                 "Model updated: " +
-                str([self.ngau, self.nlor, self.nvoi, self.nlin])
+                str([self.engine.ngau, self.engine.nlor,
+                     self.engine.nvoi, self.engine.nlin])
         )
 
     def init_param_widgets(self):
@@ -312,7 +737,7 @@ class App(Gtk.Application):
         self.vbox_lor = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.vbox_voi = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.vbox_lin = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
-        for param_name in self.model.param_names:
+        for param_name in self.engine.model.param_names:
             # set param label text
             labels[param_name] = Gtk.Label()
             labels[param_name].set_text(param_name)
@@ -320,10 +745,12 @@ class App(Gtk.Application):
             # make user entry widgets
             for key in self.usr_entry_widgets:
                 self.usr_entry_widgets[key][param_name] = Gtk.Entry()
-                if param_name in self.usr_vals[key]:
+                if param_name in self.engine.usr_vals[key]:
                     self.usr_entry_widgets[key][param_name]\
                         .set_placeholder_text(
-                            str(round(self.usr_vals[key][param_name], rnd))
+                            str(round(
+                                self.engine.usr_vals[key][param_name], rnd
+                            ))
                         )
                 else:
                     self.usr_entry_widgets[key][param_name]\
@@ -371,7 +798,7 @@ class App(Gtk.Application):
                          self.param_viewport_voi, self.param_viewport_lin]:
             viewport.show_all()
 
-        if self.result is not None:
+        if self.engine.result is not None:
             self.set_params()
             self.update_param_widgets()
 
@@ -380,7 +807,7 @@ class App(Gtk.Application):
         for val_type, param_dict in entry_widget_dict.items():
             for param, param_widget in param_dict.items():
                 try:
-                    self.usr_vals[val_type][param] = \
+                    self.engine.usr_vals[val_type][param] = \
                         float(param_widget.get_text())
                 except Exception:
                     pass
@@ -388,123 +815,42 @@ class App(Gtk.Application):
     def update_param_widgets(self):
         rnd = 3
         # the 'value' placeholder text is the result for that param
-        # taken from self.result
-        # the 'min' and 'max' text is from either the self.guesses
-        # or from self.usr_vals
-        for param in self.params:
-            if param in self.result.best_values:
+        # taken from self.engine.result
+        # the 'min' and 'max' text is from either the self.engine.guesses
+        # or from self.engine.usr_vals
+        params = self.engine.params
+        best_values = self.engine.result.best_values
+        for param in params:
+            if param in best_values:
                 self.usr_entry_widgets['value'][param].set_placeholder_text(
-                    str(round(self.result.best_values[param], rnd))
+                    str(round(best_values[param], rnd))
                 )
                 self.usr_entry_widgets['min'][param].set_placeholder_text(
-                    str(round(self.params[param].min, rnd))
+                    str(round(params[param].min, rnd))
                 )
                 self.usr_entry_widgets['max'][param].set_placeholder_text(
-                    str(round(self.params[param].max, rnd))
+                    str(round(params[param].max, rnd))
                 )
 
-    def guess_params(self, source=None, event=None):
-        for comp in self.model.components:
-            if comp.prefix.find('gau') != -1 or \
-                    comp.prefix.find('lor') != -1 or \
-                    comp.prefix.find('voi') != -1:
-
-                # need to define explicitly to make proper guesses
-                c = comp.prefix + 'center'
-                a = comp.prefix + 'amplitude'
-                s = comp.prefix + 'sigma'
-                f = comp.prefix + 'fraction'
-
-                self.guesses['value'][c] = \
-                    self.data.iloc[:, self.xcol_idx].mean()
-                self.guesses['value'][a] = \
-                    self.data.iloc[:, self.ycol_idx].mean()
-                self.guesses['value'][s] = \
-                    self.data.iloc[:, self.xcol_idx].std()
-                self.guesses['min'][c] = None
-                self.guesses['min'][a] = 0
-                self.guesses['min'][s] = 0
-                self.guesses['max'][c] = None
-                self.guesses['max'][a] = None
-                self.guesses['max'][s] = None
-
-                if comp.prefix.find('voi') != -1:
-                    self.guesses['value'][f] = 0.5
-                    self.guesses['min'][f] = 0
-                    self.guesses['max'][f] = 1
-            else:
-                slope = comp.prefix + 'slope'
-                intc = comp.prefix + 'intercept'
-                for p in [slope, intc]:
-                    self.guesses['value'][p] = \
-                        self.data.iloc[:, self.ycol_idx].mean()
-                    self.guesses['min'][p] = None
-                    self.guesses['max'][p] = None
-
     def set_params(self, source=None, event=None):
-        self.params = Parameters()
-        self.guess_params()
-        self.update_usr_vals(None, self.usr_entry_widgets)
-        vals = {}
-
         # fill params with any user-entered values
         # fill in blanks with guesses
-        for param_name in self.model.param_names:
-            for val_type in ['value', 'min', 'max']:
-                if param_name in self.usr_vals[val_type]:
-                    vals[val_type] = self.usr_vals[val_type][param_name]
-                else:
-                    vals[val_type] = self.guesses[val_type][param_name]
-            self.params.add(
-                name=param_name, value=vals['value'], vary=True,
-                min=vals['min'], max=vals['max']
-            )
+        self.update_usr_vals(None, self.usr_entry_widgets)
+        self.engine.set_params()
 
     def set_xlims(self, source=None, event=None):
-        self.xmin = np.min(self.x) - 0.02*(np.max(self.x) - np.min(self.x))
-        self.xmax = np.max(self.x) + 0.02*(np.max(self.x) - np.min(self.x))
+        x = self.engine.x
+        self.xmin = np.min(x) - 0.02*(np.max(x) - np.min(x))
+        self.xmax = np.max(x) + 0.02*(np.max(x) - np.min(x))
 
     def set_xrange_to_zoom(self):
         self.xmin, self.xmax = self.axis.get_xlim()
-        range_bool = (self.x >= self.xmin) & (self.x <= self.xmax)
-        self.x = self.x[range_bool]
-        self.y = self.y[range_bool]
-
-    def filter_nan(self):
-        if True in np.isnan(self.x) or True in np.isnan(self.y):
-            nanbool = (~np.isnan(self.x) & ~np.isnan(self.y))
-            self.x = self.x[nanbool]
-            self.y = self.y[nanbool]
+        self.engine.set_xrange(self.xmin, self.xmax)
 
     def increment(self, val, add):
-        if add:
-            if val == 'gau':
-                self.ngau += 1
-            if val == 'lor':
-                self.nlor += 1
-            if val == 'voi':
-                self.nvoi += 1
-            if val == 'lin':
-                self.nlin += 1
-        if not add:
-            if val == 'gau':
-                self.ngau -= 1
-            if val == 'lor':
-                self.nlor -= 1
-            if val == 'voi':
-                self.nvoi -= 1
-            if val == 'lin':
-                self.nlin -= 1
-
-        # make sure value doesn't go below zero
-        if self.ngau < 0:
-            self.ngau = 0
-        if self.nlor < 0:
-            self.nlor = 0
-        if self.nvoi < 0:
-            self.nvoi = 0
-        if self.nlin < 1:
-            self.nlin = 1
+        # a running fit belongs to the old model
+        self.cancel_fit()
+        self.engine.increment(val, add)
 
     def clear_param_viewports(self):
         # clear any existing widgets from viewports
@@ -514,26 +860,12 @@ class App(Gtk.Application):
                 viewport.remove(viewport.get_child())
 
     def hard_reset(self, source=None, event=None):
+        self.cancel_fit()
         self.clear_param_viewports()
-        self.ngau = 0
-        self.nlor = 0
-        self.nvoi = 0
-        self.nlin = 1
+        self.engine.reset()
         self.init_model()
-        self.params = Parameters()
-        self.result = None
         self.params_df = None
         self.curves_df = None
-        self.guesses = {
-            'value': {},
-            'min': {},
-            'max': {}
-        }
-        self.usr_vals = {
-            'value': {},
-            'min': {},
-            'max': {}
-        }
         self.output_buffer.set_text('')
         self.init_param_widgets()
         self.get_column_index()
@@ -576,11 +908,6 @@ class App(Gtk.Application):
     def get_data(self, source=None, event=None):
         self.cmode_radio_off.set_active(True)
         self.toggle_copy_mode(self.cmode_radio_off)
-        # reset column indices
-        self.xcol_idx = 0
-        self.column_entry_x.set_text(str(self.xcol_idx))
-        self.ycol_idx = 1
-        self.column_entry_y.set_text(str(self.ycol_idx))
         # open file dialog
         self.dialog = Gtk.FileChooserDialog(
             title='Import data file...', parent=self.main_window,
@@ -595,6 +922,12 @@ class App(Gtk.Application):
         filter_csv.add_mime_type('text/csv')
         self.dialog.add_filter(filter_csv)
 
+        filter_data = Gtk.FileFilter()
+        filter_data.set_name('Data files (csv, npy, parquet, hdf5, ...)')
+        for ext in tools.formats:
+            filter_data.add_pattern('*' + ext)
+        self.dialog.add_filter(filter_data)
+
         filter_any = Gtk.FileFilter()
         filter_any.set_name('All files')
         filter_any.add_pattern("*")
@@ -603,15 +936,13 @@ class App(Gtk.Application):
 
         response = self.dialog.run()
         if response == Gtk.ResponseType.OK:
-            self.file_name = self.dialog.get_filename()
+            file_name = self.dialog.get_filename()
             try:
-                df = tools.to_df(
-                    self.file_name, sep=self.sep, header=self.header,
-                    index_col=self.index_col, skiprows=self.skiprows,
-                    dtype=self.dtype, encoding=self.encoding
-                )
-                df.iloc[:, self.xcol_idx]
-                df.iloc[:, self.ycol_idx]
+                # only the header is read here, and only the x and y
+                # columns are parsed
+                columns = tools.peek_columns(file_name, **self.import_kws())
+                # a new file starts from its first two columns
+                columns[1]
             except Exception:
                 self.statusbar.push(
                     self.statusbar.get_context_id('import_error'),
@@ -620,7 +951,6 @@ class App(Gtk.Application):
                 self.dialog.destroy()
                 return
         else:
-            self.file_name = None
             self.statusbar.push(
                 self.statusbar.get_context_id('import_canceled'),
                 'Import canceled.'
@@ -629,48 +959,157 @@ class App(Gtk.Application):
             return
 
         self.dialog.destroy()
+        self.start_import(file_name, columns, [0, 1])
+
+    def import_kws(self):
+        return {
+            'sep': self.sep, 'header': self.header,
+            'skiprows': self.skiprows, 'dtype': self.dtype,
+            'encoding': self.encoding,
+        }
+
+    def start_import(self, file_name, columns, usecols):
+        '''
+        Parse the usecols columns of file_name on the import worker,
+        filling the table as pieces of the file arrive. Nothing else
+        changes until the whole file is in.
+        '''
+        import_kws = self.import_kws()
+        import_kws['usecols'] = usecols
+        cache = self.import_cache
+
+        def job(progress, cancel):
+            # progress(frame, bytes read, file size) for every piece
+            return cache.load(
+                file_name, on_chunk=progress, cancel=cancel, **import_kws
+            )
+
+        self.import_rows = 0
+        # starting a new import supersedes one that is still running
+        self.import_worker.start(
+            job,
+            lambda df: self.on_import_done(file_name, columns, usecols, df),
+            self.on_import_error,
+            lambda *args: self.on_import_progress(file_name, columns, *args)
+        )
+        self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text('Importing...')
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+    def on_import_progress(self, file_name, columns, chunk, nbytes, size):
+        # the last pieces are shown with the rest by on_import_done
+        if nbytes < size:
+            if self.import_rows == 0:
+                self.display_data(chunk, columns, file_name)
+            else:
+                self.table_model.append(chunk)
+                # setting the model walks every row, so only do it once
+                # the table has doubled since it was last shown
+                if self.table_model.nrows >= 2*self.table_shown:
+                    self.refresh_table()
+        self.import_rows += len(chunk)
+        self.progress_bar.set_fraction(nbytes/size if size else 1)
+        self.progress_bar.set_text('{:,} rows'.format(self.import_rows))
+        self.statusbar.push(
+            self.statusbar.get_context_id('import_progress'),
+            import_progress_msg.format(
+                os.path.basename(file_name), nbytes/2**20, size/2**20,
+                self.import_rows
+            )
+        )
 
+    def on_import_done(self, file_name, columns, usecols, df):
+        self.hide_fit_progress()
+        if df is None:
+            return
+        self.cancel_fit()
+        self.file_name = self.data_file = file_name
+        self.columns = columns
+        self.xcol_idx, self.ycol_idx = usecols
+        self.column_entry_x.set_text(str(self.xcol_idx))
+        self.column_entry_y.set_text(str(self.ycol_idx))
         self.data = df
+        # the table drops the pieces it was filled with for the whole
+        # frame, so only one copy of the data is kept
         self.display_data()
-        self.result = None
         # reset x, y, and xlim
-        self.x = self.data.iloc[:, self.xcol_idx].values
-        self.y = self.data.iloc[:, self.ycol_idx].values
-        self.filter_nan()
+        self.engine.set_data(
+            self.data.iloc[:, 0].values, self.data.iloc[:, 1].values
+        )
         self.set_xlims()
         self.plot()
         self.statusbar.push(
             self.statusbar.get_context_id('import_finished'),
-            'Imported {}'.format(self.file_name)
+            'Imported {} ({:,} rows)'.format(file_name, len(df))
+        )
+
+    def on_import_error(self, error):
+        self.hide_fit_progress()
+        self.display_data()
+        self.statusbar.push(
+            self.statusbar.get_context_id('import_error'),
+            '{} ({})'.format(file_import_error_msg, error)
         )
 
-    def display_data(self):
+    def display_data(self, df=None, columns=None, file_name=None):
+        '''
+        Show df (default: the loaded data) in the data table
+        '''
+        if df is None:
+            df, columns, file_name = self.data, self.columns, self.file_name
         # remove any pre-existing columns from treeview
         for col in self.data_treeview.get_columns():
             self.data_treeview.remove_column(col)
-        # create model
-        # TODO: allow for other types, and infer from data
-        col_types = [float for col in self.data.columns]
-        list_store = Gtk.ListStore(*col_types)
-
-        # fill model with data
-        for row in self.data.itertuples():
-            list_store.append(
-                [row[i+1] for i, col in enumerate(self.data.columns)]
-            )
-        # set it as TreeView model
-        self.data_treeview.set_model(list_store)
+        # rows are only built as they scroll into view, and fixed height
+        # mode stops the treeview from measuring every one of them
+        model = DataFrameModel(df)
+        self.table_model = model
+        self.table_shown = model.nrows
+        self.data_treeview.set_fixed_height_mode(True)
+        self.data_treeview.set_model(model)
         # Create and append columns
-        for i, col in enumerate(self.data.columns):
+        nsample = min(model.nrows, col_width_sample)
+        for i, col in enumerate(df.columns):
             renderer = Gtk.CellRendererText()
-            column = Gtk.TreeViewColumn(col, renderer, text=i)
+            column = Gtk.TreeViewColumn(str(col), renderer, text=i)
+            # size to the header and the first rows, not the whole column
+            texts = [str(col)] + [
+                model.formatters[i](val)
+                for val in model.columns[i][:nsample]
+            ]
+            layout = self.data_treeview.create_pango_layout('')
+            width = 0
+            for text in texts:
+                layout.set_text(text, -1)
+                width = max(width, layout.get_pixel_size()[0])
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(
+                width + 2*renderer.get_property('xpad') + 4*pad
+            )
+            column.set_resizable(True)
             self.data_treeview.append_column(column)
-        self.fname_buffer.set_text('Source:  {}'.format(self.file_name))
+        # the table only holds x and y, so list every column to pick from
+        self.fname_buffer.set_text('Source:  {}\nColumns:  {}'.format(
+            file_name,
+            ', '.join('{}: {}'.format(i, col)
+                      for i, col in enumerate(columns))
+        ))
         self.fname_textview.set_buffer(self.fname_buffer)
 
+    def refresh_table(self):
+        '''
+        Show the rows appended to the table model since it was set on
+        the treeview
+        '''
+        self.data_treeview.set_model(None)
+        self.data_treeview.set_model(self.table_model)
+        self.table_shown = self.table_model.nrows
+
     def export_data(self, source=None, event=None):
         '''
-        Export fit data and parameters to .csv
+        Export fit curves as .csv, .parquet, .h5 or .npz, and parameters
+        to .params.csv
         '''
         self.file_export_dialog = Gtk.FileChooserDialog(
             title='Export results file...', parent=self.main_window,
@@ -680,22 +1119,58 @@ class App(Gtk.Application):
             Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
             Gtk.STOCK_OK, Gtk.ResponseType.OK
         )
-        filter_csv = Gtk.FileFilter()
-        filter_csv.set_name('.csv files')
-        filter_csv.add_mime_type('text/csv')
-        self.file_export_dialog.add_filter(filter_csv)
+        export_filters = {}
+        for name, fmt in [('.csv files', 'csv'),
+                          ('Parquet files (needs pyarrow)', 'parquet'),
+                          ('HDF5 files (needs h5py)', 'hdf5'),
+                          ('NumPy .npz files', 'npz')]:
+            export_filter = Gtk.FileFilter()
+            export_filter.set_name(name)
+            for ext, ext_fmt in tools.export_formats.items():
+                if ext_fmt == fmt:
+                    export_filter.add_pattern('*' + ext)
+            self.file_export_dialog.add_filter(export_filter)
+            export_filters[fmt] = export_filter
+        # binary formats are much faster to write and read for long fits
+        options_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        compress_check = Gtk.CheckButton.new_with_label('Compress')
+        float32_check = Gtk.CheckButton.new_with_label(
+            'Store curves as float32'
+        )
+        options_box.pack_start(compress_check, False, False, pad)
+        options_box.pack_start(float32_check, False, False, pad)
+        options_box.show_all()
+        self.file_export_dialog.set_extra_widget(options_box)
         response = self.file_export_dialog.run()
 
         if response == Gtk.ResponseType.OK:
             export_filename = self.file_export_dialog.get_filename()
-            if export_filename.find('.csv') == -1:
-                export_filename += '.csv'
+            # the extension picks the format, or else the chosen filter
+            fmt = tools.export_format(export_filename)
+            if fmt is None:
+                chosen = self.file_export_dialog.get_filter()
+                fmt = next((fmt for fmt, export_filter
+                            in export_filters.items()
+                            if export_filter == chosen), 'csv')
+                export_filename += tools.export_ext[fmt]
             self.process_results()
-            self.curves_df.to_csv(export_filename)
-            self.params_df.to_csv(
-                '{}.params.csv'.format(
-                    export_filename[:export_filename.find('.csv')]
+            if self.engine.result is None:
+                return
+            try:
+                export_filename = tools.write_curves(
+                    self.curves_df, export_filename, fmt=fmt,
+                    compression=compress_check.get_active() or None,
+                    float32=float32_check.get_active()
+                )
+            except (ImportError, OSError, ValueError) as e:
+                self.statusbar.push(
+                    self.statusbar.get_context_id('export_error'),
+                    '{} ({})'.format(export_error_msg, e)
                 )
+                self.file_export_dialog.hide()
+                return
+            self.params_df.to_csv(
+                '{}.params.csv'.format(tools.export_stem(export_filename))
             )
             self.statusbar.push(
                 self.statusbar.get_context_id('export_results'),
@@ -709,22 +1184,10 @@ class App(Gtk.Application):
         self.file_export_dialog.hide()
 
     def process_results(self):
-        if self.result is not None:
-            self.params_df = pd.DataFrame.from_dict(
-                self.result.best_values, orient='index'
+        if self.engine.result is not None:
+            self.params_df, self.curves_df = self.engine.process_results(
+                xname=self.data.columns[0]
             )
-            self.params_df.index.name = 'parameter'
-            self.params_df.columns = ['value']
-            curves_dict = {
-                'data': self.y,
-                'total_fit': self.result.best_fit,
-            }
-            components = self.result.eval_components()
-            for i, comp in enumerate(components):
-                curves_dict[comp[:comp.find('_')]] = components[comp]
-            self.curves_df = pd.DataFrame.from_dict(curves_dict)
-            self.curves_df.index = self.x
-            self.curves_df.index.name = self.data.columns[self.xcol_idx]
         else:
             self.statusbar.push(
                 self.statusbar.get_context_id('no_fit_results'),
@@ -752,30 +1215,42 @@ class App(Gtk.Application):
                 )
             self.column_entry_y.set_text('')
             return
-        self.xcol_idx = idx_x
-        self.ycol_idx = idx_y
-        self.result = None
         # make sure user enters an index that's in the data range
         try:
-            self.x = self.data.iloc[:, self.xcol_idx]
+            self.columns[idx_x]
         except IndexError:
             self.statusbar.push(
                 self.statusbar.get_context_id('idx_range_error'),
                 idx_range_error_msg
             )
-            self.column_entry_x.set_text(None)
+            self.column_entry_x.set_text('')
             return
         try:
-            self.y = self.data.iloc[:, self.ycol_idx]
+            self.columns[idx_y]
         except IndexError:
             self.statusbar.push(
                 self.statusbar.get_context_id('idx_range_error'),
                 idx_range_error_msg
             )
-            self.column_entry_y.set_text(None)
+            self.column_entry_y.set_text('')
             return
-        self.xmin = np.min(self.x)
-        self.xmax = np.max(self.x)
+        if self.data_file is not None and \
+                [idx_x, idx_y] != [self.xcol_idx, self.ycol_idx]:
+            # parse the newly picked columns (from the cache if they
+            # were picked before), on_import_done takes it from there
+            self.start_import(self.data_file, self.columns, [idx_x, idx_y])
+            return
+        self.cancel_fit()
+        self.xcol_idx = idx_x
+        self.ycol_idx = idx_y
+        if self.data_file is None:
+            self.data = self.demo_data.iloc[:, [idx_x, idx_y]]
+            self.display_data()
+        self.engine.set_data(
+            self.data.iloc[:, 0].values, self.data.iloc[:, 1].values
+        )
+        self.xmin = np.min(self.engine.x)
+        self.xmax = np.max(self.engine.x)
         self.statusbar.push(
             self.statusbar.get_context_id('new_idx_success'),
             'Column Index (X) = ' + str(self.xcol_idx) + ', ' +
@@ -815,9 +1290,9 @@ class App(Gtk.Application):
             else:
                 self.encoding = self.encoding_entry.get_text()
             if self.fit_method_entry.get_text() != 'least_squares':
-                self.fit_method = self.fit_method_entry.get_text()
+                self.engine.fit_method = self.fit_method_entry.get_text()
             else:
-                self.fit_method = 'least_squares'
+                self.engine.fit_method = 'least_squares'
         else:
             self.settings_dialog.hide()
 
@@ -830,27 +1305,29 @@ class App(Gtk.Application):
             2: 'Copy mode on | y-value',
         }
         if button.get_active():
+            # drop the cursor and click handler of the previous mode
+            if self.mpl_cursor is not None:
+                self.mpl_cursor.remove()
+                self.mpl_cursor = None
+            if self.cid is not None:
+                self.canvas.mpl_disconnect(self.cid)
+                self.cid = None
             if button.get_label() == 'x':
                 self.cmode_state = 1
-                self.mpl_cursor = Cursor(
-                    self.axis, lw=1, c='red', linestyle='--'
-                )
-                self.cid = self.canvas.mpl_connect(
-                    'button_press_event', self.get_coord_click
-                )
             elif button.get_label() == 'y':
                 self.cmode_state = 2
-                self.mpl_cursor = Cursor(
-                    self.axis, lw=1, c='red', linestyle='--'
+            else:
+                # copy mode off
+                self.cmode_state = 0
+            if self.cmode_state:
+                self.mpl_cursor = BlitCursor(
+                    self.axis, linewidth=1, color='red', linestyle='--'
                 )
                 self.cid = self.canvas.mpl_connect(
                     'button_press_event', self.get_coord_click
                 )
-            else:
-                # copy mode off
-                self.cmode_state = 0
-                self.mpl_cursor = None
-                self.canvas.mpl_disconnect(self.cid)
+                # fill the cursor's background cache
+                self.canvas.draw_idle()
 
             self.statusbar.push(
                 self.statusbar.get_context_id('cmode_state'),
@@ -872,6 +1349,20 @@ class App(Gtk.Application):
                     'Copied Y=' + str(y_copy) + ' to clipboard!'
             )
 
+    def add_tool_button(self, label, tooltip, handler, sibling):
+        '''
+        Adds a flat button to the top bar, just right of sibling
+        '''
+        button = Gtk.Button.new_with_label(label)
+        button.set_relief(Gtk.ReliefStyle.NONE)
+        button.set_tooltip_text(tooltip)
+        button.connect('clicked', handler)
+        self.top_bar.insert_next_to(sibling, Gtk.PositionType.RIGHT)
+        self.top_bar.attach_next_to(
+            button, sibling, Gtk.PositionType.RIGHT, 1, 1
+        )
+        return button
+
     def add_accelerator(self, widget, accelerator, signal="activate"):
         '''
         Adds keyboard shortcuts
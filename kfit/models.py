@@ -1,8 +1,41 @@
 # Built-in models for peak fitting from lmfit
 
+import inspect
 import numpy as np
+from scipy.sparse import coo_matrix, diags, issparse
+from lmfit.minimizer import Minimizer
+try:
+    from lmfit.minimizer import coerce_float64
+except ImportError:  # lmfit < 1.2
+    from lmfit.minimizer import _nan_policy as coerce_float64
+from lmfit.model import Model, ModelResult
 from lmfit.models import LorentzianModel, GaussianModel, PseudoVoigtModel, LinearModel
 
+tiny = 1.0e-15  # same floor lmfit.lineshapes puts under widths
+s2pi = np.sqrt(2*np.pi)
+s2ln2 = np.sqrt(2*np.log(2))
+# most of a lorentzian's area a windowed fit may cut off; its tails
+# fall as 1/x**2, so this takes about 2/(pi*tail_area) half-widths
+# either side, where a gaussian is done within a few sigma
+tail_area = 1e-3
+model_nan_msg = (
+    'The model function generated NaN values and the fit aborted! Set '
+    'bounds on the parameters where they apply.'
+)
+
+# a global fit shares these parameters of every peak between datasets
+shared_args = ['center', 'sigma', 'fraction']
+# and prefixes the others with this, per dataset
+data_prefix = 'd{}_'
+
+# parameter names for each component type, in lmfit's order
+component_args = {
+    'lin': ['slope', 'intercept'],
+    'gau': ['amplitude', 'center', 'sigma'],
+    'lor': ['amplitude', 'center', 'sigma'],
+    'voi': ['amplitude', 'center', 'sigma', 'fraction'],
+}
+
 
 def gauss(x, amp, center, sigma):
     '''
@@ -68,6 +101,617 @@ def line_mod(N):
     return model
 
 
+def prefixes(kind, N):
+    '''
+        Returns the lmfit prefixes for N components of one type,
+        e.g. ['gau1_', 'gau2_']
+    '''
+    return ['{}{}_'.format(kind, i+1) for i in range(N)]
+
+
+class PeakSum():
+    '''
+        Callable that evaluates a sum of lines and peaks
+
+        Parameters for each component type are packed into an
+        (n_components, n_args) array and every component of that type
+        is evaluated at once on an (n_components, n_points) grid.
+        __signature__ lists every parameter by name, so lmfit.Model
+        can inspect it like a normal model function.
+
+        With `window` set, each peak is only evaluated within
+        window*sigma of its center (x must be sorted), so the cost of
+        a peak no longer depends on the length of the whole spectrum.
+        Lorentzian and pseudo-Voigt windows are widened so they lose
+        at most tail_area of their area (see window_scales()).
+    '''
+
+    __name__ = 'multi_peak'
+
+    def __init__(self, ngau=0, nlor=0, nvoi=0, nlin=1, window=None):
+        # lines first to keep the old line_mod + gauss_mod + ... order
+        self.counts = {'lin': nlin, 'gau': ngau, 'lor': nlor, 'voi': nvoi}
+        self.window = window
+        self.scales = window_scales(window)
+        self.prefixes = {
+            kind: prefixes(kind, N) for kind, N in self.counts.items()
+        }
+        self.names = {
+            kind: [[prefix + arg for arg in component_args[kind]]
+                   for prefix in self.prefixes[kind]]
+            for kind in self.counts
+        }
+        self.param_names = [
+            name for kind in self.counts
+            for comp_names in self.names[kind] for name in comp_names
+        ]
+        kind_ = inspect.Parameter.POSITIONAL_OR_KEYWORD
+        self.__signature__ = inspect.Signature(
+            [inspect.Parameter('x', kind_)] +
+            [inspect.Parameter(name, kind_) for name in self.param_names]
+        )
+
+    def pack(self, values):
+        '''
+            Returns {kind: (n_components, n_args) array} from a dict
+            of parameter values
+        '''
+        return {
+            kind: np.array(
+                [[values[name] for name in comp_names]
+                 for comp_names in self.names[kind]], dtype=float
+            ).reshape(self.counts[kind], len(component_args[kind]))
+            for kind in self.counts
+        }
+
+    def eval_kinds(self, x, packed):
+        '''
+            Returns {kind: (n_components, n_points) array}
+        '''
+        x = np.asarray(x, dtype=float)
+        return {
+            kind: curve_kinds[kind](x, packed[kind])
+            for kind in self.counts if self.counts[kind]
+        }
+
+    def windows(self, x, packed, kind):
+        '''
+            Returns (lo, hi) so x[lo[i]:hi[i]] is the window of peak i
+        '''
+        p = packed[kind]
+        half = self.window*self.scales[kind]*np.abs(p[:, 2])
+        return window_slices(x, p[:, 1] - half, p[:, 1] + half)
+
+    def window_fill(self, x, **values):
+        '''
+            Returns the share of the (n_params, n_points) jacobian that
+            falls inside the windows, 1 without a window
+        '''
+        if self.window is None or not len(x):
+            return 1
+        x = np.asarray(x, dtype=float)
+        packed = self.pack(values)
+        filled = 0
+        for kind in self.counts:
+            n, k = packed[kind].shape
+            if kind == 'lin':
+                filled += n*k*len(x)
+            elif n:
+                lo, hi = self.windows(x, packed, kind)
+                filled += k*np.sum(hi - lo)
+        return filled/(len(self.param_names)*len(x))
+
+    def windowed_curves(self, x, packed):
+        '''
+            Yields (kind, i, lo, hi, curve) for every component, with
+            lines spanning all of x and peaks cut to their windows
+        '''
+        for kind in self.counts:
+            p = packed[kind]
+            if kind == 'lin':
+                lo, hi = np.zeros(len(p), int), np.full(len(p), len(x))
+            else:
+                lo, hi = self.windows(x, packed, kind)
+            for i in range(len(p)):
+                curve = curve_kinds[kind](x[lo[i]:hi[i]], p[i:i+1])[0]
+                yield kind, i, lo[i], hi[i], curve
+
+    def components(self, x, **values):
+        '''
+            Returns {prefix: curve} for every component
+        '''
+        x = np.asarray(x, dtype=float)
+        packed = self.pack(values)
+        if self.window is None:
+            grids = self.eval_kinds(x, packed)
+            return {
+                prefix: grids[kind][i]
+                for kind in self.counts if kind in grids
+                for i, prefix in enumerate(self.prefixes[kind])
+            }
+        out = {}
+        for kind, i, lo, hi, curve in self.windowed_curves(x, packed):
+            comp = np.zeros(len(x))
+            comp[lo:hi] = curve
+            out[self.prefixes[kind][i]] = comp
+        return out
+
+    def __call__(self, x, **values):
+        x = np.asarray(x, dtype=float)
+        packed = self.pack(values)
+        if self.window is None:
+            grids = self.eval_kinds(x, packed)
+            return sum(grid.sum(axis=0) for grid in grids.values())
+        total = np.zeros(len(x))
+        for kind, i, lo, hi, curve in self.windowed_curves(x, packed):
+            total[lo:hi] += curve
+        return total
+
+    def jacobian(self, x, **values):
+        '''
+            Returns (n_params, n_points) array of d(model)/d(param),
+            rows in param_names order
+        '''
+        x = np.asarray(x, dtype=float)
+        packed = self.pack(values)
+        windowed = self.window is not None
+        jac = np.zeros((len(self.param_names), len(x))) if windowed \
+            else np.empty((len(self.param_names), len(x)))
+        row = 0
+        for kind in self.counts:
+            n, k = packed[kind].shape
+            # rows for one type are contiguous: components x args
+            block = jac[row:row + n*k].reshape(n, k, len(x))
+            if n and (kind == 'lin' or not windowed):
+                jac_kinds[kind](x, packed[kind], block)
+            elif n:
+                lo, hi = self.windows(x, packed, kind)
+                for i in range(n):
+                    jac_kinds[kind](
+                        x[lo[i]:hi[i]], packed[kind][i:i+1],
+                        block[i:i+1, :, lo[i]:hi[i]]
+                    )
+            row += n*k
+        return jac
+
+    def sparse_jacobian(self, x, **values):
+        '''
+            Returns the jacobian as a sparse (n_points, n_params)
+            matrix, columns in param_names order, with each peak only
+            filled in over its window
+        '''
+        x = np.asarray(x, dtype=float)
+        packed = self.pack(values)
+        data, rows, cols = [], [], []
+        col = 0
+        for kind in self.counts:
+            n, k = packed[kind].shape
+            if kind == 'lin' or self.window is None:
+                lo, hi = np.zeros(n, int), np.full(n, len(x))
+            else:
+                lo, hi = self.windows(x, packed, kind)
+            for i in range(n):
+                block = np.empty((1, k, hi[i] - lo[i]))
+                jac_kinds[kind](x[lo[i]:hi[i]], packed[kind][i:i+1], block)
+                span = np.arange(lo[i], hi[i])
+                for j in range(k):
+                    data.append(block[0, j])
+                    rows.append(span)
+                    cols.append(np.full(len(span), col + j))
+                col += k
+        if data:
+            data, rows, cols = [np.concatenate(a) for a in (data, rows, cols)]
+        return coo_matrix(
+            (data, (rows, cols)), shape=(len(x), len(self.param_names))
+        ).tocsr()
+
+
+def window_scales(window):
+    '''
+        Returns {kind: multiple of window} giving each peak type's
+        window, in units of its sigma
+
+        A gaussian cut at 5 sigma keeps all but 6e-7 of its area, but a
+        lorentzian cut at 5 half-widths loses 13% of it. So lorentzians,
+        and pseudo-Voigts with their lorentzian part, get at least the
+        half-width that keeps all but tail_area.
+    '''
+    if window is None:
+        return {kind: 1 for kind in component_args}
+    # a unit lorentzian has 1 - 2*arctan(w)/pi of its area beyond +-w
+    lor_half = np.tan(np.pi/2*(1 - tail_area))
+    wide = max(1, lor_half/window)
+    return {'lin': 1, 'gau': 1, 'lor': wide, 'voi': wide}
+
+
+def window_slices(x, lower, upper):
+    '''
+        Returns index arrays (lo, hi) with lower <= x[lo:hi] <= upper,
+        for x sorted in either direction
+    '''
+    if len(x) == 0 or x[0] <= x[-1]:
+        return (np.searchsorted(x, lower, 'left'),
+                np.searchsorted(x, upper, 'right'))
+    rev = x[::-1]
+    return (len(x) - np.searchsorted(rev, upper, 'right'),
+            len(x) - np.searchsorted(rev, lower, 'left'))
+
+
+def gauss_grid(x, amp, center, sigma):
+    '''
+        Returns (n_peaks, n_points) array of lmfit-style gaussians
+    '''
+    sigma = np.maximum(sigma, tiny)[:, None]
+    # work in place on one (n_peaks, n_points) buffer
+    grid = np.subtract(x, center[:, None])
+    grid /= sigma
+    np.square(grid, out=grid)
+    grid *= -0.5
+    np.exp(grid, out=grid)
+    grid *= amp[:, None]/(s2pi*sigma)
+    return grid
+
+
+def lor_grid(x, amp, center, sigma):
+    '''
+        Returns (n_peaks, n_points) array of lmfit-style lorentzians
+    '''
+    sigma = np.maximum(sigma, tiny)[:, None]
+    grid = np.subtract(x, center[:, None])
+    np.square(grid, out=grid)
+    grid += sigma**2
+    np.reciprocal(grid, out=grid)
+    grid *= amp[:, None]*sigma/np.pi
+    return grid
+
+
+# each returns (n_components, n_points) curves for packed params p
+def line_curves(x, p):
+    return p[:, :1]*x + p[:, 1:2]
+
+
+def gauss_curves(x, p):
+    return gauss_grid(x, p[:, 0], p[:, 1], p[:, 2])
+
+
+def lor_curves(x, p):
+    return lor_grid(x, p[:, 0], p[:, 1], p[:, 2])
+
+
+def voigt_curves(x, p):
+    frac = p[:, 3:4]
+    grid = gauss_grid(x, p[:, 0], p[:, 1], p[:, 2]/s2ln2)
+    grid *= 1 - frac
+    grid += frac*lor_grid(x, p[:, 0], p[:, 1], p[:, 2])
+    return grid
+
+
+curve_kinds = {
+    'lin': line_curves,
+    'gau': gauss_curves,
+    'lor': lor_curves,
+    'voi': voigt_curves,
+}
+
+
+# analytic derivatives, each fills out[i_component, i_arg, :]
+# in the same arg order as component_args
+def line_jac(x, p, out):
+    out[:, 0] = x
+    out[:, 1] = 1
+
+
+def gauss_jac(x, p, out, sigma_scale=1):
+    amp, center = p[:, 0:1], p[:, 1:2]
+    sigma = np.maximum(p[:, 2:3]/sigma_scale, tiny)
+    u = (x - center)/sigma
+    base = np.exp(-0.5*u**2)/(s2pi*sigma)  # unit-area gaussian
+    out[:, 0] = base
+    curve = amp*base
+    out[:, 1] = curve*u/sigma
+    out[:, 2] = curve*(u**2 - 1)/sigma/sigma_scale
+    return curve
+
+
+def lor_jac(x, p, out):
+    amp, center = p[:, 0:1], p[:, 1:2]
+    sigma = np.maximum(p[:, 2:3], tiny)
+    d = x - center
+    denom = d**2 + sigma**2
+    base = sigma/(np.pi*denom)  # unit-area lorentzian
+    out[:, 0] = base
+    curve = amp*base
+    out[:, 1] = curve*2*d/denom
+    out[:, 2] = curve*(d**2 - sigma**2)/(sigma*denom)
+    return curve
+
+
+def voigt_jac(x, p, out):
+    frac = p[:, 3:4]
+    gau_out = np.empty((len(p), 3, len(x)))
+    gau = gauss_jac(x, p, gau_out, sigma_scale=s2ln2)
+    lor = lor_jac(x, p, out)
+    out[:, :3] *= frac[:, :, None]
+    out[:, :3] += (1 - frac)[:, :, None]*gau_out
+    out[:, 3] = lor - gau
+
+
+jac_kinds = {
+    'lin': line_jac,
+    'gau': gauss_jac,
+    'lor': lor_jac,
+    'voi': voigt_jac,
+}
+
+
+class SparseLeastSquares():
+    '''
+        Mixin for lmfit Minimizers fitting with least_squares and a
+        sparse jacobian
+
+        lmfit makes any jacobian from a callable dense, so pass it
+        through untouched instead. Newer scipy also returns it as a
+        sparse array, where `*` is elementwise, and lmfit's covariance
+        estimate fails on that after the fit itself has converged, so
+        redo just that step.
+    '''
+
+    def _jacobian(self, fvars, apply_bounds_transformation=True):
+        if apply_bounds_transformation:
+            # only least_squares, which handles bounds itself, is sparse
+            return super()._jacobian(fvars, apply_bounds_transformation)
+        pars = self.result.params
+        for name, val in zip(self.result.var_names, fvars):
+            pars[name].value = val
+        pars.update_constraints()
+        return self.jacfcn(pars, *self.userargs, **self.userkws)
+
+    def least_squares(self, params=None, max_nfev=None, **kws):
+        try:
+            return super().least_squares(
+                params=params, max_nfev=max_nfev, **kws
+            )
+        except ValueError:
+            result = self.result
+            if not issparse(getattr(result, 'jac', None)):
+                raise
+        try:
+            hess = (result.jac.T @ result.jac).toarray()
+            result.covar = np.linalg.inv(hess)
+            self._calculate_uncertainties_correlations()
+        except np.linalg.LinAlgError:
+            pass
+        return result
+
+
+class SparseModelResult(SparseLeastSquares, ModelResult):
+    pass
+
+
+class SparseMinimizer(SparseLeastSquares, Minimizer):
+    '''
+        Minimizer for least_squares with a sparse jacobian over many
+        parameters
+
+        Only the standard errors are set on the parameters. lmfit would
+        also give each one a dict of its correlation with every other,
+        which for a global fit of thousands of parameters takes longer
+        than the fit; they can be read off result.covar instead.
+    '''
+
+    def _calculate_uncertainties_correlations(self):
+        result = self.result
+        if self.scale_covar:
+            result.covar *= result.redchi
+        for par in result.params.values():
+            par.stderr, par.correl = 0, None
+        stderr = np.sqrt(np.diag(result.covar))
+        for name, err in zip(result.var_names, stderr):
+            result.params[name].stderr = float(err)
+        result.errorbars = bool(np.all(stderr > 0))
+
+
+class MultiPeakModel(Model):
+    '''
+        Drop-in replacement for line_mod(nlin) + gauss_mod(ngau) + ...
+
+        A single lmfit Model with the same gau1_/lor1_/voi1_/lin1_
+        parameter names, but evaluated with one broadcast expression
+        per peak type instead of walking a deep CompositeModel tree.
+    '''
+
+    def __init__(self, ngau=0, nlor=0, nvoi=0, nlin=1, window=None, **kws):
+        kws.setdefault('independent_vars', ['x'])
+        super().__init__(PeakSum(ngau, nlor, nvoi, nlin, window), **kws)
+        self.prefixes = [
+            prefix for kind in self.func.counts
+            for prefix in self.func.prefixes[kind]
+        ]
+
+    def _reprstring(self, long=False):
+        counts = self.func.counts
+        window = '' if self.func.window is None \
+            else ', window={}'.format(self.func.window)
+        return ('Model(multi_peak, ngau={}, nlor={}, nvoi={}, nlin={}{})'
+                .format(counts['gau'], counts['lor'], counts['voi'],
+                        counts['lin'], window))
+
+    def eval_components(self, params=None, **kwargs):
+        '''
+            Returns {prefix: curve}, like CompositeModel.eval_components
+        '''
+        return self.func.components(**self.make_funcargs(params, kwargs))
+
+    def _residual(self, params, data, weights, **kwargs):
+        # lmfit has flipped the sign of its default residual between
+        # releases, so pin (model - data)*weights to match jacobian(),
+        # with the same nan_policy checks as lmfit's
+        model = self.eval(params, **kwargs)
+        if self.nan_policy == 'raise' and not np.all(np.isfinite(model)):
+            raise ValueError(model_nan_msg)
+        diff = model - data
+        if weights is not None:
+            diff *= weights
+        if self.nan_policy == 'omit':
+            # fit() has dropped missing data already, and dropping more
+            # here would leave rows of the jacobian without a residual
+            return np.asarray(diff, dtype=float).ravel()
+        return coerce_float64(diff, nan_policy=self.nan_policy)
+
+    def jacobian(self, params, data, weights, **kwargs):
+        '''
+            Analytic jacobian of the residual for lmfit's leastsq and
+            least_squares, pass as fit_kws={'Dfun': model.jacobian}
+
+            Returns (n_points, n_varying) array. Assumes no parameter
+            is constrained with an expression.
+        '''
+        jac = self.func.jacobian(**self.make_funcargs(params, kwargs))
+        varying = [params[name].vary for name in self.param_names]
+        if not all(varying):
+            jac = jac[varying]
+        if weights is not None:
+            jac *= weights
+        return jac.T
+
+    def sparse_jacobian(self, params, data, weights, **kwargs):
+        '''
+            Like jacobian(), but returns a sparse (n_points, n_varying)
+            matrix, which only pays off with a window set
+        '''
+        jac = self.func.sparse_jacobian(**self.make_funcargs(params, kwargs))
+        varying = [params[name].vary for name in self.param_names]
+        if not all(varying):
+            jac = jac[:, np.flatnonzero(varying)]
+        if weights is not None:
+            jac = diags(np.ravel(weights)) @ jac
+        return jac.tocsr()
+
+    def fit_sparse(self, data, params, x, iter_cb=None, **fit_kws):
+        '''
+            Model.fit with least_squares and sparse_jacobian(), solving
+            with lsmr so the jacobian is never made dense
+
+            Assumes no parameter is constrained with an expression.
+        '''
+        fit_kws.setdefault('tr_solver', 'lsmr')
+        # lsmr steps converge poorly on badly scaled peak parameters
+        fit_kws.setdefault('x_scale', 'jac')
+        if self.nan_policy == 'omit':
+            # drop missing data up front, as Model.fit does
+            keep = ~np.isnan(data)
+            data, x = np.asarray(data)[keep], np.asarray(x)[keep]
+        result = SparseModelResult(
+            self, params.copy(), method='least_squares', iter_cb=iter_cb,
+            fcn_kws={'x': x}, nan_policy=self.nan_policy,
+            jac=self.sparse_jacobian, **fit_kws
+        )
+        result.fit(data=data)
+        result.components = self.components
+        return result
+
+
+class GlobalPeakModel():
+    '''
+        The same peaks fit to several datasets at once
+
+        Parameters named by one of `shared` (e.g. every peak's center
+        and sigma) are common to all the datasets, the rest get a prefix
+        per dataset: d0_gau1_amplitude, d1_gau1_amplitude, ... The
+        residuals of all the datasets are joined into one least-squares
+        problem. Its jacobian is block-sparse: a row only depends on the
+        shared parameters and those of its own dataset.
+    '''
+
+    def __init__(self, ndata, ngau=0, nlor=0, nvoi=0, nlin=1, window=None,
+                 shared=shared_args):
+        self.func = PeakSum(ngau, nlor, nvoi, nlin, window)
+        self.ndata = ndata
+        self.shared = list(shared)
+        self.shared_names = [
+            name for name in self.func.param_names if self.is_shared(name)
+        ]
+        self.param_names = self.shared_names + [
+            self.global_name(name, i) for i in range(ndata)
+            for name in self.func.param_names if not self.is_shared(name)
+        ]
+        index = {name: j for j, name in enumerate(self.param_names)}
+        # columns[i][k]: where the k-th parameter of dataset i's model
+        # lives in param_names
+        self.columns = [
+            np.array([index[self.global_name(name, i)]
+                      for name in self.func.param_names], dtype=int)
+            for i in range(ndata)
+        ]
+
+    def is_shared(self, name):
+        kind, arg = name.split('_', 1)
+        return not kind.startswith('lin') and arg in self.shared
+
+    def global_name(self, name, i):
+        return name if self.is_shared(name) else data_prefix.format(i) + name
+
+    def dataset_values(self, values, i):
+        '''
+            {model parameter name: value} for dataset i, from values
+            (or Parameters) keyed by global names
+        '''
+        return {name: float(values[self.global_name(name, i)])
+                for name in self.func.param_names}
+
+    def eval(self, params, x, i):
+        return self.func(x, **self.dataset_values(params, i))
+
+    def eval_components(self, params, x, i):
+        return self.func.components(x, **self.dataset_values(params, i))
+
+    def residual(self, params, xs, ys):
+        return np.concatenate([
+            self.eval(params, x, i) - y
+            for i, (x, y) in enumerate(zip(xs, ys))
+        ])
+
+    def jacobian(self, params, xs, ys):
+        '''
+            Sparse (total points, n_varying) jacobian of residual()
+        '''
+        data, rows, cols = [], [], []
+        offset = 0
+        for i, x in enumerate(xs):
+            block = self.func.sparse_jacobian(
+                x, **self.dataset_values(params, i)
+            ).tocoo()
+            data.append(block.data)
+            rows.append(block.row + offset)
+            cols.append(self.columns[i][block.col])
+            offset += len(x)
+        jac = coo_matrix(
+            (np.concatenate(data), (np.concatenate(rows),
+                                    np.concatenate(cols))),
+            shape=(offset, len(self.param_names))
+        ).tocsc()
+        varying = [params[name].vary for name in self.param_names]
+        if not all(varying):
+            jac = jac[:, np.flatnonzero(varying)]
+        return jac.tocsr()
+
+    def fit(self, xs, ys, params, iter_cb=None, **fit_kws):
+        '''
+            least_squares over every dataset, solved with lsmr so the
+            jacobian is never made dense. Returns a MinimizerResult.
+
+            Assumes no parameter is constrained with an expression.
+        '''
+        fit_kws.setdefault('tr_solver', 'lsmr')
+        fit_kws.setdefault('x_scale', 'jac')
+        xs = [np.asarray(x, dtype=float) for x in xs]
+        ys = [np.asarray(y, dtype=float) for y in ys]
+        minimizer = SparseMinimizer(
+            self.residual, params, fcn_args=(xs, ys), iter_cb=iter_cb
+        )
+        return minimizer.least_squares(jac=self.jacobian, **fit_kws)
+
+
 # below functions convert amp/sigma to height/fwhm for
 # different curve types
 def fwhm_lor(sigma):
@@ -75,7 +719,7 @@ def fwhm_lor(sigma):
 
 
 def height_lor(amp, sigma):
-    return(amp*sigma/np.pi)  # lorentzian
+    return(amp/(np.pi*sigma))  # lorentzian
 
 
 def fwhm_gau(sigma):
@@ -90,4 +734,32 @@ def fwhm_voi(sigma):
     return(2*sigma)
 
 
-# def height_voi(amp, sigma, frac):
+def height_voi(amp, sigma, frac):
+    # gaussian part has the same fwhm as the lorentzian part
+    return((1 - frac)*height_gau(amp, sigma/s2ln2) +
+           frac*height_lor(amp, sigma))
+
+
+def peak_shapes(values):
+    '''
+        Returns {prefix + 'height': ..., prefix + 'fwhm': ...} for every
+        peak in a dict of parameter values
+    '''
+    out = {}
+    for name in values:
+        if not name.endswith('_center'):
+            continue
+        prefix = name[:-len('center')]
+        amp, sigma = values[prefix + 'amplitude'], values[prefix + 'sigma']
+        if prefix.startswith('gau'):
+            out[prefix + 'height'] = height_gau(amp, sigma)
+            out[prefix + 'fwhm'] = fwhm_gau(sigma)
+        elif prefix.startswith('lor'):
+            out[prefix + 'height'] = height_lor(amp, sigma)
+            out[prefix + 'fwhm'] = fwhm_lor(sigma)
+        else:
+            out[prefix + 'height'] = height_voi(
+                amp, sigma, values[prefix + 'fraction']
+            )
+            out[prefix + 'fwhm'] = fwhm_voi(sigma)
+    return out
@@ -0,0 +1,44 @@
+'''
+    Fan independent fits out over a process pool that can be cancelled
+    part way through
+'''
+
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+class Cancelled(Exception):
+    '''
+        Raised by completed() once the cancel event is set
+    '''
+
+
+def is_cancelled(cancel):
+    return cancel is not None and cancel.is_set()
+
+
+@contextmanager
+def process_pool(workers=None, mp_context=None, **kws):
+    '''
+        A ProcessPoolExecutor that, on the way out, drops the work not
+        yet started rather than waiting for it, e.g. after a cancel or
+        an error
+    '''
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                               **kws)
+    try:
+        yield pool
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def completed(futures, cancel=None):
+    '''
+        Yields (futures[future], future) as each of futures (a dict of
+        future: key) finishes, and raises Cancelled as soon as the
+        cancel event is set
+    '''
+    for future in as_completed(futures):
+        if is_cancelled(cancel):
+            raise Cancelled()
+        yield futures[future], future
@@ -0,0 +1,307 @@
+'''
+    Keeps the main plot's artists alive between redraws
+
+    Rather than clearing the figure and plotting everything again,
+    PlotManager moves the data, total fit and component lines to new
+    values with set_data, and only adds or removes component lines
+    when the set of components changes. Redraws go through draw_idle,
+    so several updates in a row cost a single render.
+
+    Long lines are drawn from a MinMaxPyramid: whenever the x limits
+    or the canvas size change, each line gets the min and max of its
+    points in every pixel-sized block of the view, so panning and
+    zooming cost the same for a thousand points or a million. Only the
+    plot is decimated; fits use the full arrays.
+'''
+
+import numpy as np
+import matplotlib
+
+data_color = '#af87ff'
+fit_color = 'r'
+component_cmap = 'gnuplot'
+# with this many points or more, data is drawn as a line, not markers,
+# and lines are decimated to the view
+line_threshold = 1000
+
+
+def pair_reduce(idx, y, better):
+    '''
+        Halve idx by keeping the better of each neighbouring pair
+    '''
+    npairs = len(idx)//2
+    a, b = idx[:2*npairs:2], idx[1:2*npairs:2]
+    out = np.where(better(y[a], y[b]), a, b)
+    if len(idx) % 2:
+        out = np.append(out, idx[-1])
+    return out
+
+
+class MinMaxPyramid():
+    '''
+        Indices of the min and max of y over blocks of 2, 4, 8, ...
+        points, so any x range can be drawn with two points per block
+        without losing peaks or spikes
+    '''
+
+    def __init__(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='stable')
+            x, y = x[order], y[order]
+        self.x, self.y = x, y
+        # levels[k] holds (imin, imax) for blocks of 2**(k+1) points
+        self.levels = []
+        imin = imax = np.arange(len(y))
+        while len(imin) > 1:
+            imin = pair_reduce(imin, y, np.less_equal)
+            imax = pair_reduce(imax, y, np.greater_equal)
+            self.levels.append((imin, imax))
+
+    def query(self, xmin, xmax, npix):
+        '''
+            Returns (x, y) covering xmin..xmax with at most about
+            2*npix points
+        '''
+        lo = max(np.searchsorted(self.x, xmin, 'left') - 1, 0)
+        hi = min(np.searchsorted(self.x, xmax, 'right') + 1, len(self.x))
+        npoints = hi - lo
+        if npoints <= 2*npix or not self.levels:
+            return self.x[lo:hi], self.y[lo:hi]
+        k = int(np.ceil(np.log2(npoints/npix))) - 1
+        k = min(max(k, 0), len(self.levels) - 1)
+        size = 2**(k + 1)
+        imin, imax = self.levels[k]
+        start, stop = lo//size, -(-hi//size)
+        a, b = imin[start:stop], imax[start:stop]
+        # keep each block's two points in x order
+        idx = np.empty(2*len(a), dtype=int)
+        idx[0::2] = np.minimum(a, b)
+        idx[1::2] = np.maximum(a, b)
+        return self.x[idx], self.y[idx]
+
+
+class PlotManager():
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.axis = figure.add_subplot(111)
+        self.data_line, = self.axis.plot([], [], label='data')
+        self.fit_line, = self.axis.plot([], [], c=fit_color, linewidth=2.5)
+        self.fit_line.set_visible(False)
+        # {prefix: Line2D}, in model order
+        self.component_lines = {}
+        # {Line2D: MinMaxPyramid} for lines drawn decimated
+        self.pyramids = {}
+        self.legend_stale = True
+        self.legend_cid = None
+        self.axis.callbacks.connect('xlim_changed', self.update_views)
+        figure.canvas.mpl_connect('resize_event', self.update_views)
+
+    def set_data(self, x, y, xlabel='', ylabel=''):
+        line = self.data_line
+        self.set_line(line, x, y)
+        if len(x) >= line_threshold:
+            line.set(linestyle='-', linewidth=12, color=data_color,
+                     marker='None')
+        else:
+            # same look as scatter(s=200, edgecolors='black')
+            line.set(linestyle='None', marker='o',
+                     markersize=np.sqrt(200), markerfacecolor=data_color,
+                     markeredgecolor='black', markeredgewidth=1)
+        self.axis.set_xlabel(xlabel)
+        self.axis.set_ylabel(ylabel)
+        self.legend_stale = True
+        self.autoscale()
+
+    def set_fit(self, x, total=None, components=None):
+        '''
+            Show the total fit and {prefix: curve} components, or hide
+            them if total is None
+        '''
+        components = {} if total is None else components or {}
+        if total is None:
+            self.set_line(self.fit_line, [], [])
+            self.fit_line.set_visible(False)
+        else:
+            self.set_line(self.fit_line, x, total)
+            self.fit_line.set_visible(True)
+
+        changed = list(self.component_lines) != list(components)
+        for prefix in list(self.component_lines):
+            if prefix not in components:
+                line = self.component_lines.pop(prefix)
+                self.pyramids.pop(line, None)
+                line.remove()
+        lines = {}
+        for prefix, curve in components.items():
+            line = self.component_lines.get(prefix)
+            if line is None:
+                line, = self.axis.plot(
+                    [], [], linewidth=2.5, linestyle='--',
+                    label=prefix[:prefix.find('_')]
+                )
+            self.set_line(line, x, curve)
+            lines[prefix] = line
+        self.component_lines = lines
+        if changed:
+            cmap = matplotlib.colormaps[component_cmap]
+            for i, line in enumerate(lines.values()):
+                line.set_color(cmap(i/len(lines)))
+            self.legend_stale = True
+        self.autoscale()
+
+    def set_line(self, line, x, y):
+        '''
+            Give line new data, drawn from a pyramid if it's long
+        '''
+        if len(x) >= line_threshold:
+            pyramid = MinMaxPyramid(x, y)
+            self.pyramids[line] = pyramid
+            # the whole range, so autoscale sees every point
+            line.set_data(*pyramid.query(
+                pyramid.x[0], pyramid.x[-1], self.pixel_width()
+            ))
+        else:
+            self.pyramids.pop(line, None)
+            line.set_data(x, y)
+
+    def pixel_width(self):
+        return max(int(self.axis.bbox.width), 1)
+
+    def update_views(self, *args):
+        '''
+            Re-decimate long lines to the current x limits and size
+        '''
+        xmin, xmax = sorted(self.axis.get_xlim())
+        npix = self.pixel_width()
+        for line, pyramid in self.pyramids.items():
+            line.set_data(*pyramid.query(xmin, xmax, npix))
+
+    def autoscale(self):
+        self.axis.relim(visible_only=True)
+        self.axis.autoscale_view()
+
+    def set_xlim(self, xmin, xmax):
+        self.axis.set_xlim([xmin, xmax])
+
+    def draw(self):
+        self.update_views()
+        if self.legend_stale:
+            self.axis.legend(
+                handles=[self.data_line] + list(self.component_lines.values()),
+                loc='best'
+            )
+            self.legend_stale = False
+            if self.legend_cid is None:
+                self.legend_cid = self.figure.canvas.mpl_connect(
+                    'draw_event', self.pin_legend
+                )
+        self.figure.canvas.draw_idle()
+
+    def pin_legend(self, event):
+        '''
+            loc='best' checks every point of every line on each draw,
+            so once it has found a spot, keep the legend there
+        '''
+        self.figure.canvas.mpl_disconnect(self.legend_cid)
+        self.legend_cid = None
+        legend = self.axis.get_legend()
+        if legend is not None:
+            bbox = legend.get_window_extent().transformed(
+                self.axis.transAxes.inverted()
+            )
+            legend.set_loc((bbox.x0, bbox.y0))
+
+
+class BlitCursor():
+    '''
+        Crosshair and x/y readout that follow the mouse over an axis
+
+        The rest of the figure is cached after each full draw, so a
+        mouse move only restores that and draws the two lines and the
+        label on top. The cache is dropped whenever the view changes
+        and refilled by the draw that follows.
+    '''
+
+    def __init__(self, axis, color='red', linewidth=1, linestyle='--',
+                 fmt='x = {:.4g}, y = {:.4g}'):
+        self.axis = axis
+        self.canvas = axis.figure.canvas
+        self.fmt = fmt
+        # without blitting, the cursor is drawn as part of the figure
+        animated = self.canvas.supports_blit
+        line_kws = {'color': color, 'linewidth': linewidth,
+                    'linestyle': linestyle, 'animated': animated,
+                    'visible': False}
+        self.hline = axis.axhline(axis.get_ybound()[0], **line_kws)
+        self.vline = axis.axvline(axis.get_xbound()[0], **line_kws)
+        self.label = axis.text(
+            0.01, 0.98, '', transform=axis.transAxes, ha='left', va='top',
+            animated=animated, visible=False,
+            bbox={'facecolor': 'white', 'alpha': 0.8, 'edgecolor': 'none'}
+        )
+        self.artists = [self.hline, self.vline, self.label]
+        self.background = None
+        self.cids = [
+            self.canvas.mpl_connect('draw_event', self.on_draw),
+            self.canvas.mpl_connect('resize_event', self.invalidate),
+            self.canvas.mpl_connect('motion_notify_event', self.on_move),
+            self.canvas.mpl_connect('axes_leave_event', self.on_leave),
+        ]
+        self.lim_cids = [
+            axis.callbacks.connect('xlim_changed', self.invalidate),
+            axis.callbacks.connect('ylim_changed', self.invalidate),
+        ]
+
+    def invalidate(self, *args):
+        self.background = None
+
+    def on_draw(self, event):
+        if not self.canvas.supports_blit:
+            return
+        self.background = self.canvas.copy_from_bbox(self.axis.bbox)
+        # animated artists are left out of full draws, so put them back
+        self.blit()
+
+    def on_move(self, event):
+        if event.inaxes is not self.axis or \
+                self.canvas.widgetlock.locked():
+            # e.g. the toolbar is zooming
+            self.on_leave(event)
+            return
+        self.hline.set_ydata([event.ydata, event.ydata])
+        self.vline.set_xdata([event.xdata, event.xdata])
+        self.label.set_text(self.fmt.format(event.xdata, event.ydata))
+        for artist in self.artists:
+            artist.set_visible(True)
+        self.blit()
+
+    def on_leave(self, event):
+        if self.hline.get_visible():
+            for artist in self.artists:
+                artist.set_visible(False)
+            self.blit()
+
+    def blit(self):
+        if not self.canvas.supports_blit:
+            self.canvas.draw_idle()
+            return
+        if self.background is None:
+            # wait for the next full draw to cache the background
+            return
+        self.canvas.restore_region(self.background)
+        for artist in self.artists:
+            if artist.get_visible():
+                self.axis.draw_artist(artist)
+        self.canvas.blit(self.axis.bbox)
+
+    def remove(self):
+        for cid in self.cids:
+            self.canvas.mpl_disconnect(cid)
+        for cid in self.lim_cids:
+            self.axis.callbacks.disconnect(cid)
+        for artist in self.artists:
+            artist.remove()
+        self.canvas.draw_idle()
@@ -0,0 +1,421 @@
+'''
+    Search over models on a process pool
+
+    select_peaks picks how many peaks of each kind to fit. It starts
+    from the baseline alone and adds one peak at a time, fitting every
+    (ngau, nlor, nvoi) with the same total number of peaks in parallel
+    and ranking them by AIC or BIC. Only models within prune_delta of
+    the best so far get more peaks, and the search stops once adding
+    peaks has stopped helping for `patience` peak counts in a row, so
+    it fits a small part of the full grid.
+
+    multi_start fits one model from many starting points, for data
+    where overlapping peaks leave least_squares stuck in whichever
+    local minimum is nearest the guesses. The starts fill the space of
+    peak centers, widths, amplitudes and fractions evenly (a Sobol
+    sequence or a Latin hypercube), the local fits run in parallel, and
+    the minima they reach are merged when they give the same curve,
+    even if the peaks came out in a different order.
+'''
+
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+try:
+    from . import models
+    from .engine import FitEngine, engine_spec
+    from .parallel import Cancelled, completed, process_pool
+except ImportError:
+    import models
+    from engine import FitEngine, engine_spec
+    from parallel import Cancelled, completed, process_pool
+
+peak_kinds = ['gau', 'lor', 'voi']
+criteria = ['aic', 'bic']
+# a model this far above the best criterion so far is clearly worse
+# (Burnham & Anderson), so it isn't grown any further
+prune_delta = 10
+# peak counts in a row that may fail to beat the best before stopping
+default_patience = 2
+default_starts = 32
+samplers = ['sobol', 'lhs']
+# minima are the same if their chi-squares are this close, relatively,
+# and their curves differ by less than this fraction of the rms residual
+same_chisqr = 1e-6
+same_curve = 1e-3
+# widths are drawn from this factor either side of the guesses
+width_range = 4
+# centers are drawn in proportion to the signal above the baseline,
+# plus this fraction of its mean so every x can still be picked
+signal_floor = 0.05
+
+
+def count_name(counts):
+    '''
+        e.g. 'gau2 voi1', or 'baseline' for no peaks
+    '''
+    name = ' '.join('{}{}'.format(kind, counts['n' + kind])
+                    for kind in peak_kinds if counts['n' + kind])
+    return name or 'baseline'
+
+
+def add_peak(counts, kinds):
+    '''
+        Every model with one more peak than counts, of one of kinds
+    '''
+    grown = []
+    for kind in kinds:
+        new = dict(counts)
+        new['n' + kind] += 1
+        grown.append(new)
+    return grown
+
+
+def fit_counts(x, y, counts, nlin=1, fit_method='least_squares',
+               window=None):
+    '''
+        Fit one model from fresh guesses. Runs in a worker process, so
+        returns a summary of the fit rather than the ModelResult.
+    '''
+    engine = FitEngine(x, y, nlin=nlin, fit_method=fit_method,
+                       window=window, **counts)
+    result = engine.fit()
+    record = dict(counts)
+    record.update({
+        'npeaks': sum(counts.values()), 'aic': result.aic,
+        'bic': result.bic, 'redchi': result.redchi, 'nfev': result.nfev,
+        'success': result.success,
+    })
+    return record
+
+
+def select_peaks(x, y, kinds=peak_kinds, max_peaks=6, nlin=1,
+                 criterion='bic', fit_method='least_squares', window=None,
+                 patience=default_patience, workers=None, on_fit=None,
+                 cancel=None, mp_context=None):
+    '''
+        Returns ({'ngau': .., 'nlor': .., 'nvoi': ..} of the best model,
+        a DataFrame of every model fit, best first), or None if the
+        cancel event was set
+
+        on_fit(record) is called as each fit finishes. Fits that fail
+        are kept in the table with a nan criterion. mp_context is
+        passed on to the ProcessPoolExecutor.
+    '''
+    if criterion not in criteria:
+        raise ValueError('criterion must be one of {}'.format(criteria))
+    fit_kws = {'nlin': nlin, 'fit_method': fit_method, 'window': window}
+    x, y = np.asarray(x), np.asarray(y)
+    records = []
+    best = None
+    stale = 0
+    level = [{'n' + kind: 0 for kind in peak_kinds}]
+    try:
+        with process_pool(workers, mp_context) as pool:
+            for npeaks in range(max_peaks + 1):
+                futures = {
+                    pool.submit(fit_counts, x, y, counts, **fit_kws): counts
+                    for counts in level
+                }
+                results = []
+                for counts, future in completed(futures, cancel):
+                    try:
+                        record = future.result()
+                    except Exception:
+                        record = dict(counts)
+                        record.update({'npeaks': npeaks, 'aic': np.nan,
+                                       'bic': np.nan, 'success': False})
+                    results.append(record)
+                    if on_fit is not None:
+                        on_fit(record)
+                records += results
+                fitted = [r for r in results if np.isfinite(r[criterion])]
+                if fitted:
+                    level_best = min(fitted, key=lambda r: r[criterion])
+                    if best is None or level_best[criterion] < best[criterion]:
+                        best = level_best
+                        stale = 0
+                    else:
+                        stale += 1
+                else:
+                    stale += 1
+                if stale >= patience:
+                    break
+                # grow the models still in the running, once each
+                level = []
+                for record in fitted:
+                    if record[criterion] - best[criterion] < prune_delta:
+                        for counts in add_peak(
+                                {'n' + kind: record['n' + kind]
+                                 for kind in peak_kinds}, kinds):
+                            if counts not in level:
+                                level.append(counts)
+                if not level:
+                    break
+    except Cancelled:
+        return None
+    if best is None:
+        raise ValueError('No model could be fit!')
+    fits_df = pd.DataFrame(records)
+    fits_df.insert(0, 'model', [count_name(r) for r in records])
+    fits_df['delta_' + criterion] = fits_df[criterion] - best[criterion]
+    fits_df = fits_df.sort_values(criterion, na_position='last')
+    return ({'n' + kind: best['n' + kind] for kind in peak_kinds},
+            fits_df.reset_index(drop=True))
+
+
+def canonical(func, values):
+    '''
+        values with the peaks of each kind renumbered in order of
+        center, so minima that only differ by labels read the same
+    '''
+    packed = func.pack(values)
+    out = {}
+    for kind, comp_names in func.names.items():
+        p = packed[kind]
+        if kind != 'lin':
+            p = p[np.argsort(p[:, 1], kind='stable')]
+        for row, names in zip(p, comp_names):
+            out.update(zip(names, row))
+    return out
+
+
+def start_box(engine, params):
+    '''
+        Returns (lower, upper, log) arrays over params, the box starts
+        are drawn from, and whether to draw on a log scale
+
+        Finite bounds are used as they are. Otherwise centers span the
+        data (start_points() draws them where the signal is) and widths
+        run from a quarter of the narrowest guess to four times the
+        widest. Amplitudes and lines stay at their guesses;
+        start_points() sets the amplitudes from the data.
+    '''
+    x = np.sort(engine.x)
+    spacing = np.median(np.diff(x)) if len(x) > 1 else 1
+    sigmas = [par.value for name, par in params.items()
+              if name.endswith('_sigma') and par.value > 0]
+    narrow = max(min(sigmas, default=spacing)/width_range, spacing)
+    wide = max(max(sigmas, default=spacing)*width_range, narrow)
+    lower, upper, log = [], [], []
+    for name, par in params.items():
+        arg = name.split('_', 1)[1]
+        if name.startswith('lin') or arg == 'amplitude':
+            lo = hi = par.value
+        elif arg == 'center':
+            lo, hi = x[0], x[-1]
+        elif arg == 'sigma':
+            lo, hi = narrow, wide
+        else:
+            lo, hi = 0, 1
+        lo = par.min if np.isfinite(par.min) else lo
+        hi = par.max if np.isfinite(par.max) else hi
+        lower.append(lo)
+        upper.append(max(hi, lo))
+        log.append(arg == 'sigma' and lo > 0)
+    return np.array(lower), np.array(upper), np.array(log)
+
+
+def signal(engine, values):
+    '''
+        Returns (x, data above the baseline in values), sorted by x
+    '''
+    order = np.argsort(engine.x)
+    x, y = engine.x[order], engine.y[order]
+    baseline = sum(
+        values[prefix + 'slope']*x + values[prefix + 'intercept']
+        for prefix in engine.model.func.prefixes['lin']
+    )
+    return x, y - baseline
+
+
+def signal_quantiles(x, above, lower, upper, unit):
+    '''
+        Map unit (0..1) to x in lower..upper, in proportion to the
+        signal above the baseline
+    '''
+    inside = (x >= lower) & (x <= upper)
+    if inside.sum() < 2:
+        return lower + unit*(upper - lower)
+    x, weight = x[inside], np.clip(above[inside], 0, None)
+    weight = weight + signal_floor*(weight.mean() or 1)
+    cdf = np.concatenate([[0], np.cumsum((weight[1:] + weight[:-1])/2 *
+                                         np.diff(x))])
+    return np.interp(unit*cdf[-1], cdf, x)
+
+
+def match_heights(engine, start):
+    '''
+        Set the amplitude of every peak in start so its height is the
+        data above the baseline at its center
+    '''
+    x, above = signal(engine, start)
+    func = engine.model.func
+    floor = np.std(engine.y)/10 or np.finfo(float).eps
+    for kind in ['gau', 'lor', 'voi']:
+        for prefix in func.prefixes[kind]:
+            sigma = start[prefix + 'sigma']
+            height = max(np.interp(start[prefix + 'center'], x, above), floor)
+            if kind == 'gau':
+                unit = models.height_gau(1, sigma)
+            elif kind == 'lor':
+                unit = models.height_lor(1, sigma)
+            else:
+                unit = models.height_voi(1, sigma, start[prefix + 'fraction'])
+            start[prefix + 'amplitude'] = height/unit
+    return start
+
+
+def start_points(engine, params, nstarts, sampler='sobol', seed=None):
+    '''
+        nstarts {name: value} starting points spread over start_box(),
+        the first of which is params itself
+    '''
+    if sampler not in samplers:
+        raise ValueError('sampler must be one of {}'.format(samplers))
+    names = list(params)
+    lower, upper, log = start_box(engine, params)
+    if sampler == 'sobol':
+        draw = qmc.Sobol(len(names), seed=seed)
+    else:
+        draw = qmc.LatinHypercube(len(names), seed=seed)
+    with warnings.catch_warnings():
+        # sobol points are balanced for powers of two, but any n is fine
+        warnings.simplefilter('ignore')
+        unit = draw.random(max(nstarts - 1, 0))
+    lo = np.where(log, np.log(np.where(log, lower, 1)), lower)
+    hi = np.where(log, np.log(np.where(log, upper, 1)), upper)
+    points = lo + unit*(hi - lo)
+    points[:, log] = np.exp(points[:, log])
+    x, above = signal(engine, {name: par.value
+                               for name, par in params.items()})
+    for j, name in enumerate(names):
+        if name.endswith('_center'):
+            points[:, j] = signal_quantiles(x, above, lower[j], upper[j],
+                                            unit[:, j])
+    starts = [{name: par.value for name, par in params.items()}]
+    for point in points:
+        start = match_heights(engine, dict(zip(names, point)))
+        for name, par in params.items():
+            start[name] = float(np.clip(start[name], par.min, par.max))
+        starts.append(start)
+    return starts
+
+
+def fit_start(x, y, spec, params, start):
+    '''
+        One local fit from start. Runs in a worker process, so returns
+        a summary of the fit rather than the ModelResult.
+    '''
+    engine = FitEngine(x, y, **spec)
+    params = params.copy()
+    for name, value in start.items():
+        params[name].set(value=value)
+    engine.params = params
+    with warnings.catch_warnings():
+        # e.g. a peak that shrank to nothing leaves no sensible stderr
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result = engine.run()
+    return {
+        'chisqr': result.chisqr, 'redchi': result.redchi,
+        'bic': result.bic, 'nfev': result.nfev, 'success': result.success,
+        'values': canonical(engine.model.func, result.best_values),
+        'best_fit': result.best_fit,
+    }
+
+
+def merge_minima(fits, names):
+    '''
+        Returns a DataFrame of the distinct minima among fits, best
+        first, with how many starts reached each
+
+        Comparing curves rather than values also merges minima that
+        only differ along a direction the data can't see, like the
+        center of a peak that shrank to nothing.
+    '''
+    fits = sorted(fits, key=lambda fit: fit['chisqr'])
+    minima = []
+    for fit in fits:
+        for minimum in minima:
+            scale = max(minimum['chisqr'], np.finfo(float).tiny)
+            if abs(fit['chisqr'] - minimum['chisqr']) > same_chisqr*scale:
+                continue
+            diff = fit['best_fit'] - minimum['best_fit']
+            if np.mean(diff**2) <= same_curve**2*scale/len(diff):
+                minimum['starts'] += 1
+                break
+        else:
+            minima.append(dict(fit, starts=1))
+    rows = []
+    for minimum in minima:
+        row = {key: minimum[key] for key in
+               ['chisqr', 'redchi', 'bic', 'starts', 'success']}
+        row.update({name: minimum['values'][name] for name in names})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def multi_start(engine, nstarts=default_starts, sampler='sobol', seed=None,
+                params=None, workers=None, on_fit=None, cancel=None,
+                mp_context=None):
+    '''
+        Fit engine's model from nstarts points in parallel
+
+        The first start is params (by default the usual guesses and user
+        values from engine.set_params()), the rest are drawn by sampler
+        ('sobol' or 'lhs') within the bounds; see start_box().
+
+        Returns (params, minima_df): Parameters at the best minimum, to
+        fit from once more for a full result, and a DataFrame of the
+        distinct minima found, best first. Returns None if the cancel
+        event was set. on_fit(record) is called as each fit finishes,
+        including fits that fail (with a nan chisqr), which are left out
+        of minima_df.
+    '''
+    if params is None:
+        params = engine.set_params()
+    x, y = np.asarray(engine.x), np.asarray(engine.y)
+    if len(x) == 0:
+        raise ValueError('No data to fit!')
+    spec = engine_spec(engine)
+    starts = start_points(engine, params, nstarts, sampler, seed)
+    fits = []
+    try:
+        with process_pool(workers, mp_context) as pool:
+            futures = {pool.submit(fit_start, x, y, spec, params, start): i
+                       for i, start in enumerate(starts)}
+            for _, future in completed(futures, cancel):
+                try:
+                    record = future.result()
+                except Exception:
+                    record = {'chisqr': np.nan, 'redchi': np.nan,
+                              'bic': np.nan, 'nfev': 0, 'success': False}
+                fits.append(record)
+                if on_fit is not None:
+                    on_fit(record)
+    except Cancelled:
+        return None
+    fits = [fit for fit in fits if np.isfinite(fit['chisqr'])]
+    if not fits:
+        raise ValueError('No fit converged from any start!')
+    minima_df = merge_minima(fits, list(params))
+    best = params.copy()
+    for name in params:
+        best[name].set(value=minima_df[name][0])
+    return best, minima_df
+
+
+def multi_start_report(minima_df, nstarts, names=None):
+    '''
+        A [[Multi-start]] section for the output tab, tabulating the
+        distinct minima with the values of the parameters in names
+    '''
+    lines = ['[[Multi-start]]',
+             '    # starts   = {}'.format(nstarts),
+             '    # fit      = {}'.format(int(minima_df['starts'].sum())),
+             '    # minima   = {}'.format(len(minima_df))]
+    columns = ['chisqr', 'redchi', 'bic', 'starts'] + list(names or [])
+    table = minima_df[columns].to_string(index=False)
+    lines += ['    ' + line for line in table.splitlines()]
+    return '\n'.join(lines)
@@ -0,0 +1,124 @@
+'''
+    Read-only Gtk.TreeModel over a pandas DataFrame
+
+    Gtk.ListStore copies every cell into GTK before anything is shown.
+    DataFrameModel hands out rows by index instead and only formats a
+    cell when the TreeView asks for it, i.e. when it scrolls into view.
+    Setting the model on a TreeView still walks every row once, as the
+    view keeps a node per row, so that step grows with the table.
+
+    Rows can be appended a frame at a time, e.g. as a file is parsed,
+    without copying the ones already there. Views aren't told about
+    them row by row; they show them once the model is set on them
+    again.
+'''
+
+from bisect import bisect_right
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GObject
+
+
+def formatter(values):
+    '''
+        Returns a function that turns one value of the column into text
+    '''
+    kind = values.dtype.kind
+    if kind == 'f':
+        return lambda val: str(float(val))
+    if kind in 'iub':
+        return lambda val: str(val.item())
+    return str
+
+
+class DataFrameModel(GObject.Object, Gtk.TreeModel):
+
+    def __init__(self, df):
+        super().__init__()
+        # keep the column arrays, not the frame, so lookups are cheap
+        self.columns = [df.iloc[:, i].to_numpy() for i in range(df.shape[1])]
+        self.formatters = [formatter(values) for values in self.columns]
+        self.nrows = len(df)
+        # appended frames, as lists of column arrays, and their first rows
+        self.chunks = [self.columns]
+        self.starts = [0]
+        self.stamp = id(self) & 0x7fffffff
+
+    def append(self, df):
+        '''
+            Add the rows of df, which has the same columns, at the end,
+            without signalling them (see the module docstring)
+        '''
+        self.chunks.append(
+            [df.iloc[:, i].to_numpy() for i in range(df.shape[1])]
+        )
+        self.starts.append(self.nrows)
+        self.nrows += len(df)
+
+    def make_iter(self, row):
+        tree_iter = Gtk.TreeIter()
+        tree_iter.stamp = self.stamp
+        tree_iter.user_data = row
+        return tree_iter
+
+    def row(self, tree_iter):
+        # a row of 0 comes back as a null pointer
+        return tree_iter.user_data or 0
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.columns)
+
+    def do_get_column_type(self, index):
+        # every column is shown as text, whatever its dtype
+        return GObject.TYPE_STRING
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) == 1 and 0 <= indices[0] < self.nrows:
+            return True, self.make_iter(indices[0])
+        return False, None
+
+    def do_get_path(self, tree_iter):
+        return Gtk.TreePath.new_from_indices([self.row(tree_iter)])
+
+    def do_get_value(self, tree_iter, column):
+        row = self.row(tree_iter)
+        i = bisect_right(self.starts, row) - 1
+        value = self.chunks[i][column][row - self.starts[i]]
+        return self.formatters[column](value)
+
+    def do_iter_next(self, tree_iter):
+        row = self.row(tree_iter) + 1
+        if row < self.nrows:
+            tree_iter.user_data = row
+            return True, tree_iter
+        return False, None
+
+    def do_iter_previous(self, tree_iter):
+        row = self.row(tree_iter) - 1
+        if row >= 0:
+            tree_iter.user_data = row
+            return True, tree_iter
+        return False, None
+
+    def do_iter_children(self, parent):
+        if parent is None and self.nrows:
+            return True, self.make_iter(0)
+        return False, None
+
+    def do_iter_has_child(self, tree_iter):
+        return False
+
+    def do_iter_n_children(self, tree_iter):
+        return self.nrows if tree_iter is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < self.nrows:
+            return True, self.make_iter(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
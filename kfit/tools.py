@@ -3,17 +3,613 @@
     fitting, and visualization
 '''
 
+import os
+import json
+import numpy as np
 import pandas as pd
 
+# formats to_df can read, by file extension
+formats = {
+    '.csv': 'csv', '.txt': 'csv', '.tsv': 'csv', '.dat': 'csv',
+    '.npy': 'npy', '.npz': 'npz',
+    '.parquet': 'parquet', '.pq': 'parquet',
+    '.feather': 'feather', '.arrow': 'feather',
+    '.h5': 'hdf5', '.hdf5': 'hdf5', '.he5': 'hdf5',
+    '.raw': 'raw', '.bin': 'raw',
+}
+# and by the first bytes of the file, for unknown extensions
+magic = [
+    (b'\x93NUMPY', 'npy'),
+    (b'PK\x03\x04', 'npz'),
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'feather'),
+    (b'\x89HDF\r\n\x1a\n', 'hdf5'),
+]
+# a raw binary file is described by this file next to it, e.g.
+# scan.raw.json = {"dtype": "<f4", "columns": 2, "offset": 0,
+#                  "names": ["x", "y"]}
+raw_spec_ext = '.json'
+# rows parsed per piece when a text file is read in chunks, and written
+# per row group on export
+chunk_rows = 500000
+# bytes per piece for pyarrow's streaming csv reader, which splits by
+# size rather than rows
+chunk_bytes = 2**24
+# formats curves can be exported as, by file extension
+export_formats = {
+    '.csv': 'csv', '.parquet': 'parquet', '.h5': 'hdf5', '.hdf5': 'hdf5',
+    '.npz': 'npz',
+}
+export_ext = {'csv': '.csv', 'parquet': '.parquet', 'hdf5': '.h5',
+              'npz': '.npz'}
+# codec used for each format when compression=True
+default_compression = {
+    'csv': 'gzip', 'parquet': 'zstd', 'hdf5': 'gzip', 'npz': 'deflate',
+}
+# compressed csv files get these added to their names
+csv_compression_ext = {
+    'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zstd': '.zst', 'zip': '.zip',
+}
+raw_spec_msg = (
+    'Raw binary files need a spec: pass raw_spec or put a {} file next to '
+    'the data, e.g. {{"dtype": "<f4", "columns": 2}}'
+)
 
-def to_df(file_path, sep=',', header='infer', index_col=None, skiprows=None, dtype=None, encoding=None): 
+
+def detect_format(file_path):
+    '''
+        Returns one of the formats to_df can read, from the file
+        extension or, failing that, the first few bytes
+    '''
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in formats:
+        return formats[ext]
+    with open(file_path, 'rb') as f:
+        head = f.read(8)
+    for start, fmt in magic:
+        if head.startswith(start):
+            return fmt
+    return 'csv'
+
+
+def array_df(arr, names=None):
+    '''
+        DataFrame over the columns of a 1D or 2D array, without copying
+        it where pandas allows (e.g. a memmap stays a memmap)
+    '''
+    if arr.dtype.names:
+        return pd.DataFrame(
+            {name: arr[name] for name in arr.dtype.names}, copy=False
+        )
+    if arr.ndim == 1:
+        arr = arr[:, None]
+    if arr.ndim != 2:
+        raise ValueError('Expected a 1D or 2D array, got {}D'.format(arr.ndim))
+    if names is None:
+        names = [str(i) for i in range(arr.shape[1])]
+    return pd.DataFrame(arr, columns=names, copy=False)
+
+
+class H5Dataset():
+    '''
+        A chunked or compressed HDF5 dataset, read as it's indexed,
+        that keeps its file open until close() (or the end of a with
+        block)
+    '''
+
+    def __init__(self, h5, dset):
+        self.h5 = h5
+        self.dset = dset
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.ndim = dset.ndim
+
+    def __getitem__(self, key):
+        return self.dset[key]
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def close_array(arr):
+    '''
+        Close the file behind arr, if it holds one open
+    '''
+    if isinstance(arr, H5Dataset):
+        arr.close()
+
+
+def open_h5_dataset(file_path, dataset=None, ndim=None):
+    '''
+        Returns an HDF5 dataset as a read-only array, memory-mapped if
+        it's stored contiguously, or an H5Dataset if it's chunked or
+        compressed, which the caller closes (see close_array())
+
+        Without a dataset name, the first one with ndim dimensions (or
+        any) is used.
+    '''
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Reading HDF5 files needs h5py installed')
+    h5 = h5py.File(file_path, 'r')
+    try:
+        if dataset is None:
+            found = []
+            h5.visititems(
+                lambda name, obj: found.append(name)
+                if isinstance(obj, h5py.Dataset) and
+                (ndim is None or obj.ndim in np.atleast_1d(ndim)) else None
+            )
+            if not found:
+                raise ValueError('No suitable dataset in {}'.format(
+                    file_path
+                ))
+            dataset = found[0]
+        dset = h5[dataset]
+        offset = dset.id.get_offset()
+        if dset.chunks is not None or offset is None or \
+                not dset.dtype.isnative:
+            return H5Dataset(h5, dset)
+        arr = np.memmap(file_path, dtype=dset.dtype, mode='r',
+                        offset=offset, shape=dset.shape)
+    except BaseException:
+        h5.close()
+        raise
+    h5.close()
+    return arr
+
+
+def read_npy(file_path):
+    return array_df(np.load(file_path, mmap_mode='r'))
+
+
+def read_npz(file_path):
+    '''
+        A single array becomes the columns of the frame, several
+        same-length 1D arrays become one column each, named by key
+    '''
+    with np.load(file_path) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    if len(arrays) == 1:
+        return array_df(next(iter(arrays.values())))
+    return pd.DataFrame(arrays, copy=False)
+
+
+def arrow_reader(fmt):
+    try:
+        if fmt == 'parquet':
+            import pyarrow.parquet as reader
+        else:
+            import pyarrow.feather as reader
+    except ImportError:
+        raise ImportError('Reading {} files needs pyarrow installed'.format(
+            fmt
+        ))
+    return reader
+
+
+def arrow_names(file_path, fmt):
+    arrow_reader(fmt)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(file_path).names
+    import pyarrow.ipc as ipc
+    with ipc.open_file(file_path) as f:
+        return f.schema.names
+
+
+def read_arrow(file_path, fmt, columns=None):
+    '''
+        columns (names) are the only ones read, if given
+    '''
+    reader = arrow_reader(fmt)
+    # uncompressed feather files are mapped and not copied at all
+    table = reader.read_table(file_path, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def read_hdf5(file_path, dataset=None):
+    arr = open_h5_dataset(file_path, dataset=dataset, ndim=(1, 2))
+    if isinstance(arr, np.ndarray):
+        return array_df(arr)
+    with arr:
+        return array_df(arr[()])
+
+
+def read_raw(file_path, raw_spec=None):
+    '''
+        Raw little-endian (or any numpy dtype) values, row by row
+    '''
+    if raw_spec is None:
+        spec_path = file_path + raw_spec_ext
+        if not os.path.exists(spec_path):
+            raise ValueError(raw_spec_msg.format(spec_path))
+        with open(spec_path) as f:
+            raw_spec = json.load(f)
+    dtype = np.dtype(raw_spec.get('dtype', '<f8'))
+    ncols = int(raw_spec.get('columns', 2))
+    offset = int(raw_spec.get('offset', 0))
+    nrows = (os.path.getsize(file_path) - offset)//(dtype.itemsize*ncols)
+    arr = np.memmap(file_path, dtype=dtype, mode='r', offset=offset,
+                    shape=(nrows, ncols))
+    return array_df(arr, names=raw_spec.get('names'))
+
+
+def csv_engines():
+    '''
+        read_csv engines to try, fastest first; pyarrow turns down some
+        options (e.g. a regex sep), and the C engine takes those
+    '''
+    try:
+        import pyarrow  # noqa: F401
+        return ['pyarrow', 'c']
+    except ImportError:
+        return ['c']
+
+
+def csv_attempts(dtype=None):
+    '''
+        (engine, dtype) pairs to parse text columns with, in order:
+        floats (or dtype) with each engine, then inferred dtypes if no
+        dtype was asked for
+    '''
+    attempts = [(engine, dtype or float) for engine in csv_engines()]
+    if dtype is None:
+        attempts.append(('c', None))
+    return attempts
+
+
+def peek_columns(file_path, sep=',', header='infer', skiprows=None,
+                 encoding=None, fmt=None, dataset=None, raw_spec=None,
+                 **kws):
+    '''
+        Column names of a data file, reading no more of it than the
+        header (binary files are only mapped)
+    '''
+    if fmt is None:
+        fmt = detect_format(file_path)
+    if fmt in ['parquet', 'feather']:
+        return arrow_names(file_path, fmt)
+    if fmt != 'csv':
+        return list(to_df(file_path, fmt=fmt, dataset=dataset,
+                          raw_spec=raw_spec).columns)
+    return list(pd.read_csv(
+        file_path, sep=sep, header=header, skiprows=skiprows,
+        encoding=encoding, nrows=0
+    ).columns)
+
+
+def read_csv_columns(file_path, names, sep=',', header='infer',
+                     skiprows=None, dtype=None, encoding=None):
+    '''
+        Parse only the named columns of a text file, as floats unless
+        dtype says otherwise (or they aren't numbers)
+    '''
+    attempts = csv_attempts(dtype)
+    for i, (engine, col_dtype) in enumerate(attempts):
+        try:
+            return pd.read_csv(
+                file_path, sep=sep, header=header, skiprows=skiprows,
+                usecols=names, dtype=col_dtype, encoding=encoding,
+                engine=engine
+            )
+        except ValueError:
+            if i == len(attempts) - 1:
+                raise
+
+
+def project(names, usecols):
+    '''
+        Returns the names of the usecols columns in file order, and the
+        positions that put them back in usecols order
+    '''
+    # raises IndexError for a column that isn't there, like iloc
+    wanted = [names[i] for i in usecols]
+    unique = [name for name in names if name in wanted]
+    return unique, [unique.index(name) for name in wanted]
+
+
+def read_columns(file_path, usecols, fmt, **kws):
+    '''
+        The usecols columns of a file, in that order (an index may be
+        repeated)
+    '''
+    if fmt not in ['csv', 'parquet', 'feather']:
+        # mapped, so selecting columns costs nothing
+        df = to_df(file_path, fmt=fmt, dataset=kws.get('dataset'),
+                   raw_spec=kws.get('raw_spec'))
+        return df.iloc[:, usecols]
+    unique, order = project(peek_columns(file_path, fmt=fmt, **kws), usecols)
+    if fmt == 'csv':
+        csv_kws = {key: kws.get(key) for key in
+                   ['sep', 'header', 'skiprows', 'dtype', 'encoding']}
+        df = read_csv_columns(file_path, unique, **csv_kws)
+    else:
+        df = read_arrow(file_path, fmt, columns=unique)
+    return df.iloc[:, order]
+
+
+def arrow_csv_chunks(f, names, unique, sep=',', header='infer',
+                     skiprows=None, dtype=None, encoding=None):
+    '''
+        Frames of the unique columns of an open text file, a block at a
+        time, from pyarrow's streaming reader (pandas' pyarrow engine
+        can't read in chunks). Raises ValueError for settings it can't
+        take, as the pyarrow engine does.
     '''
-        Convert .csv file to dataframe using a few select
-        pandas.read_csv() parameters
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    if not isinstance(sep, str) or len(sep) != 1 or \
+            not (skiprows is None or isinstance(skiprows, int)) or \
+            not (header in ['infer', None] or isinstance(header, int)):
+        raise ValueError('Settings the pyarrow csv reader does not take')
+    # the names come from peek_columns, so skip the header row too
+    skip = (skiprows or 0) + (
+        0 if header is None else 1 if header == 'infer' else header + 1
+    )
+    keys = [str(name) for name in names]
+    wanted = [str(name) for name in unique]
+    types = {}
+    if dtype is not None:
+        try:
+            types = {key: pa.from_numpy_dtype(np.dtype(dtype))
+                     for key in wanted}
+        except (TypeError, pa.ArrowNotImplementedError):
+            raise ValueError('dtype {} is not a single numpy dtype'.format(
+                dtype
+            ))
+    reader = pa_csv.open_csv(
+        f,
+        read_options=pa_csv.ReadOptions(
+            skip_rows=skip, column_names=keys, block_size=chunk_bytes,
+            encoding=encoding or 'utf8'
+        ),
+        parse_options=pa_csv.ParseOptions(delimiter=sep),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=wanted, column_types=types
+        )
+    )
+    for batch in reader:
+        chunk = batch.to_pandas()
+        chunk.columns = unique
+        yield chunk
+
+
+def pandas_csv_chunks(f, unique, sep=',', header='infer', skiprows=None,
+                      dtype=None, encoding=None, rows=chunk_rows):
+    '''
+        Frames of the unique columns of an open text file, rows at a
+        time, from the C engine
+    '''
+    reader = pd.read_csv(
+        f, sep=sep, header=header, skiprows=skiprows, usecols=unique,
+        dtype=dtype, encoding=encoding, engine='c', chunksize=rows
+    )
+    with reader:
+        yield from reader
+
+
+def read_csv_chunks(file_path, usecols, sep=',', header='infer',
+                    skiprows=None, dtype=None, encoding=None,
+                    rows=chunk_rows):
+    '''
+        Yields (frame, bytes read, file size) for successive pieces of
+        a text file, parsing only the usecols columns (in that order)
+
+        The engines and dtypes are tried as in read_csv_columns(), on
+        the first piece; the rest of the file is read the same way, so
+        every piece has the same dtypes (a later piece that doesn't
+        parse as them raises ValueError).
+    '''
+    names = peek_columns(file_path, sep=sep, header=header,
+                         skiprows=skiprows, encoding=encoding, fmt='csv')
+    unique, order = project(names, usecols)
+    size = os.path.getsize(file_path)
+    csv_kws = {'sep': sep, 'header': header, 'skiprows': skiprows,
+               'encoding': encoding}
+    # read through our own handle, so its position tells how far we are
+    with open(file_path, 'rb') as f:
+        attempts = csv_attempts(dtype)
+        for i, (engine, col_dtype) in enumerate(attempts):
+            f.seek(0)
+            if engine == 'pyarrow':
+                chunks = arrow_csv_chunks(f, names, unique, dtype=col_dtype,
+                                          **csv_kws)
+            else:
+                chunks = pandas_csv_chunks(f, unique, dtype=col_dtype,
+                                           rows=rows, **csv_kws)
+            try:
+                first = next(chunks, None)
+            except ValueError:
+                if i == len(attempts) - 1:
+                    raise
+                continue
+            break
+        if first is None:
+            return
+        yield first.iloc[:, order], f.tell(), size
+        for chunk in chunks:
+            yield chunk.iloc[:, order], f.tell(), size
+
+
+def to_df(file_path, sep=',', header='infer', index_col=None,
+          skiprows=None, dtype=None, encoding=None, fmt=None, dataset=None,
+          raw_spec=None, usecols=None):
     '''
+        Load a data file as a dataframe
+
+        Text files go through pandas.read_csv() with a few select
+        parameters. .npy, raw binary, contiguous HDF5 and feather
+        files are memory-mapped rather than read, so they open in about
+        the same time whatever their size. fmt overrides detection
+        (see formats), dataset picks an HDF5 dataset and raw_spec
+        describes a raw binary file.
+
+        usecols (column indices, in the order wanted) projects the file
+        down to those columns: text and parquet files then only parse
+        them, with the pyarrow engine if it's installed, and index_col
+        is ignored.
+    '''
+    if fmt is None:
+        fmt = detect_format(file_path)
+    if usecols is not None:
+        return read_columns(
+            file_path, list(usecols), sep=sep, header=header,
+            skiprows=skiprows, dtype=dtype, encoding=encoding, fmt=fmt,
+            dataset=dataset, raw_spec=raw_spec
+        )
+    if fmt == 'npy':
+        return read_npy(file_path)
+    if fmt == 'npz':
+        return read_npz(file_path)
+    if fmt in ['parquet', 'feather']:
+        return read_arrow(file_path, fmt)
+    if fmt == 'hdf5':
+        return read_hdf5(file_path, dataset=dataset)
+    if fmt == 'raw':
+        return read_raw(file_path, raw_spec=raw_spec)
     df = pd.read_csv(
         file_path, sep=sep, header=header,
-        index_col=index_col, skiprows=skiprows, 
+        index_col=index_col, skiprows=skiprows,
         dtype=dtype, encoding=encoding
     )
     return df
+
+
+def export_format(file_path):
+    '''
+        Returns the export format for file_path's extension, or None;
+        a compressed csv (e.g. .csv.gz) counts as csv
+    '''
+    root, ext = os.path.splitext(file_path.lower())
+    if ext in csv_compression_ext.values():
+        ext = os.path.splitext(root)[1]
+    return export_formats.get(ext)
+
+
+def export_stem(file_path):
+    '''
+        file_path without its export extension(s), e.g. for naming the
+        .params.csv that goes with it
+    '''
+    root, ext = os.path.splitext(file_path)
+    if ext.lower() in csv_compression_ext.values():
+        root, ext = os.path.splitext(root)
+    return root if ext.lower() in export_formats else file_path
+
+
+def export_table(df, float32=False):
+    '''
+        df with its index (x) as the first column, and the float columns
+        after it as float32 if asked
+    '''
+    table = df.reset_index()
+    if table.columns[0] == 'index' and df.index.name is None:
+        table = table.rename(columns={'index': 'x'})
+    table.columns = [str(col) for col in table.columns]
+    if float32:
+        for col in table.columns[1:]:
+            if table[col].dtype.kind == 'f':
+                table[col] = table[col].astype(np.float32)
+    return table
+
+
+def row_groups(nrows, rows):
+    return [(start, min(start + rows, nrows))
+            for start in range(0, max(nrows, 1), rows)]
+
+
+def write_parquet(table, file_path, compression, rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing parquet files needs pyarrow installed')
+    writer = None
+    try:
+        for start, stop in row_groups(len(table), rows):
+            group = pa.Table.from_pandas(
+                table.iloc[start:stop], preserve_index=False
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    file_path, group.schema, compression=compression or 'none'
+                )
+            writer.write_table(group)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_hdf5(table, file_path, compression, rows):
+    '''
+        One compound dataset, 'curves', with a field per column, so
+        read_hdf5 gets the names back and x keeps its own dtype
+    '''
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Writing HDF5 files needs h5py installed')
+    dtype = np.dtype([(col, table[col].dtype) for col in table.columns])
+    with h5py.File(file_path, 'w') as h5:
+        dset = h5.create_dataset(
+            'curves', shape=(len(table),), dtype=dtype,
+            chunks=(max(min(rows, len(table)), 1),) if compression else None,
+            compression=compression or None
+        )
+        for start, stop in row_groups(len(table), rows):
+            group = np.empty(stop - start, dtype=dtype)
+            for col in table.columns:
+                group[col] = table[col].to_numpy()[start:stop]
+            dset[start:stop] = group
+
+
+def write_curves(df, file_path, fmt=None, compression=None, float32=False,
+                 rows=chunk_rows):
+    '''
+        Write df (the curves from FitEngine.process_results()) to
+        file_path a row group at a time, so no format needs more than
+        one group's worth of text or buffers at once
+
+        fmt defaults to the format of the extension (see
+        export_formats), or csv. compression is a codec name for the
+        format, or True for its default_compression. float32 stores
+        every float column but x as float32, which halves the size for
+        more digits than the fit gives anyway. Binary formats store x
+        as their first column, so the file imports straight back into
+        kfit. Returns the path written, which for compressed csv gets
+        the codec's extension.
+    '''
+    if fmt is None:
+        fmt = export_format(file_path) or 'csv'
+    if compression is True:
+        compression = default_compression[fmt]
+    if fmt == 'csv':
+        ext = csv_compression_ext.get(compression, '')
+        if compression and not file_path.endswith(ext):
+            file_path += ext
+        out = df.astype(np.float32) if float32 else df
+        # to_csv formats and writes rows a chunk at a time
+        out.to_csv(file_path, chunksize=rows, compression=compression)
+        return file_path
+    table = export_table(df, float32=float32)
+    if fmt == 'parquet':
+        write_parquet(table, file_path, compression, rows)
+    elif fmt == 'hdf5':
+        write_hdf5(table, file_path, compression, rows)
+    elif fmt == 'npz':
+        save = np.savez_compressed if compression else np.savez
+        # zip members are streamed out an array at a time
+        if not file_path.endswith('.npz'):
+            file_path += '.npz'  # numpy would add it anyway
+        save(file_path, **{col: table[col].to_numpy() for col in table})
+    else:
+        raise ValueError('Unknown export format {!r}'.format(fmt))
+    return file_path
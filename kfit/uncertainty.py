@@ -0,0 +1,595 @@
+'''
+    Parameter uncertainties beyond the covariance estimate
+
+    The stderr lmfit reports comes from the curvature at the best fit,
+    which is unreliable for overlapping peaks whose parameters trade
+    off against each other. bootstrap refits the model to resampled
+    data on a process pool: each sample is the best fit plus the
+    residuals drawn again with replacement, fit starting from the best
+    values. Percentiles of the refit values give an interval for every
+    parameter and for the height and fwhm of every peak.
+
+    conf_intervals profiles the likelihood like lmfit's conf_interval:
+    each parameter is fixed at values further and further from its best
+    value, the rest are refit, and an F-test against the best fit gives
+    where the 1, 2 and 3 sigma bounds lie. lmfit scans the parameters
+    one at a time; here every parameter and direction is scanned in a
+    worker process of its own.
+
+    sample_posterior runs emcee (if installed) from the best fit, with
+    the walkers spread over worker processes. Flat priors within each
+    parameter's bounds and a noise level sampled along with the rest,
+    as lmfit's emcee does by default. The chain is appended to a .npy
+    file a block of steps at a time, so a run that is stopped can be
+    picked up again, and summary statistics are passed back after every
+    block.
+'''
+
+import os
+import json
+import warnings
+from types import SimpleNamespace
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+from lmfit.confidence import ConfidenceInterval
+try:
+    from . import models
+    from .engine import FitEngine, engine_spec, result_data
+    from .parallel import Cancelled, completed, is_cancelled, process_pool
+except ImportError:
+    import models
+    from engine import FitEngine, engine_spec, result_data
+    from parallel import Cancelled, completed, is_cancelled, process_pool
+
+default_samples = 200
+# fraction of the samples inside each interval
+default_level = 0.95
+# batches of refits per worker, so progress arrives steadily
+batches_per_worker = 4
+no_result_msg = 'Fit the data before estimating uncertainties!'
+no_stderr_msg = (
+    'The fit has no standard errors to start the confidence intervals from'
+)
+default_sigmas = [1, 2, 3]
+default_steps = 1000
+default_walkers = 32
+# steps between saving the chain and reporting its statistics
+default_block = 100
+# the first part of the chain is dropped from statistics as burn-in
+burn_fraction = 0.5
+# most steps of the chain read back for statistics
+stats_steps = 2000
+# sampled along with the model parameters, named as lmfit does
+noise_name = '__lnsigma'
+chain_resume_msg = (
+    '{} holds a chain for a different model; pick another file or delete '
+    'it to start over'
+)
+
+
+def refit_samples(spec, x, fitted, resid, params, seeds):
+    '''
+        Fit one resample per seed, starting from params. Runs in a
+        worker process. Returns [{name: value}] for the fits that
+        succeed, with the height and fwhm of every peak.
+    '''
+    engine = FitEngine(x, fitted, **spec)
+    samples = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        engine.y = fitted + rng.choice(resid, size=len(resid))
+        engine.params = params.copy()
+        try:
+            result = engine.run()
+        except Exception:
+            continue  # counted as a failed sample
+        values = dict(result.best_values)
+        values.update(models.peak_shapes(values))
+        samples.append(values)
+    return samples
+
+
+def split(items, nbatches):
+    return [batch for batch in np.array_split(np.array(items, dtype=object),
+                                              nbatches) if len(batch)]
+
+
+def bootstrap(engine, nsamples=default_samples, level=default_level,
+              seed=None, workers=None, on_progress=None, cancel=None,
+              mp_context=None):
+    '''
+        Returns (intervals_df, samples_df) for engine's latest result,
+        or None if the cancel event was set
+
+        intervals_df has a row per parameter and peak height/fwhm with
+        the best value, the covariance stderr (nan for heights and
+        fwhms), the bounds of the central `level` interval and the
+        spread of the samples. samples_df has a row per refit that
+        succeeded. on_progress(done, nsamples) is called as each batch
+        of refits finishes.
+    '''
+    result = engine.result
+    if result is None:
+        raise ValueError(no_result_msg)
+    x, data = result_data(result)
+    fitted = np.asarray(result.best_fit, dtype=float)
+    resid = data - fitted
+    spec = engine_spec(engine)
+    workers = workers or os.cpu_count() or 1
+    seeds = np.random.SeedSequence(seed).spawn(nsamples)
+    samples = []
+    done = 0
+    try:
+        with process_pool(workers, mp_context) as pool:
+            futures = {
+                pool.submit(refit_samples, spec, x, fitted, resid,
+                            result.params, list(batch)): len(batch)
+                for batch in split(seeds, workers*batches_per_worker)
+            }
+            for nbatch, future in completed(futures, cancel):
+                samples += future.result()
+                done += nbatch
+                if on_progress is not None:
+                    on_progress(done, nsamples)
+    except Cancelled:
+        return None
+
+    best = dict(result.best_values)
+    best.update(models.peak_shapes(best))
+    samples_df = pd.DataFrame(samples, columns=list(best))
+    tail = 50*(1 - level)
+    lower, upper = np.nanpercentile(
+        samples_df.to_numpy(dtype=float), [tail, 100 - tail], axis=0
+    ) if len(samples_df) else (np.nan, np.nan)
+    intervals_df = pd.DataFrame({
+        'best': best,
+        'stderr': {name: result.params[name].stderr
+                   if name in result.params else np.nan for name in best},
+        'lower': pd.Series(lower, index=list(best)),
+        'upper': pd.Series(upper, index=list(best)),
+        'std': samples_df.std(),
+    }).astype(float)
+    intervals_df.index.name = 'parameter'
+    return intervals_df, samples_df
+
+
+def bootstrap_report(intervals_df, nfit, nsamples, level=default_level):
+    '''
+        A [[Bootstrap]] section for the output tab: how many refits
+        succeeded, then each parameter's best value and interval
+    '''
+    lines = ['[[Bootstrap]]',
+             '    # samples fit = {} of {}'.format(nfit, nsamples),
+             '    interval      = {:g}%'.format(100*level)]
+    width = max([len(name) for name in intervals_df.index] + [0])
+    for name, row in intervals_df.iterrows():
+        lines.append('    {} {:.8g} [{:.8g}, {:.8g}]'.format(
+            (name + ':').ljust(width + 2), row['best'], row['lower'],
+            row['upper']
+        ))
+    return '\n'.join(lines)
+
+
+class ProfileScan(ConfidenceInterval):
+    '''
+        lmfit's ConfidenceInterval, with each probe refit straight with
+        scipy's least_squares and the model's analytic jacobian, starting
+        from the probe closest to it that was already fit
+
+        lmfit refits through a fresh Minimizer, which deep-copies the
+        parameters every time and costs more than the refit itself.
+        Every refit is kept, so the root finding never repeats one the
+        search for the limit already did.
+
+        The bounds agree with lmfit's to within its root finding
+        tolerance (rtol 5e-5), not exactly, since the warm starts stop
+        at slightly different points. Where the profile is flat, e.g.
+        the 3 sigma bound of a barely resolved peak, the two can land
+        in different minima. benchmarks/bench_ci.py compares them.
+    '''
+
+    def __init__(self, model, x, y, best, name, sigmas=default_sigmas):
+        super().__init__(None, best, p_names=[name], sigmas=sigmas)
+        self.func = model.func
+        self.x, self.y = x, y
+        self.varying = [par_name for par_name in self.func.param_names
+                        if best.params[par_name].vary]
+        # {value: (probability, refit values)}
+        self.refits = {}
+
+    def refit(self, name, val, start):
+        '''
+            Returns (chisqr, values) with name fixed at val
+        '''
+        values = dict(start)
+        values[name] = val
+        free = [par_name for par_name in self.varying if par_name != name]
+        cols = [self.func.param_names.index(par_name) for par_name in free]
+        params = self.params
+        lower = np.array([params[par_name].min for par_name in free])
+        upper = np.array([params[par_name].max for par_name in free])
+        p0 = np.clip([values[par_name] for par_name in free], lower, upper)
+
+        def resid(p):
+            values.update(zip(free, p))
+            return self.func(self.x, **values) - self.y
+
+        def jac(p):
+            values.update(zip(free, p))
+            if self.func.window is None:
+                return self.func.jacobian(self.x, **values)[cols].T
+            return self.func.sparse_jacobian(self.x, **values)[:, cols]
+
+        kws = {'x_scale': 'jac'}
+        if self.func.window is not None:
+            kws['tr_solver'] = 'lsmr'
+        sol = least_squares(resid, p0, jac=jac, bounds=(lower, upper), **kws)
+        values.update(zip(free, sol.x))
+        return 2*sol.cost, values
+
+    def calc_prob(self, para, val, offset=0., restore=False):
+        val = float(val)
+        if val not in self.refits:
+            start = self.org_values
+            if self.refits:
+                nearest = min(self.refits, key=lambda done: abs(done - val))
+                start = self.refits[nearest][1]
+            chisqr, values = self.refit(para.name, val, start)
+            probe = SimpleNamespace(chisqr=chisqr,
+                                    nvarys=len(self.varying) - 1)
+            self.refits[val] = (self.prob_func(self.result, probe), values)
+        return self.refits[val][0] - offset
+
+    @property
+    def org_values(self):
+        return {name: self.org[name][0] for name in self.func.param_names}
+
+
+def profile_parameter(spec, x, y, best, name, direction,
+                      sigmas=default_sigmas):
+    '''
+        Scan one parameter in one direction (1 or -1). Runs in a worker
+        process. best holds the params, chisqr, nvarys and nfree of the
+        best fit. Returns [(probability, value)] for each of sigmas.
+    '''
+    model = FitEngine(**spec).model
+    scan = ProfileScan(model, x, y, SimpleNamespace(**best), name, sigmas)
+    with warnings.catch_warnings():
+        # lmfit warns when a bound stops the scan; that interval is inf
+        warnings.simplefilter('ignore')
+        return scan.calc_ci(name, direction)
+
+
+def conf_intervals(engine, names=None, sigmas=default_sigmas, workers=None,
+                   on_interval=None, cancel=None, mp_context=None):
+    '''
+        Returns {name: [(probability, value)]} for engine's latest
+        result, in the format of lmfit's conf_interval (so
+        lmfit.printfuncs.ci_report can show it), or None if the cancel
+        event was set
+
+        names defaults to every parameter that was varied.
+        on_interval(name, rows) is called as each parameter finishes.
+    '''
+    result = engine.result
+    if result is None:
+        raise ValueError(no_result_msg)
+    params = result.params
+    if names is None:
+        names = [name for name, par in params.items() if par.vary]
+    if any(params[name].stderr is None or not np.isfinite(params[name].stderr)
+           for name in names):
+        raise ValueError(no_stderr_msg)
+    x, y = result_data(result)
+    spec = engine_spec(engine)
+    best = {'params': params, 'chisqr': result.chisqr,
+            'nvarys': result.nvarys, 'nfree': result.nfree}
+    scans = {}
+    out = {}
+    try:
+        with process_pool(workers, mp_context) as pool:
+            futures = {
+                pool.submit(profile_parameter, spec, x, y, best, name,
+                            direction, sigmas): (name, direction)
+                for name in names for direction in [-1, 1]
+            }
+            for (name, direction), future in completed(futures, cancel):
+                scans[name, direction] = future.result()
+                if (name, -direction) in scans:
+                    out[name] = scans[name, -1][::-1] + \
+                        [(0., params[name].value)] + scans[name, 1]
+                    if on_interval is not None:
+                        on_interval(name, out[name])
+    except Cancelled:
+        return None
+    # same order as the parameters
+    return {name: out[name] for name in names}
+
+
+class Posterior():
+    '''
+        log posterior of the model parameters and the log of the noise
+        level, with flat priors within the parameter bounds
+    '''
+
+    def __init__(self, spec, x, y, params):
+        self.func = FitEngine(**spec).model.func
+        self.x, self.y = x, y
+        self.values = {name: params[name].value
+                       for name in self.func.param_names}
+        self.names = [name for name in self.func.param_names
+                      if params[name].vary]
+        self.lower = np.array([params[name].min for name in self.names])
+        self.upper = np.array([params[name].max for name in self.names])
+
+    def __call__(self, theta):
+        p, lnsigma = theta[:-1], theta[-1]
+        if np.any(p < self.lower) or np.any(p > self.upper):
+            return -np.inf
+        values = dict(self.values)
+        values.update(zip(self.names, p))
+        resid = self.func(self.x, **values) - self.y
+        chisqr = np.sum(resid**2)
+        if not np.isfinite(chisqr):
+            return -np.inf
+        return -0.5*chisqr*np.exp(-2*lnsigma) - len(resid)*lnsigma
+
+
+# set in each worker process by init_posterior, so the data is sent
+# once per worker rather than with every walker
+posterior = None
+
+
+def init_posterior(spec, x, y, params):
+    global posterior
+    posterior = Posterior(spec, x, y, params)
+
+
+def log_posterior(theta):
+    return posterior(theta)
+
+
+class ChunkedPool():
+    '''
+        Gives emcee a map that sends each worker one batch of walkers,
+        rather than one walker per message
+    '''
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.workers = workers
+
+    def map(self, func, items):
+        items = list(items)
+        chunk = max(-(-len(items)//self.workers), 1)
+        return self.pool.map(func, items, chunksize=chunk)
+
+
+class ChainFile():
+    '''
+        An emcee chain on disk: a (steps, walkers, params + 1) .npy
+        array of every walker's position and log posterior, and a .json
+        file next to it with the parameter names, how many steps are
+        filled in and how many moves each walker has accepted
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.splitext(path)[0] + '.json'
+        self.meta = None
+        self.chain = None
+
+    def open(self, info, nwalkers, steps):
+        '''
+            Open the chain for the model described by info, with room
+            for `steps` more steps. Returns the number of steps already
+            filled in (0 for a new chain).
+        '''
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if meta['info'] != info or meta['nwalkers'] != nwalkers:
+                raise ValueError(chain_resume_msg.format(self.path))
+            self.meta = meta
+            self.chain = np.load(self.path, mmap_mode='r+')
+        else:
+            self.meta = {'info': info, 'nwalkers': nwalkers, 'steps': 0,
+                         'accepted': [0]*nwalkers}
+            self.chain = None
+        done = self.meta['steps']
+        if self.chain is None or len(self.chain) < done + steps:
+            self.grow(done + steps, nwalkers, len(info['names']) + 1)
+        return done
+
+    def grow(self, total, nwalkers, width):
+        '''
+            Copy the steps so far into a new file with room for total
+        '''
+        tmp_path = '{}.tmp{}.npy'.format(self.path, os.getpid())
+        chain = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=float, shape=(total, nwalkers, width)
+        )
+        done = self.meta['steps']
+        if done:
+            chain[:done] = self.chain[:done]
+        chain.flush()
+        del chain
+        self.chain = None
+        os.replace(tmp_path, self.path)
+        self.chain = np.load(self.path, mmap_mode='r+')
+
+    def append(self, positions, log_prob, accepted):
+        '''
+            Add (steps, walkers, params) positions and their (steps,
+            walkers) log posterior, and the moves accepted over them
+        '''
+        done = self.meta['steps']
+        steps = len(positions)
+        self.chain[done:done + steps, :, :-1] = positions
+        self.chain[done:done + steps, :, -1] = log_prob
+        self.chain.flush()
+        self.meta['steps'] = done + steps
+        self.meta['accepted'] = [
+            int(before + now) for before, now in
+            zip(self.meta['accepted'], accepted)
+        ]
+        # written last, so a crash never counts steps that weren't saved
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+    def samples(self):
+        '''
+            (steps, walkers, params) positions after burn-in, thinned to
+            at most stats_steps steps
+        '''
+        done = self.meta['steps']
+        start = int(done*burn_fraction)
+        thin = max((done - start)//stats_steps, 1)
+        return np.asarray(self.chain[start:done:thin, :, :-1])
+
+    def last(self):
+        return np.array(self.chain[self.meta['steps'] - 1, :, :-1])
+
+
+def chain_stats(chain_file):
+    '''
+        Returns (stats_df, summary): the median, 16% and 84% quantiles
+        and autocorrelation time of every parameter after burn-in, and
+        {'steps', 'acceptance', 'tau'} for the whole chain
+    '''
+    import emcee
+    names = chain_file.meta['info']['names']
+    samples = chain_file.samples()
+    flat = samples.reshape(-1, samples.shape[-1])
+    lower, median, upper = np.percentile(flat, [15.87, 50, 84.13], axis=0)
+    # tol=0 skips emcee's check that the chain is long enough; a short
+    # chain still gives a rough estimate, which is shown as such
+    tau = emcee.autocorr.integrated_time(samples, tol=0)
+    thin = max((chain_file.meta['steps'] -
+                int(chain_file.meta['steps']*burn_fraction))//stats_steps, 1)
+    stats_df = pd.DataFrame({
+        'median': median, 'lower': lower, 'upper': upper, 'tau': tau*thin,
+    }, index=pd.Index(names, name='parameter'))
+    steps = chain_file.meta['steps']
+    summary = {
+        'steps': steps,
+        'acceptance': float(np.mean(chain_file.meta['accepted']))/steps,
+        'tau': float(np.nanmax(stats_df['tau'])),
+    }
+    return stats_df, summary
+
+
+def sample_posterior(engine, chain_path, steps=default_steps, nwalkers=None,
+                     block=default_block, workers=None, seed=None,
+                     on_block=None, cancel=None, mp_context=None):
+    '''
+        Run emcee from engine's latest result for `steps` more steps,
+        saving the chain to chain_path (a .npy file) and continuing the
+        chain already there if it is for the same model
+
+        New walkers start in a small ball around the best values.
+        on_block(stats_df, summary) is called with chain_stats() after
+        every block of steps. Returns the last chain_stats(), or None
+        if the cancel event was set; the steps taken before that are
+        kept in the file either way.
+    '''
+    try:
+        import emcee
+    except ImportError:
+        raise ImportError('Posterior sampling needs emcee installed')
+    result = engine.result
+    if result is None:
+        raise ValueError(no_result_msg)
+    if steps < 1:
+        raise ValueError('steps must be at least 1')
+    x, y = result_data(result)
+    params = result.params
+    spec = engine_spec(engine)
+    model = Posterior(spec, x, y, params)
+    names = model.names + [noise_name]
+    ndim = len(names)
+    nwalkers = nwalkers or max(default_walkers, 2*ndim + 2)
+    info = {'names': names, 'spec': spec, 'ndata': len(x),
+            'x': [float(x[0]), float(x[-1])]}
+    chain_file = ChainFile(chain_path)
+    done = chain_file.open(info, nwalkers, steps)
+
+    rng = np.random.default_rng(seed)
+    if done:
+        start = chain_file.last()
+    else:
+        best = np.array([params[name].value for name in model.names] +
+                        [np.log(max(np.std(result.data - result.best_fit),
+                                    np.finfo(float).tiny))])
+        scale = np.array([
+            params[name].stderr if params[name].stderr else
+            1e-4*max(abs(params[name].value), 1)
+            for name in model.names
+        ] + [1e-2])
+        start = best + 1e-2*scale*rng.standard_normal((nwalkers, ndim))
+        start[:, :-1] = np.clip(start[:, :-1], model.lower, model.upper)
+
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    log_prob = model
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(process_pool(
+                workers, mp_context, initializer=init_posterior,
+                initargs=(spec, x, y, params)
+            ))
+            log_prob = log_posterior
+        sampler = emcee.EnsembleSampler(
+            nwalkers, ndim, log_prob,
+            pool=None if pool is None else ChunkedPool(pool, workers)
+        )
+        # emcee keeps its own RandomState, so seed it from rng too
+        sampler.random_state = np.random.RandomState(
+            rng.integers(2**32)
+        ).get_state()
+        left = steps
+        while left > 0:
+            cancelled = False
+            for state in sampler.sample(start, iterations=min(block, left)):
+                if is_cancelled(cancel):
+                    cancelled = True
+                    break
+            taken = sampler.iteration
+            if taken:
+                chain_file.append(
+                    sampler.get_chain(), sampler.get_log_prob(),
+                    sampler.backend.accepted
+                )
+                start = sampler.get_last_sample()
+                sampler.reset()
+            if cancelled:
+                return None
+            left -= taken
+            stats = chain_stats(chain_file)
+            if on_block is not None:
+                on_block(*stats)
+    return stats
+
+
+def mcmc_report(stats_df, summary):
+    '''
+        An [[MCMC]] section for the output tab: the chain's length,
+        acceptance and autocorrelation time, then each parameter's
+        median and credible interval
+    '''
+    lines = ['[[MCMC]]',
+             '    # steps    = {}'.format(summary['steps']),
+             '    acceptance = {:.3f}'.format(summary['acceptance']),
+             '    max tau    = {:.1f} steps'.format(summary['tau'])]
+    width = max(len(name) for name in stats_df.index)
+    for name, row in stats_df.iterrows():
+        lines.append('    {} {:.8g} -{:.3g} +{:.3g} (tau {:.0f})'.format(
+            (name + ':').ljust(width + 2), row['median'],
+            row['median'] - row['lower'], row['upper'] - row['median'],
+            row['tau']
+        ))
+    return '\n'.join(lines)
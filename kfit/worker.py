@@ -0,0 +1,80 @@
+'''
+    Run long jobs (fits, imports, ...) off the GTK main loop
+'''
+
+import threading
+
+
+class Worker():
+    '''
+        Runs one job at a time on a daemon thread and hands its
+        progress, result or error back through `dispatch`, which the
+        GUI sets to GLib.idle_add so callbacks run on the main loop.
+
+        Starting a new job supersedes the running one: the old job is
+        asked to stop through its cancel event, and anything it sends
+        back afterwards is dropped as stale.
+    '''
+
+    def __init__(self, dispatch=None):
+        if dispatch is None:
+            dispatch = self._call
+        self.dispatch = dispatch
+        self.job_id = 0
+        self.running = False
+        self.cancel_event = None
+
+    def start(self, job, on_done, on_error=None, on_progress=None):
+        '''
+            Run job(progress, cancel) on a new thread
+
+            `progress` forwards its arguments to on_progress, `cancel`
+            is a threading.Event the job should poll to stop early.
+            Returns the id of the new job.
+        '''
+        self.cancel()
+        self.job_id += 1
+        job_id = self.job_id
+        cancel = threading.Event()
+        self.cancel_event = cancel
+        self.running = True
+
+        def progress(*args):
+            if not cancel.is_set():
+                self.dispatch(self._deliver, job_id, on_progress, False, *args)
+
+        def run():
+            try:
+                out = job(progress, cancel)
+            except Exception as e:
+                self.dispatch(self._deliver, job_id, on_error, True, e)
+            else:
+                self.dispatch(self._deliver, job_id, on_done, True, out)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return job_id
+
+    def cancel(self):
+        '''
+            Stop the running job and drop anything it still sends back
+        '''
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_event = None
+        self.job_id += 1
+        self.running = False
+
+    def _deliver(self, job_id, callback, finished, *args):
+        # runs on the main loop, so job_id can't change underneath us
+        if job_id == self.job_id:
+            if finished:
+                self.running = False
+                self.cancel_event = None
+            if callback is not None:
+                callback(*args)
+        return False  # don't repeat when used with GLib.idle_add
+
+    @staticmethod
+    def _call(func, *args):
+        func(*args)
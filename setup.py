@@ -15,6 +15,11 @@ setup(
         data_files=[
             (prime, ['kfit.desktop', 'images/kfit_v2.svg']),
             (app_dir, ['kfit/kfit.py', 'kfit/models.py', 'kfit/tools.py',
+                       'kfit/worker.py', 'kfit/engine.py',
+                       'kfit/batch.py', 'kfit/cube.py', 'kfit/table.py',
+                       'kfit/plotting.py', 'kfit/cache.py',
+                       'kfit/search.py', 'kfit/parallel.py',
+                       'kfit/uncertainty.py',
                        'kfit/kfit.glade', 'kfit/kfit.mplstyle',
                        'kfit/custom_backend_gtk3.py']),
             (image_dir, ['images/kfit_v2.svg',
@@ -28,12 +33,21 @@ setup(
                          'images/dialog-question-symbolic.svg'])
         ],
         packages=find_packages(),
+        entry_points={
+            'console_scripts': ['kfit-batch=kfit.batch:main',
+                                'kfit-map=kfit.cube:main'],
+        },
         install_requires=[
             'numpy',
             'matplotlib',
             'pandas',
+            'scipy>=1.7',
             'lmfit',
             'pycairo',
             'pygobject'
-        ]
+        ],
+        extras_require={
+            'formats': ['pyarrow', 'h5py'],
+            'mcmc': ['emcee'],
+        }
 )